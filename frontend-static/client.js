@@ -18,16 +18,11 @@ var MAX_AI_LOG_ELS = 28;
 var FILLED_RECTS = false;
 var FILL_OPACITY_HEX = '22';
 
-var target_fps = 12;
 var emojiSize = 28;
 
-var request_start_time = performance.now();
 var start_time = performance.now();
 var time = 0;
-var request_time = 0;
 var time_smoothing = 1.2; // larger=more smoothing
-var request_time_smoothing = 0.2; // larger=more smoothing
-var target_time = 1000 / target_fps;
 
 var sounds = {
   'tap_location': {src:'Rodeo-single-click.wav'},
@@ -527,11 +522,7 @@ function showNewMoneyAnimation() {
 
 /// Image Handling
 
-function requestImage() {
-  request_start_time = performance.now();
-  ws.send('more');
-}
-
+// frames are pushed by the server (at most FRONTEND_PUSH_FPS), no need to ask for them
 function handleImageMessage(arrayBuffer) {
   if (playing) {
     if (img.src) {
@@ -547,20 +538,91 @@ function handleImageMessage(arrayBuffer) {
     time = (time * time_smoothing) + (current_time * (1.0 - time_smoothing));
     start_time = end_time;
     renderState.fps = Math.round(1000 / time);
-
-    // smooth with moving average
-    var current_request_time = performance.now() - request_start_time;
-    request_time = (request_time * request_time_smoothing) + (current_request_time * (1.0 - request_time_smoothing));
-    var timeout = Math.max(0, target_time - request_time);
   }
-
-  setTimeout(requestImage, timeout);
 }
 
 /// Data Updates
 
 const parseMessageKey = (data, key) => typeof data[key] === 'string' ? JSON.parse(data[key]) : data[key]
 
+/// State Sync (full snapshot on connect, then deltas against acked versions, see src/state_sync.py)
+
+var syncedStates = {}  // version -> state, for versions the server may still send deltas against
+var awaitingSnapshot = false
+
+function sendStateSyncMessage(message) {
+  if (ws.readyState === WebSocket.OPEN) {
+    ws.send(JSON.stringify(message))
+  }
+}
+
+function applyFieldsDiff(base, diff) {
+  if (!diff) {
+    return base
+  }
+  const next = Object.assign({}, base || {}, diff.set)
+  diff.unset.forEach(key => { delete next[key] })
+  return next
+}
+
+function applyObjectsDiff(objects, diff) {
+  if (!diff) {
+    return objects
+  }
+  const next = new Map(objects)
+  diff.unset.forEach(key => next.delete(key))
+  diff.set.forEach(([key, obj]) => next.set(key, obj))
+  return next
+}
+
+function toCurState(state) {
+  const imageState = state.imageState && Object.assign({}, state.imageState, {image_objects: Array.from(state.objects.values())})
+  return {frameNum: state.frameNum, imageState, systemInfo: state.systemInfo, aiStatus: state.aiStatus}
+}
+
+function handleStateSnapshot(data) {
+  const imageObjects = data.imageState ? data.imageState.image_objects : []
+  const state = {
+    frameNum: data.frameNum,
+    imageState: data.imageState,
+    objects: new Map((data.objectKeys || []).map((key, i) => [key, imageObjects[i]])),
+    systemInfo: data.systemInfo,
+    aiStatus: data.aiStatus,
+  }
+  syncedStates = {[data.version]: state}
+  awaitingSnapshot = false
+  sendStateSyncMessage({type: 'ack', version: data.version})
+  handleCurStateUpdate(toCurState(state))
+}
+
+function handleStateDelta(data) {
+  const base = syncedStates[data.base]
+  if (!base) {
+    if (!awaitingSnapshot) {
+      awaitingSnapshot = true
+      sendStateSyncMessage({type: 'resync'})
+    }
+    return
+  }
+
+  const state = {
+    frameNum: data.frameNum,
+    imageState: applyFieldsDiff(base.imageState, data.imageState),
+    objects: applyObjectsDiff(base.objects, data.objects),
+    systemInfo: applyFieldsDiff(base.systemInfo, data.systemInfo),
+    aiStatus: applyFieldsDiff(base.aiStatus, data.aiStatus),
+  }
+  // the server only diffs against versions we acked, which never go backwards
+  Object.keys(syncedStates).forEach(version => {
+    if (Number(version) < data.base) {
+      delete syncedStates[version]
+    }
+  })
+  syncedStates[data.version] = state
+  sendStateSyncMessage({type: 'ack', version: data.version})
+  handleCurStateUpdate(toCurState(state))
+}
+
 function handleCurStateUpdate(data) {
   if (!playing) {
     return
@@ -644,14 +706,6 @@ ws.onopen = function() {
   console.log('connection was established');
   setupUserInteraction();
   start_time = performance.now();
-  requestImage();
-
-  // set up interval such that if we haven't gotten an image in a while we request more
-  setInterval(() => {
-    if (performance.now() - request_start_time > 1000) {
-      requestImage();
-    }
-  }, 300);
 };
 
 ws.onmessage = function(evt) {
@@ -660,7 +714,10 @@ ws.onmessage = function(evt) {
       const message = JSON.parse(evt.data)
       switch (message.type) {
         case 'curState':
-          handleCurStateUpdate(message.data)
+          handleStateSnapshot(message.data)
+          break
+        case 'stateDelta':
+          handleStateDelta(message.data)
           break
         case 'aiAction':
           handleAIActionUpdate(message.data)
@@ -0,0 +1,23 @@
+// Reads the parts of phone-image-states messages the hub shows, from either the
+// binary AIState wire format (see src/ai_state_wire.py) or the old json messages.
+
+const MAGIC = 'KAIS'
+const INDEX_OFFSET = 8
+const NUM_OBJECTS_OFFSET = 52
+
+function decodePhoneImageStateSummary(buffer) {
+  if (buffer.length >= 56 && buffer.toString('ascii', 0, 4) === MAGIC) {
+    const index = buffer.readUInt32LE(INDEX_OFFSET) + buffer.readUInt32LE(INDEX_OFFSET + 4) * 2 ** 32
+    return { index, numImageObjects: buffer.readUInt32LE(NUM_OBJECTS_OFFSET) }
+  }
+
+  try {
+    const { index, state: stateJSON } = JSON.parse(buffer.toString())
+    const state = JSON.parse(stateJSON)
+    return { index, numImageObjects: (state.image_objects || []).length }
+  } catch (err) {
+    return null
+  }
+}
+
+module.exports = { decodePhoneImageStateSummary }
@@ -9,6 +9,8 @@ const { screen, grid, dashboardParts, resetDashboardTimer, genlog, endLogWriteSt
 const { KimProcessManager } = require('./kim-process-manager')
 const { getSystemInfoObject } = require('./system-info')
 const { setWindowTitle, setupVisibleWindows, setupVysorWindow } = require('./util')
+const { decodePhoneImageStateSummary } = require('./ai-state-wire')
+const { subscribeRedisChannels } = require('./redis-channels')
 const { OPTIONS, modes, mode, baseProcessConfigs } = require('./config')
 
 const rSubscriber = redis.createClient()
@@ -56,8 +58,8 @@ const getCurrentCommands = () => [
 
 function getAiStatusStateLines() {
   const {
-    screenIndex, mostRecentAction, imageObjects,
-    stepNum, reward, recentPolicyChoice, recentActionStepNums,
+    screenIndex, mostRecentAction, numImageObjects,
+    stepNum, reward, recentPolicyChoice, recentActionStepNums, imageStreamPerf,
   } = aiStatusState
 
   let recentActionLabel = 'None'
@@ -73,15 +75,24 @@ function getAiStatusStateLines() {
 
   const recentActionStepKeys = Object.keys(recentActionStepNums)
 
+  // slowest vision stages by p95, from the image stream's perf metrics
+  const perfStages = imageStreamPerf ? imageStreamPerf.stages : {}
+  const slowStageNames = Object.keys(perfStages)
+    .filter(k => k !== 'frame_interval' && k !== 'latency')
+    .sort((a, b) => perfStages[b].p95 - perfStages[a].p95)
+    .slice(0, 3)
+
   return [
     '',
     `Screen Index`.bgRed.bold + ' - ' + `${screenIndex}`.red.bold,
     `Step`.bgBlue.bold + ' - ' + `${stepNum}`.brightBlue.bold,
     `Reward`.bgGreen.bold + ' - ' + ` ${reward}`.brightGreen.bold,
-    `Num Image Objects`.bgCyan.bold + ' - ' + `${imageObjects ? imageObjects.length : '?'}`.brightCyan.bold,
+    `Num Image Objects`.bgCyan.bold + ' - ' + `${numImageObjects !== null ? numImageObjects : '?'}`.brightCyan.bold,
     `Recent Policy`.bgWhite.black.bold + ` - ` + `${recentPolicyChoice}`.white.bold,
     `Recent Action`.bgYellow.bold + ` - ` + `${recentActionLabel}`.yellow.bold,
     ...recentActionStepKeys.map(k => `Num Steps Since ${k.green.underline}`.bgMagenta.bold + ` - ` + `${stepNum - recentActionStepNums[k]}`.brightMagenta.bold),
+    ...(imageStreamPerf ? [`Vision FPS`.bgRed.bold + ' - ' + `${imageStreamPerf.fps}`.red.bold] : []),
+    ...slowStageNames.map(k => `Vision ${k}`.bgRed.bold + ' - ' + `p50 ${perfStages[k].p50}ms / p95 ${perfStages[k].p95}ms`.red.bold),
   ]
 }
 
@@ -143,44 +154,42 @@ function renderScreenLoop() {
 /// Redis
 
 const redisChannels = [
-  { name: 'phone-image-states', handler: handlePhoneImageStates },
+  { name: 'phone-image-states', handler: handlePhoneImageStates, binary: true },
   { name: 'ai-action-stream', handler: handleAIActionStream },
   { name: 'ai-status-updates', handler: handleAIStatusUpdates },
+  { name: 'system-info-updates', handler: handleSystemInfoUpdates },
 ]
 
-rSubscriber.on('message', (channel, message) => {
-  const item = redisChannels.find(rc => rc.name === channel)
-  if (item) {
-    let data = {}
-    try {
-      data = JSON.parse(message)
-    } catch (err) {}
-
-    item.handler(data)
-  }
-})
-
-redisChannels.forEach(rc => rSubscriber.subscribe(rc.name))
+subscribeRedisChannels(rSubscriber, redisChannels)
 
 const aiStatusState = {
   screenIndex: 0,
   mostRecentAction: null,
-  imageObjects: null,
+  numImageObjects: null,
   reward: 0,
   stepNum: 0,
   recentPolicyChoice: null,
   recentActionStepNums: {},
   actionItems: [],
+  imageStreamPerf: null,
 }
 
-function handlePhoneImageStates(data) {
-  const { index, state: stateJSON } = data
-  const state = JSON.parse(stateJSON || "")
-  aiStatusState.screenIndex = index
-  aiStatusState.imageObjects = state && state.image_objects || []
+function handlePhoneImageStates(buffer) {
+  const summary = decodePhoneImageStateSummary(buffer)
+  if (!summary) return
+
+  aiStatusState.screenIndex = summary.index
+  aiStatusState.numImageObjects = summary.numImageObjects
   updateAIStatusBox()
 }
 
+function handleSystemInfoUpdates(data) {
+  if (data.imageStreamPerf) {
+    aiStatusState.imageStreamPerf = data.imageStreamPerf
+    updateAIStatusBox()
+  }
+}
+
 function handleAIActionStream(data) {
   if (data.type) {
     aiStatusState.mostRecentAction = data
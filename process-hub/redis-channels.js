@@ -0,0 +1,30 @@
+// Hooks a node_redis subscriber up to a list of { name, handler, binary } channels.
+// Json channels get the parsed message, binary ones the raw buffer.
+
+function handleRedisMessage(channels, channel, message) {
+  const item = channels.find(rc => rc.name === channel)
+  if (item && !item.binary) {
+    let data = {}
+    try {
+      data = JSON.parse(message)
+    } catch (err) {}
+
+    item.handler(data)
+  }
+}
+
+function handleRedisMessageBuffer(channels, channel, message) {
+  const item = channels.find(rc => rc.name === channel.toString())
+  if (item && item.binary) {
+    item.handler(message)
+  }
+}
+
+function subscribeRedisChannels(subscriber, channels) {
+  subscriber.on('message', (channel, message) => handleRedisMessage(channels, channel, message))
+  // node_redis only emits buffers (as 'message_buffer') once something listens for them
+  subscriber.on('message_buffer', (channel, message) => handleRedisMessageBuffer(channels, channel, message))
+  channels.forEach(rc => subscriber.subscribe(rc.name))
+}
+
+module.exports = { subscribeRedisChannels, handleRedisMessage, handleRedisMessageBuffer }
@@ -0,0 +1,50 @@
+const test = require('node:test')
+const assert = require('node:assert')
+const { EventEmitter } = require('events')
+const { subscribeRedisChannels } = require('../redis-channels')
+const { decodePhoneImageStateSummary } = require('../ai-state-wire')
+
+// header of a version 2 KAIS message (see src/ai_state_wire.py), without the body
+function encodeStateHeader(index, numImageObjects) {
+  const buffer = Buffer.alloc(64)
+  buffer.write('KAIS', 0, 'ascii')
+  buffer.writeUInt8(2, 4)
+  buffer.writeUInt32LE(index % 2 ** 32, 8)
+  buffer.writeUInt32LE(Math.floor(index / 2 ** 32), 12)
+  buffer.writeUInt32LE(numImageObjects, 52)
+  buffer.writeDoubleLE(NaN, 56)
+  return buffer
+}
+
+class FakeSubscriber extends EventEmitter {
+  constructor() {
+    super()
+    this.subscribed = []
+  }
+
+  subscribe(name) {
+    this.subscribed.push(name)
+  }
+}
+
+test('binary phone-image-states from message_buffer are decoded', () => {
+  const summaries = []
+  const jsonMessages = []
+  const subscriber = new FakeSubscriber()
+  subscribeRedisChannels(subscriber, [
+    { name: 'phone-image-states', handler: buffer => summaries.push(decodePhoneImageStateSummary(buffer)), binary: true },
+    { name: 'ai-status-updates', handler: data => jsonMessages.push(data) },
+  ])
+  assert.deepStrictEqual(subscriber.subscribed, ['phone-image-states', 'ai-status-updates'])
+
+  // node_redis emits every message as both 'message' (string) and 'message_buffer'
+  const state = encodeStateHeader(2 ** 32 + 7, 3)
+  subscriber.emit('message', 'phone-image-states', state.toString())
+  subscriber.emit('message_buffer', Buffer.from('phone-image-states'), state)
+  const status = '{"stepNum": 4}'
+  subscriber.emit('message', 'ai-status-updates', status)
+  subscriber.emit('message_buffer', Buffer.from('ai-status-updates'), Buffer.from(status))
+
+  assert.deepStrictEqual(summaries, [{ index: 2 ** 32 + 7, numImageObjects: 3 }])
+  assert.deepStrictEqual(jsonMessages, [{ stepNum: 4 }])
+})
@@ -1,21 +1,106 @@
+import atexit
 import json
+import threading
 import redis
+from collections import deque
 from time import time
 from kim_logs import get_kim_logger
 from ai_actions import get_action_type_str
 from config import REDIS_HOST, REDIS_PORT
+from config import AI_INFO_PUBLISH_BATCH_SIZE, AI_INFO_PUBLISH_INTERVAL, AI_INFO_PUBLISH_BUFFER_SIZE
 
 
 class AIInfoPublisher:
-    def __init__(self, host=REDIS_HOST, port=REDIS_PORT):
+    '''
+    Publishing only queues the message, a background thread sends queued messages
+    in one redis pipeline once batch_size of them are waiting or flush_interval
+    passed. When the buffer is full the oldest messages are dropped (and counted).
+    Whatever is still queued is flushed at exit.
+    '''
+
+    def __init__(self,
+                 host=REDIS_HOST,
+                 port=REDIS_PORT,
+                 batch_size=AI_INFO_PUBLISH_BATCH_SIZE,
+                 flush_interval=AI_INFO_PUBLISH_INTERVAL,
+                 buffer_size=AI_INFO_PUBLISH_BUFFER_SIZE):
         self.logger = get_kim_logger('AIActionPublisher')
 
         self.logger.debug('Connecting to %s:%d', host, port)
         self.r = redis.StrictRedis(
             host=host, port=port, db=0, decode_responses=True)
 
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = deque(maxlen=buffer_size)
+        self.buffer_cond = threading.Condition()
+        self.send_lock = threading.Lock()
+        self.num_published = 0
+        self.num_dropped = 0
+        self.num_failed = 0
+        self.closed = False
+
+        self.flusher = threading.Thread(target=self._run_flusher, name='AIInfoPublisherFlusher', daemon=True)
+        self.flusher.start()
+        atexit.register(self.close)
+
     def publish_data(self, channel, data, tojson=True):
-        self.r.publish(channel, json.dumps(data) if tojson else data)
+        message = json.dumps(data) if tojson else data
+        with self.buffer_cond:
+            if len(self.buffer) == self.buffer.maxlen:
+                self.num_dropped += 1
+            self.buffer.append((channel, message))
+            if len(self.buffer) >= self.batch_size:
+                self.buffer_cond.notify()
+
+    def _run_flusher(self):
+        while True:
+            with self.buffer_cond:
+                if len(self.buffer) < self.batch_size and not self.closed:
+                    self.buffer_cond.wait(self.flush_interval)
+                if self.closed:
+                    return
+            self.flush()
+
+    def flush(self):
+        ''' sends everything queued so far, returns the number of messages sent '''
+        with self.send_lock:
+            with self.buffer_cond:
+                messages = list(self.buffer)
+                self.buffer.clear()
+            if not messages:
+                return 0
+
+            pipe = self.r.pipeline(transaction=False)
+            for channel, message in messages:
+                pipe.publish(channel, message)
+            try:
+                pipe.execute()
+            except redis.RedisError:
+                self.num_failed += len(messages)
+                self.logger.exception('Failed to publish %d messages', len(messages))
+                return 0
+
+            self.num_published += len(messages)
+            return len(messages)
+
+    def close(self):
+        ''' stops the flusher and sends whatever is left '''
+        with self.buffer_cond:
+            if self.closed:
+                return
+            self.closed = True
+            self.buffer_cond.notify()
+        self.flusher.join(timeout=1)
+        self.flush()
+
+    def get_stats(self):
+        return {
+            'published': self.num_published,
+            'dropped': self.num_dropped,
+            'failed': self.num_failed,
+            'queued': len(self.buffer),
+        }
 
     def publish_action(self, action, args):
         name = get_action_type_str(action)
@@ -1,17 +1,23 @@
 """ Code to transform images from KK:Hollywood into numerical state """
 
-import tensorflow as tf
 import cv2
 from concurrent import futures
-from darkflow.net.build import TFNet
 from config import TFNET_CONFIG, CURRENT_IMG_CONFIG, HOUGH_CIRCLES_CONFIG
-from config import DARKNET_SPECIFIC_OBJECT_THRESHOLDS
+from config import DARKNET_SPECIFIC_OBJECT_THRESHOLDS, IMAGE_PROCESS_THREADS
+from config import IMAGE_PROCESS_MODE, IMAGE_PROCESS_WORKERS, FRAME_CHANGE_GATING, OBJECT_DETECTOR_BACKEND
+from config import OBJECT_TRACKING
 from image_circles import get_image_circles
 from image_blob import BlobDetector
 from image_contours import get_kim_action_color_shapes
 from image_color import get_image_color_features
 from image_ocr import ImageOCRProcessor
+from image_change import FrameChangeDetector
 from ai_state_data import AIState
+from ai_state_workers import VisionProcessPool
+from object_detectors import create_object_detector
+from object_tracker import ObjectTracker
+from kim_logs import get_kim_logger
+from perf_metrics import StageMetrics
 from util import convert_rect_between_rects
 
 
@@ -57,22 +63,66 @@ def _process_image_objects(image_objects, image_size, scale=1):
 class AIStateProcessor(object):
     """ Top-level class for translating an image into state """
 
-    def __init__(self, image_config):
+    def __init__(self,
+                 image_config,
+                 process_mode=IMAGE_PROCESS_MODE,
+                 gate_unchanged_frames=FRAME_CHANGE_GATING,
+                 metrics=None,
+                 use_yolo=True,
+                 detector_backend=OBJECT_DETECTOR_BACKEND,
+                 track_objects=OBJECT_TRACKING):
+        self.logger = get_kim_logger('AIStateProcessor')
         self.image_config = image_config
-        self.ocr_processor = ImageOCRProcessor(image_config)
-        self.tfnet = TFNet(TFNET_CONFIG)
+        self.metrics = metrics if metrics is not None else StageMetrics()
+        self.ocr_processor = ImageOCRProcessor(image_config, metrics=self.metrics)
+
+        # skip processing frames that haven't changed since the last processed one
+        self.change_detector = FrameChangeDetector(watch_rects=self._get_hud_watch_rects()) \
+            if gate_unchanged_frames else None
+        self.last_state = None
+
+        # worker processes have to be forked before tensorflow gets going
+        self.process_pool = None
+        if process_mode == 'process':
+            if VisionProcessPool.is_available():
+                self.process_pool = VisionProcessPool(IMAGE_PROCESS_WORKERS, metrics=self.metrics)
+            else:
+                self.logger.warning('Shared memory unavailable, falling back to threaded processing')
+
+        # yolo is optional so the rest of the stack can run on boxes without a detector
+        self.object_detector = create_object_detector(detector_backend, TFNET_CONFIG) if use_yolo else None
+        # detector only runs every few frames, objects are tracked in between
+        self.object_tracker = ObjectTracker() if use_yolo and track_objects else None
         self.blob_detector = BlobDetector()
 
-    def process_from_np_img(self, sess, np_img, scale=1):
+        # long-lived pool shared by every frame (one thread per state component)
+        self.executor = futures.ThreadPoolExecutor(max_workers=IMAGE_PROCESS_THREADS)
+
+    def _get_hud_watch_rects(self):
+        """ money / stars HUD (and the menubar pixels left of money) as x,y,w,h rects """
+        c = self.image_config
+        menubar_pad = 50
+        height = c.top_menu_height - c.top_menu_padding
+        return [
+            (max(0, c.money_item_left - menubar_pad), 0, c.top_menu_item_width + menubar_pad, height),
+            (c.stars_item_left, 0, c.top_menu_item_width, height),
+        ]
+
+    def close(self):
+        """ Shuts down the long-lived worker pools """
+        self.executor.shutdown(wait=False)
+        self.ocr_processor.close()
+        if self.object_detector:
+            self.object_detector.close()
+        if self.process_pool:
+            self.process_pool.close()
+
+    def get_state_components(self, np_img, scale=1):
         """
         Args:
-            sess: A Tensorflow session object
             np_img: np array of image pixels
         Returns:
-            A processed AIState object.
-
-        FPS with sync pil and yolo: ~3.9
-        FPS with threaded pil and yolo: ~6.8
+            list of (name, fn) tuples. each fn returns a dict of AIState kwargs.
         """
 
         scaled_np_img = np_img
@@ -91,9 +141,21 @@ class AIStateProcessor(object):
             return pil_features
 
         # Gets the very valuable yolo objects
+        def detect_objects():
+            yolo_result = self.object_detector.detect(scaled_np_img_3chan)
+            return _process_image_objects(yolo_result, image_size=(scaled_width, scaled_height), scale=scale)
+
         def get_yolo_state():
-            yolo_result = self.tfnet.return_predict(scaled_np_img_3chan)
-            return {'image_objects': _process_image_objects(yolo_result, image_size=(scaled_width, scaled_height), scale=scale)}
+            tracker = self.object_tracker
+            if tracker is None:
+                return {'image_objects': detect_objects()}
+
+            change_fraction = self.change_detector.last_change_fraction if self.change_detector else 0
+            if tracker.should_detect(change_fraction):
+                return {'image_objects': tracker.update_detections(np_img, detect_objects())}
+
+            self.metrics.increment('yolo_tracked_frames')
+            return {'image_objects': tracker.propagate(np_img)}
 
         # Gets Tappable circles!!
         def get_circles_state():
@@ -136,35 +198,66 @@ class AIStateProcessor(object):
 
             return {'on_menubar': 1 if on_menubar else 0}
 
+        state_components = [
+            ('pil_state', get_pil_state),
+            ('yolo_state', get_yolo_state),
+            ('circles_state', get_circles_state),
+            # ('blobs_state', get_blobs),
+            ('shapes_state', get_shapes),
+            ('menubar_state', check_on_menubar),
+            ('color_state', get_color_features)
+        ]
+        if self.object_detector is None:
+            state_components = [c for c in state_components if c[0] != 'yolo_state']
+
+        # swap in the worker process versions of the cpu-bound components
+        if self.process_pool:
+            process_components = self.process_pool.get_process_components(np_img)
+            state_components = [(name, process_components.get(name, fn)) for name, fn in state_components]
+
+        return state_components
+
+    def process_from_np_img(self, sess, np_img, scale=1):
+        """
+        Args:
+            sess: A Tensorflow session object
+            np_img: np array of image pixels
+        Returns:
+            A processed AIState object.
+
+        FPS with sync pil and yolo: ~3.9
+        FPS with threaded pil and yolo: ~6.8
+
+        Returns the previous AIState object untouched if frame hasn't changed.
+        """
+
+        frame_changed = self.change_detector.has_changed(np_img) if self.change_detector else True
+        if not frame_changed and self.last_state is not None:
+            self.metrics.increment('frames_skipped')
+            return self.last_state
+
+        state_components = self.get_state_components(np_img, scale)
+        state_futures = [self.executor.submit(self.metrics.timed(name, fn)) for name, fn in state_components]
+
         state_data = {}
-        with futures.ThreadPoolExecutor() as executor:
-            state_components = [
-                ('pil_state', get_pil_state),
-                ('yolo_state', get_yolo_state),
-                ('circles_state', get_circles_state),
-                # ('blobs_state', get_blobs),
-                ('shapes_state', get_shapes),
-                ('menubar_state', check_on_menubar),
-                ('color_state', get_color_features)
-            ]
-
-            state_futures = [executor.submit(c[1]) for c in state_components]
-
-            futures.wait(state_futures)
-            for i in range(len(state_futures)):
-                try:
-                    future = state_futures[i]
-                    data = future.result()
-                    state_data.update(data)
-                except Exception as e:
-                    name = state_components[i][0]
-                    print('Exception getting %s: %s' % (name, e))
-
-        return AIState(**state_data)
+        futures.wait(state_futures)
+        for i in range(len(state_futures)):
+            try:
+                future = state_futures[i]
+                data = future.result()
+                state_data.update(data)
+            except Exception as e:
+                name = state_components[i][0]
+                print('Exception getting %s: %s' % (name, e))
+
+        self.metrics.increment('frames_processed')
+        self.last_state = AIState(**state_data)
+        return self.last_state
 
 
 def get_image_state(filename, image_config=CURRENT_IMG_CONFIG):
     """ Utility function to get state from a single image """
+    import tensorflow as tf
     processor = AIStateProcessor(image_config=image_config)
 
     with tf.Session() as sess:
@@ -46,7 +46,8 @@ class AIState(object):
                  tap_circles=[],
                  color_features=None,
                  blobs=[],
-                 shapes=[]):
+                 shapes=[],
+                 capture_time=None):
         self.logger = get_kim_logger('AIState')
         # self.image = tf.placeholder(shape=image_shape, dtype=tf.uint8)
 
@@ -57,7 +58,9 @@ class AIState(object):
         self.color_features = color_features
         self.color_sig = color_features['color_sig'] if color_features is not None and 'color_sig' in color_features else 'none'  # rough idea of colors in room
         self.image_sig = color_features['image_sig'] if color_features is not None and 'image_sig' in color_features else 'none'  # hard idea of exact image -- should change frame to frame
+        self.room_hash = color_features['room_hash'] if color_features is not None and 'room_hash' in color_features else 'none'  # fuzzy idea of screen, compared by hamming distance
         self.image_objects = image_objects if image_objects is not None else []
+        self.capture_time = capture_time  # time.time() the frame was captured, set when read off the wire
 
         for idx, c in enumerate(tap_circles):
             x, y, r = c
@@ -0,0 +1,275 @@
+'''
+Compact binary encoding of published AIStates (phone-image-states / cur-phone-image-state).
+
+Layout (little endian), version 2:
+
+    header   magic 'KAIS', version u8, flags u8 (1: on_menubar, 2: has image_sig, 4: has image_shape),
+             reserved u16, index u64, money i64, stars i64, image_sig u64,
+             image_shape (u32 width, u32 height, u32 channels), num_objects u32,
+             capture_time f64 (time.time() the frame was captured, not in version 1)
+    strings  color_sig, room_hash, then the string table, each as u16 length + utf-8
+             (string table is preceded by its u16 count)
+    objects  struct of arrays, one array per column, num_objects long:
+             kind u8, label u16, confidence f32 (nan for None), rect 4 x f32, nums 4 x f32, strs 4 x u16
+
+Labels are ids from get_object_name_int_values, or STRING_LABEL_FLAG | string table index
+for labels that aren't in it (like 'Circle #1'). What nums / strs hold depends on kind,
+see _pack_object. Readers should use decode_phone_image_state, which also reads the old
+json messages, so either format can be on the wire.
+'''
+
+import json
+import struct
+import numpy as np
+from ai_state_data import AIState
+from object_name_values import get_object_name_int_values
+from config import AI_STATE_WIRE_FORMAT
+
+MAGIC = b'KAIS'
+VERSION = 2
+
+HEADER_V1 = struct.Struct('<4sBBHQqqQIIII')
+HEADER = struct.Struct('<4sBBHQqqQIIIId')
+INDEX_OFFSET = 8
+CAPTURE_TIME_OFFSET = HEADER_V1.size
+STR_LEN = struct.Struct('<H')
+
+FLAG_ON_MENUBAR = 1
+FLAG_HAS_IMAGE_SIG = 2
+FLAG_HAS_IMAGE_SHAPE = 4
+
+KIND_OBJECT = 0
+KIND_CIRCLE = 1
+KIND_BLOB = 2
+KIND_ACTION_SHAPE = 3
+KIND_NAMES = {KIND_CIRCLE: 'circle', KIND_BLOB: 'blob', KIND_ACTION_SHAPE: 'action_shape'}
+KIND_VALUES = {v: k for k, v in KIND_NAMES.items()}
+
+STRING_LABEL_FLAG = 0x8000
+NO_STRING = 0xFFFF
+NO_VALUE = -1.0
+
+OBJECT_COLUMNS = [
+    ('kind', np.uint8, 1),
+    ('label', np.uint16, 1),
+    ('confidence', np.float32, 1),
+    ('rect', np.float32, 4),
+    ('nums', np.float32, 4),
+    ('strs', np.uint16, 4),
+]
+
+NAME_VALUES, VALUE_NAMES, _ = get_object_name_int_values()
+
+
+class _StringTable(object):
+    def __init__(self):
+        self.strings = []
+        self.ids = {}
+
+    def get_id(self, s):
+        if s is None:
+            return NO_STRING
+        if s not in self.ids:
+            self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.ids[s]
+
+
+def _pack_str(s):
+    data = s.encode('utf-8')
+    return STR_LEN.pack(len(data)) + data
+
+
+def _unpack_str(payload, offset):
+    (length,) = STR_LEN.unpack_from(payload, offset)
+    offset += STR_LEN.size
+    return payload[offset:offset + length].decode('utf-8'), offset + length
+
+
+def _num(v):
+    return NO_VALUE if v is None else v
+
+
+def _pack_object(obj, strings):
+    ''' returns (kind, label, confidence, rect, nums, strs) for an image object dict '''
+    kind = KIND_VALUES.get(obj.get('object_type'), KIND_OBJECT)
+    label = obj['label']
+    label_id = NAME_VALUES[label] if label in NAME_VALUES else STRING_LABEL_FLAG | strings.get_id(label)
+    confidence = np.nan if obj.get('confidence') is None else obj['confidence']
+
+    nums = [NO_VALUE] * 4
+    strs = [NO_STRING] * 4
+    if kind == KIND_OBJECT:
+        # tracking info (see object_tracker.py)
+        nums = [_num(obj.get('track_id')), _num(obj.get('age')), 1 if obj.get('tracked') else 0, NO_VALUE]
+    elif kind == KIND_CIRCLE:
+        nums[0] = obj['radius']
+    elif kind == KIND_BLOB:
+        nums = [obj['size']] + list(obj['circle'])
+        strs[0] = strings.get_id(obj['dom_color'])
+    elif kind == KIND_ACTION_SHAPE:
+        sd = obj['shape_data']
+        nums = [sd['area'], sd['verts'], sd['boundsArea'], NO_VALUE]
+        strs = [strings.get_id(sd[k]) for k in ('shape', 'color_label', 'action_shape', 'shape_label')]
+
+    return kind, label_id, confidence, list(obj['rect']), nums, strs
+
+
+def _unpack_object(kind, label_id, confidence, rect, nums, strs, strings):
+    def get_str(i):
+        return strings[i] if i != NO_STRING else None
+
+    kind, label_id = int(kind), int(label_id)
+    label = get_str(label_id & ~STRING_LABEL_FLAG) if label_id & STRING_LABEL_FLAG else VALUE_NAMES[label_id]
+    obj = {
+        'label': label,
+        'confidence': None if np.isnan(confidence) else float(confidence),
+        'rect': tuple(int(v) if float(v).is_integer() else float(v) for v in rect),
+    }
+
+    if kind == KIND_OBJECT:
+        if nums[0] != NO_VALUE:
+            obj.update(track_id=int(nums[0]), age=int(nums[1]), tracked=bool(nums[2]))
+        return obj
+
+    obj['object_type'] = KIND_NAMES[kind]
+    if kind == KIND_CIRCLE:
+        obj['radius'] = int(nums[0])
+    elif kind == KIND_BLOB:
+        obj['size'] = float(nums[0])
+        obj['circle'] = tuple(int(v) for v in nums[1:])
+        obj['dom_color'] = get_str(strs[0])
+    elif kind == KIND_ACTION_SHAPE:
+        shape, color_label, action_shape, shape_label = [get_str(i) for i in strs]
+        obj['shape_data'] = {
+            'area': int(nums[0]),
+            'verts': int(nums[1]),
+            'boundsArea': int(nums[2]),
+            'shape': shape,
+            'color_label': color_label,
+            'action_shape': action_shape,
+            'shape_label': shape_label,
+        }
+    return obj
+
+
+def encode_ai_state(ai_state, index, capture_time=None):
+    ''' AIState + frame index / capture time -> bytes '''
+    strings = _StringTable()
+    objects = [_pack_object(o, strings) for o in ai_state.image_objects]
+
+    image_sig = ai_state.image_sig if isinstance(ai_state.image_sig, int) else None
+    image_shape = tuple(ai_state.image_shape) if ai_state.image_shape else None
+    flags = (FLAG_ON_MENUBAR if ai_state.on_menubar else 0) \
+        | (FLAG_HAS_IMAGE_SIG if image_sig is not None else 0) \
+        | (FLAG_HAS_IMAGE_SHAPE if image_shape else 0)
+    shape_vals = (list(image_shape) + [0, 0, 0])[:3] if image_shape else [0, 0, 0]
+
+    parts = [
+        HEADER.pack(MAGIC, VERSION, flags, 0, index, ai_state.money, ai_state.stars,
+                    image_sig or 0, shape_vals[0], shape_vals[1], shape_vals[2], len(objects),
+                    capture_time if capture_time is not None else np.nan),
+        _pack_str(ai_state.color_sig),
+        _pack_str(ai_state.room_hash),
+    ]
+
+    # columns first, since packing objects fills the string table
+    columns = []
+    for col_idx, (_, dtype, width) in enumerate(OBJECT_COLUMNS):
+        values = [o[col_idx] for o in objects]
+        columns.append(np.array(values, dtype=dtype).reshape(len(objects) * width).tobytes())
+
+    parts.append(STR_LEN.pack(len(strings.strings)))
+    parts += [_pack_str(s) for s in strings.strings]
+    parts += columns
+    return b''.join(parts)
+
+
+def set_phone_image_state_frame(payload, index, capture_time=None):
+    ''' copy of a phone image state message for a different frame (to republish an unchanged state) '''
+    if not is_binary_ai_state(payload):
+        # the state is a string inside the json, so this doesn't re-serialize it
+        return json.dumps(dict(json.loads(payload), index=index, capture_time=capture_time))
+    payload = bytearray(payload)
+    struct.pack_into('<Q', payload, INDEX_OFFSET, index)
+    struct.pack_into('<d', payload, CAPTURE_TIME_OFFSET, capture_time if capture_time is not None else np.nan)
+    return bytes(payload)
+
+
+def is_binary_ai_state(payload):
+    return isinstance(payload, (bytes, bytearray, memoryview)) and bytes(payload[:4]) == MAGIC
+
+
+def decode_ai_state(payload):
+    ''' bytes -> (index, AIState), AIState.capture_time is None for version 1 data '''
+    (magic, version, flags, _, index, money, stars, image_sig,
+     width, height, channels, num_objects) = HEADER_V1.unpack_from(payload, 0)
+    if magic != MAGIC or version > VERSION:
+        raise ValueError('Unsupported AIState wire data (version %s)' % version)
+
+    capture_time = None
+    offset = HEADER_V1.size
+    if version >= 2:
+        capture_time = HEADER.unpack_from(payload, 0)[-1]
+        capture_time = None if np.isnan(capture_time) else capture_time
+        offset = HEADER.size
+    color_sig, offset = _unpack_str(payload, offset)
+    room_hash, offset = _unpack_str(payload, offset)
+
+    (num_strings,) = STR_LEN.unpack_from(payload, offset)
+    offset += STR_LEN.size
+    strings = []
+    for _ in range(num_strings):
+        s, offset = _unpack_str(payload, offset)
+        strings.append(s)
+
+    columns = []
+    for _, dtype, width in OBJECT_COLUMNS:
+        col = np.frombuffer(payload, dtype=dtype, count=num_objects * width, offset=offset)
+        columns.append(col.reshape(num_objects, width) if width > 1 else col)
+        offset += col.nbytes
+
+    image_objects = [_unpack_object(*[col[i] for col in columns], strings=strings) for i in range(num_objects)]
+
+    color_features = {
+        'color_sig': color_sig,
+        'image_sig': image_sig if flags & FLAG_HAS_IMAGE_SIG else 'none',
+        'room_hash': room_hash,
+    }
+    ai_state = AIState(
+        image_shape=(width, height, channels) if flags & FLAG_HAS_IMAGE_SHAPE else None,
+        money=money,
+        stars=stars,
+        on_menubar=1 if flags & FLAG_ON_MENUBAR else 0,
+        image_objects=image_objects,
+        color_features=color_features,
+        capture_time=capture_time)
+    return index, ai_state
+
+
+def encode_phone_image_state(ai_state, index, capture_time=None, wire_format=AI_STATE_WIRE_FORMAT):
+    ''' message for phone-image-states / cur-phone-image-state in the configured format '''
+    if wire_format == 'binary':
+        return encode_ai_state(ai_state, index, capture_time)
+    return json.dumps({'index': index, 'capture_time': capture_time, 'state': ai_state.serialize()})
+
+
+def decode_phone_image_state(payload):
+    ''' (index, AIState) from either a binary or an old json phone image state message '''
+    if is_binary_ai_state(payload):
+        return decode_ai_state(payload)
+
+    if isinstance(payload, (bytes, bytearray)):
+        payload = payload.decode('utf-8')
+    data = json.loads(payload)
+    ai_state = AIState.deserialize(data['state'])
+    ai_state.capture_time = data.get('capture_time')
+    return data['index'], ai_state
+
+
+def phone_image_state_to_json(payload):
+    ''' shim for old json readers: any phone image state message -> the old {index, state} json '''
+    if not is_binary_ai_state(payload):
+        return payload.decode('utf-8') if isinstance(payload, (bytes, bytearray)) else payload
+    index, ai_state = decode_ai_state(payload)
+    return json.dumps({'index': index, 'capture_time': ai_state.capture_time, 'state': ai_state.serialize()})
@@ -0,0 +1,131 @@
+'''
+Runs the CPU-bound AIState components (circles, contours, colors) in worker
+processes instead of threads so they don't fight over the GIL.
+
+Each frame is written once into a SharedFrameRing. Workers get a zero-copy view
+of the frame from the ring and only send the small result dicts back, with how
+long they took.
+
+OCR stays in the main process: its result cache and learned digit templates only
+warm up if every frame goes through the same ImageOCRProcessor.
+'''
+
+import atexit
+import multiprocessing
+import time
+from concurrent import futures
+from config import HOUGH_CIRCLES_CONFIG, IMAGE_FRAME_RING_SLOTS
+from image_circles import get_image_circles
+from image_contours import get_kim_action_color_shapes
+from image_color import get_image_color_features
+from kim_logs import get_kim_logger
+from shared_frame_ring import SharedFrameRing, is_shared_memory_available, share_resource_tracker
+
+
+# state held by each worker process
+_worker_data = {'ring': None}
+
+
+def _get_worker_frame(ring_info, slot):
+    ring = _worker_data['ring']
+    if ring is None or ring.name != ring_info['name']:
+        # frame size changed or first frame: (re)attach to the ring
+        if ring is not None:
+            ring.close()
+        ring = _worker_data['ring'] = SharedFrameRing.attach(ring_info)
+    return ring.get_slot_view(slot)
+
+
+def _get_circles_state(np_img):
+    return {'tap_circles': get_image_circles(np_img, HOUGH_CIRCLES_CONFIG)}
+
+
+def _get_shapes_state(np_img):
+    shapes = get_kim_action_color_shapes(np_img)
+    # contours are big and unused by AIState, so don't send them back
+    for shape in shapes:
+        shape.pop('contour', None)
+    return {'shapes': shapes}
+
+
+def _get_color_state(np_img):
+    return {'color_features': get_image_color_features(np_img[:, :, :3])}
+
+
+PROCESS_COMPONENTS = {
+    'circles_state': _get_circles_state,
+    'shapes_state': _get_shapes_state,
+    'color_state': _get_color_state,
+}
+
+
+def _run_component(name, ring_info, slot):
+    ''' (result, seconds the component took in the worker) '''
+    start = time.perf_counter()
+    np_img = _get_worker_frame(ring_info, slot)
+    return PROCESS_COMPONENTS[name](np_img), time.perf_counter() - start
+
+
+def _noop():
+    return None
+
+
+class VisionProcessPool(object):
+    '''
+    Pool of worker processes for the AIState components in PROCESS_COMPONENTS.
+    Should be created before tensorflow / darkflow sessions exist, since workers
+    are forked from the current process. Time spent in the workers is recorded
+    in metrics as '<component>_worker'.
+    '''
+
+    def __init__(self, num_workers, num_slots=IMAGE_FRAME_RING_SLOTS, metrics=None):
+        self.logger = get_kim_logger('VisionProcessPool')
+        self.num_slots = num_slots
+        self.metrics = metrics
+        self.ring = None
+
+        # otherwise each worker starts its own tracker, which unlinks rings when the worker exits
+        share_resource_tracker()
+        self.executor = futures.ProcessPoolExecutor(
+            max_workers=num_workers,
+            mp_context=multiprocessing.get_context('fork'))
+
+        # start the workers now, while the process is still small
+        self.executor.submit(_noop).result()
+        atexit.register(self.close)
+
+    @classmethod
+    def is_available(cls):
+        return is_shared_memory_available()
+
+    def _write_frame(self, np_img):
+        if self.ring is None or self.ring.shape != np_img.shape:
+            if self.ring is not None:
+                self.ring.close()
+            self.ring = SharedFrameRing(np_img.shape, self.num_slots, dtype=np_img.dtype)
+            self.logger.debug('Created frame ring %s for shape %s', self.ring.name, np_img.shape)
+        return self.ring.write(np_img)
+
+    def get_process_components(self, np_img):
+        '''
+        Writes frame into shared memory and returns a dict of name -> fn for the
+        components run by workers. Each fn blocks until its worker is done.
+        '''
+        slot = self._write_frame(np_img)
+        ring_info = self.ring.get_info()
+
+        def get_runner(name):
+            def run():
+                result, seconds = self.executor.submit(_run_component, name, ring_info, slot).result()
+                if self.metrics is not None:
+                    self.metrics.record('%s_worker' % name, seconds)
+                return result
+            return run
+
+        return {name: get_runner(name) for name in PROCESS_COMPONENTS}
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
@@ -1,13 +1,16 @@
 import asynchat
-from random import randint
+import itertools
+import threading
 from kim_logs import get_kim_logger
 from config import DEVICE_HOST, DEVICE_PORT
+from device_protocol import encode_frame, decode_frame, LENGTH, FRAME_COMMAND, FRAME_RESPONSE, STATUS_OK
 
 COMMAND_SEP = '|'
 
 
 class KimCommand(object):
     ACK = 'ACK'
+    HELLO = 'HELLO'
     GET_PROCESS = 'GET_PROCESS'
     SCREENSHOT = 'SCREENSHOT'
     RESET = 'RESET'
@@ -16,12 +19,22 @@ class KimCommand(object):
     DOUBLE_TAP = 'DOUBLE_TAP'
     BACK_BUTTON = 'BACK_BUTTON'
     LAUNCH_HOLLYWOOD = 'LAUNCH_HOLLYWOOD'
+    MACRO = 'MACRO'
+    STATS = 'STATS'
 
 
 class AsyncchatKim(asynchat.async_chat):
     '''
     Wrapper around the native very-raw api that attempts to make communcation
     between device_client and device_server easier
+
+    Connections start out on protocol 1 (newline terminated, | separated text).
+    A client can send HELLO with the highest version it speaks. The server acks it
+    (still in protocol 1) with the version both will use from then on, so either side
+    can be upgraded first. The server reads everything after the HELLO in the new
+    version, so the client can't send anything else until the ack arrives.
+    Protocol 2 is length prefixed binary frames with typed fields and status codes,
+    see device_protocol.py.
     '''
 
     def __init__(self, host=DEVICE_HOST, port=DEVICE_PORT,
@@ -31,23 +44,51 @@ class AsyncchatKim(asynchat.async_chat):
         self.host = host
         self.port = port
         self.logger = get_kim_logger(logger_name)
-        self.command_ack_map = {}
-        self.command_res_queue = []
+        self.command_ids = itertools.count(1)
+        self.send_lock = threading.RLock()
         self.comm = None
         self.py2 = py2
         self.use_encoding = True
-        self.set_terminator('\n'.encode())
         self.buffer = []
+        self._set_protocol_version(1)
+
+    def _set_protocol_version(self, version):
+        ''' switches how incoming data is read, from the next byte on '''
+        self.protocol_version = version
+        self.reading_frame_length = True
+        self.set_terminator(LENGTH.size if version >= 2 else '\n'.encode())
 
     def collect_incoming_data(self, data):
-        self.buffer.append(data if self.py2 else data.decode())
+        self.buffer.append(data if self.py2 or self.protocol_version >= 2 else data.decode())
 
     def found_terminator(self):
+        if self.protocol_version >= 2:
+            data = b''.join(self.buffer)
+            self.buffer = []
+            self._handle_frame_data(data)
+            return
+
         msg = ''.join(self.buffer)
         self.logger.debug('received message: %s', msg)
         self.buffer = []
         self._handle_message(msg)
 
+    def _handle_frame_data(self, data):
+        if self.reading_frame_length:
+            self.reading_frame_length = False
+            self.set_terminator(LENGTH.unpack(data)[0])
+            return
+
+        self.reading_frame_length = True
+        self.set_terminator(LENGTH.size)
+        frame_type, status, command_id, name, fields = decode_frame(data)
+        if frame_type == FRAME_RESPONSE:
+            self._handle_ack(command_id, fields, status)
+        elif frame_type == FRAME_COMMAND:
+            self._handle_command(command_id, name, fields)
+        else:
+            self.logger.error('Received unknown frame type %d', frame_type)
+
     def _handle_message(self, msg):
         parts = msg.split(COMMAND_SEP)
         command_id, command, data = parts[0], parts[1], parts[2:]
@@ -56,47 +97,59 @@ class AsyncchatKim(asynchat.async_chat):
         else:
             self._handle_command(command_id, command, data)
 
-    def _handle_ack(self, command_id, data):
-        # self.logger.debug('Received ACK for %s', command_id)
-        self.command_ack_map[command_id] = True
-        self.command_res_queue.append((command_id, data))
-
-        # remove old ack / response data to save on memory
-        if len(self.command_res_queue) > 10:
-            old_id, _ = self.command_res_queue.pop(0)
-            if old_id in self.command_ack_map:
-                del self.command_ack_map[old_id]
+    def _handle_ack(self, command_id, data, status=STATUS_OK):
+        ''' senders that wait for responses (DeviceClient) handle acks '''
+        self.logger.debug('Received ACK for %s', command_id)
 
     def _handle_command(self, command_id, command, data):
         self.logger.debug('need to handle %s' % command)
 
-    def _has_received_cmd_ack(self, command_id):
-        return command_id in self.command_ack_map
-
     def _send_message(self, msg):
         self.logger.debug('Sending message: %s', msg.rstrip())
-        self.push(msg.encode())
+        self._send_data(msg.encode())
+
+    def _send_data(self, data):
+        # commands can be sent from several threads at once
+        with self.send_lock:
+            self.push(data)
+
+    def initiate_send(self):
+        # also runs on the asyncore thread (handle_write), next to pushes from other threads
+        with self.send_lock:
+            asynchat.async_chat.initiate_send(self)
+
+    def _next_command_id(self):
+        ''' ids are unique per connection, and only go up '''
+        return str(next(self.command_ids))
+
+    def _send_command_with_id(self, command_id, *args):
+        if self.protocol_version >= 2:
+            self._send_data(encode_frame(FRAME_COMMAND, command_id, args[0], args[1:]))
+            return
 
-    def _send_command(self, *args):
-        # grab current command id and send message
-        command_id = str(randint(1, 99999999))
         msg = COMMAND_SEP.join([command_id] + [str(a) for a in args]) + '\n'
         self._send_message(msg)
+
+    def _send_command(self, *args):
+        command_id = self._next_command_id()
+        self._send_command_with_id(command_id, *args)
         return command_id
 
-    def send_ack(self, command_id, res_data):
-        ''' Sends ACK of completed command with given id and optional data '''
+    def send_ack(self, command_id, res_data, status=STATUS_OK, command=None):
+        '''
+        Sends ACK of completed command with given id and optional data. Protocol 1
+        can't carry the status, errors are just acks without data there.
+        '''
+        if self.protocol_version >= 2:
+            fields = [] if res_data is None else list(res_data) if isinstance(res_data, (list, tuple)) else [res_data]
+            self._send_data(encode_frame(FRAME_RESPONSE, command_id, command, fields, status))
+            return
+
         parts = [command_id, KimCommand.ACK]
-        if res_data is not None:
+        if isinstance(res_data, (list, tuple)):
+            parts += ['' if d is None else str(d) for d in res_data]
+        elif res_data is not None:
             parts.append(res_data)
 
         msg = COMMAND_SEP.join(parts) + '\n'
         self._send_message(msg)
-
-    def get_command_res_data(self, command_id):
-        """ finds res_data from given command if it still exists in deque """
-        for id, data in self.command_res_queue:
-            if id == command_id:
-                return data
-
-        return None
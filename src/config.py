@@ -15,9 +15,22 @@ REDIS_PORT = 6379
 # in jython :(
 DEVICE_HOST = '127.0.0.1'
 DEVICE_PORT = 5005
+DEVICE_COMMAND_TIMEOUT = 15  # seconds a DeviceClient waits for a command's ACK
+DEVICE_PROTOCOL_VERSION = 2  # highest device protocol to negotiate (1: text, 2: binary frames)
+DEVICE_HELLO_TIMEOUT = 5  # seconds a DeviceClient holds commands waiting for the HELLO ack before staying on protocol 1
+DEVICE_QUERY_WORKERS = 2  # device server threads answering queries (GET_PROCESS) while gestures run
 
 FRONTEND_WEB_URL = 'http://localhost:8888'
 FRONTEND_NAME = 'KIM_FRONTEND'  # 'hollywood - Google Chrome'
+
+# The frontend server pushes frames / state to its websocket clients at most this often.
+# Each client queues up to FRONTEND_CLIENT_QUEUE_SIZE log lines / actions, dropping the
+# oldest when it can't keep up.
+FRONTEND_PUSH_FPS = 12
+FRONTEND_CLIENT_QUEUE_SIZE = 200
+# After the first full snapshot, clients only get state diffs against the last version they
+# acknowledged. A client more than STATE_SYNC_HISTORY versions behind gets a new snapshot.
+STATE_SYNC_HISTORY = 32
 DASHBOARD_NAME = 'AI_DASHBOARD'
 
 # Name of the phone in vysor (change in vysor settings)
@@ -298,6 +311,81 @@ SAFEGUARD_MENU_RECTS = OPTIONS['SAFEGUARD_MENU_RECTS']
 CENTER_Y_OFFSET = OPTIONS['CENTER_Y_OFFSET']
 CHROME_ERROR_X_OFFSET = OPTIONS['CHROME_ERROR_X_OFFSET']
 
+"""
+IMAGE STREAM
+"""
+
+# Worker threads kept alive by AIStateProcessor (one per state component is plenty)
+IMAGE_PROCESS_THREADS = 8
+
+# 'threaded' runs every state component in AIStateProcessor threads.
+# 'process' runs circles / contours / colors in worker processes that read frames
+# from shared memory (needs python >= 3.8), which scales with cpu cores. OCR stays in
+# the main process, so its cache and digit templates are shared by every frame.
+IMAGE_PROCESS_MODE = 'threaded'
+IMAGE_PROCESS_WORKERS = 4
+IMAGE_FRAME_RING_SLOTS = 3
+
+# Captured frames are written once into a named shared memory ring that local processes
+# (frontend, recorders) read from directly (see shared_frame_ring.py). Setting
+# FRAME_RING_REDIS_FALLBACK also SETs the raw RGB frame in redis phone-image-data for remote readers.
+FRAME_RING_NAME = 'kim_phone_frames'
+FRAME_RING_SLOTS = 4
+FRAME_RING_REDIS_FALLBACK = False
+
+# 'binary' publishes AIStates in the compact ai_state_wire.py format, 'json' in the old json-in-json messages.
+# Readers decode either with ai_state_wire.decode_phone_image_state.
+AI_STATE_WIRE_FORMAT = 'binary'
+
+# YOLO backend for image_objects (see object_detectors.py): 'darkflow', 'opencv' or 'onnx'.
+# 'opencv' and 'onnx' use TFNET_CONFIG's cfg / threshold and run well without a gpu.
+OBJECT_DETECTOR_BACKEND = 'darkflow'
+OBJECT_DETECTOR_THREADS = 4
+OBJECT_DETECTOR_NMS_THRESHOLD = 0.4
+OBJECT_DETECTOR_ONNX_MODEL = 'dfbin/tiny-yolo.onnx'
+
+# Run the object detector every OBJECT_DETECT_EVERY frames (or when more than OBJECT_DETECT_SCENE_CHANGE
+# of the frame changed), and follow detected objects by template matching in between (see object_tracker.py)
+# Off by default: tracked objects carry a decayed confidence, which shifts the object info the DQN was trained on
+OBJECT_TRACKING = False
+OBJECT_DETECT_EVERY = 3
+OBJECT_DETECT_SCENE_CHANGE = 0.3
+OBJECT_TRACK_MAX_AGE = 5  # frames an object can go without being detected again
+OBJECT_TRACK_CONFIDENCE_DECAY = 0.85  # tracked confidence is multiplied by this every frame
+OBJECT_TRACK_MIN_MATCH = 0.6  # template match score needed to keep following an object
+OBJECT_TRACK_SCALE = 0.5  # frames are downscaled by this for matching
+OBJECT_TRACK_SEARCH_PAD = 0.5  # how far (as a fraction of object size) to look for it
+
+# Skip the vision pipeline on frames that look the same as the last processed
+# one and re-publish the previous state instead. Frames are compared at
+# FRAME_CHANGE_WIDTH (plus the HUD at full size). A frame has changed when at
+# least FRAME_CHANGE_MIN_PIXELS pixels differ by more than the threshold.
+FRAME_CHANGE_GATING = True
+FRAME_CHANGE_WIDTH = 160
+FRAME_CHANGE_PIXEL_THRESHOLD = 16
+FRAME_CHANGE_MIN_PIXELS = 3
+FRAME_CHANGE_MAX_SKIP_SECONDS = 2.0  # fully process at least this often anyway
+
+# Per-stage timings are kept for the last PERF_METRICS_WINDOW frames, and
+# p50 / p95 / p99 summaries get published on system-info-updates this often.
+PERF_METRICS_WINDOW = 300
+PERF_METRICS_PUBLISH_INTERVAL = 5  # in seconds
+
+# AIInfoPublisher (ai actions / status / log lines) queues messages and publishes them from
+# a background thread in redis pipelines of up to AI_INFO_PUBLISH_BATCH_SIZE, at least every
+# AI_INFO_PUBLISH_INTERVAL seconds. At most AI_INFO_PUBLISH_BUFFER_SIZE messages wait, oldest dropped first.
+AI_INFO_PUBLISH_BATCH_SIZE = 100
+AI_INFO_PUBLISH_INTERVAL = 0.05  # in seconds
+AI_INFO_PUBLISH_BUFFER_SIZE = 5000
+
+# Run capture / processing / serialization / publishing of the phone image
+# stream as overlapping stages instead of one after the other.
+IMAGE_STREAM_PIPELINED = True
+
+# Max frames waiting between pipeline stages. When full the oldest frame is
+# dropped, so keep this small to make sure the newest frame is processed.
+IMAGE_STREAM_QUEUE_SIZE = 1
+
 """
 REWARD CALCULATION
 """
@@ -365,12 +453,32 @@ BEHAVIOR
 ACTION_SHAPE_COLOR_RANGES = OPTIONS['ACTION_SHAPE_COLOR_RANGES']
 
 SHOW_FRONTEND = True
-DELAY_BETWEEN_ACTIONS = 2.5  # in seconds
+DELAY_BETWEEN_ACTIONS = 1.0  # in seconds (was 2.5 before envs waited for a state captured after the action)
 SWIPE_DURATION = 1.0
-DELAY_AFTER_SWIPE = 0.5
+DELAY_AFTER_SWIPE = 0.2
 DELAY_BETWEEN_DOUBLE_TAPS = 0.8
 ALLOW_RESET_ACTION = True
 
+# After an action, envs observe the first state whose frame was captured at least
+# FRESH_STATE_DELAY seconds after the action finished, waiting up to FRESH_STATE_TIMEOUT for it.
+# That's what keeps (obs, action, reward) consistent, so the delays above only need to
+# cover the game's animations.
+FRESH_STATE_DELAY = 0.1
+FRESH_STATE_TIMEOUT = 3.0
+
+# 'adaptive': the device only waits ACTION_SETTLE_MIN_DELAY after taps / swipes, and envs
+# wait for the screen to settle instead: ACTION_SETTLE_WINDOW seconds (of frame capture time)
+# of frames whose room_hash differ by at most ACTION_SETTLE_MAX_DISTANCE bits from the previous
+# one, or ACTION_SETTLE_TIMEOUT.
+# Settle times per action type get logged every ACTION_SETTLE_LOG_INTERVAL actions.
+# 'fixed': the delays above. Still the default, until adaptive settle times have been validated.
+ACTION_SETTLE_MODE = 'fixed'
+ACTION_SETTLE_MIN_DELAY = 0.05
+ACTION_SETTLE_WINDOW = 0.4
+ACTION_SETTLE_MAX_DISTANCE = 1  # room_hash bits (320 with ROOM_HASH_SIZES (8, 16))
+ACTION_SETTLE_TIMEOUT = 2.5
+ACTION_SETTLE_LOG_INTERVAL = 50
+
 # SHOW_FRONTEND = False
 # DELAY_BETWEEN_ACTIONS = 0.2  # in seconds
 # SWIPE_DURATION = 0.15
@@ -391,11 +499,35 @@ MIN_BACK_BUTTON_ATTEMPTS = 2
 
 SECONDS_BETWEEN_BACK_BUTTONS = 0.8
 
+OCR_CACHE_SIZE = 256  # HUD crops whose OCR values are remembered (keyed on exact pixels)
+OCR_TESSERACT_POOL_SIZE = 2  # initialized tesseract handles per ImageOCRProcessor (one per HUD reader thread)
+OCR_CHAR_WHITELIST = '0123456789,'  # HUD values are digits with comma separators
+
+# Read HUD digits by matching glyphs to templates learned from tesseract, falling back to tesseract (see image_digits.py)
+HUD_DIGIT_TEMPLATES = True
+HUD_DIGIT_GLYPH_SIZE = (10, 14)  # (w, h) glyphs are resized to before matching
+HUD_DIGIT_MIN_SCORE = 0.9  # 1 - mean abs pixel difference needed for every glyph
+HUD_DIGIT_MIN_MARGIN = 0.04  # how much better the best digit must match than the second best
+HUD_DIGIT_MIN_SAMPLES = 3  # agreeing tesseract reads needed before a digit's template is used
+
 CONTOUR_PROCESS_HEIGHT = 400  # height of images processed in image_contours
+# 'single_pass' segments every ACTION_SHAPE_COLOR_RANGES entry with one lookup table pass,
+# 'legacy' runs inRange / threshold / findContours separately for each range.
+CONTOUR_SEGMENTATION = 'single_pass'
 
 COLOR_SIG_K = 3
 COLOR_SIG_PCT_FACTOR = 0.05
 COLOR_SIG_SQUASH_FACTOR = 0.03
+# 'histogram' finds dominant colors from a quantized color histogram (fast, same sig for same screen),
+# 'kmeans' fits a new KMeans every frame (slow, sig can change between runs on the same screen)
+COLOR_SIG_METHOD = 'histogram'
+COLOR_SIG_HIST_BINS = 8  # histogram cells per color channel
+
+# Rooms are recognized by nearest multiscale image hash (see image_hash_index.py)
+ROOM_HASH_SIZES = (8, 16)  # difference hash sizes, ie 64 + 256 bits
+ROOM_HASH_MAX_DISTANCE = 20  # max hamming distance between hashes of the same room
+ROOM_HASH_MIN_NEW_DISTANCE = 4  # screens closer than this to a known one aren't stored again
+ROOM_INDEX_MAX_ENTRIES = 50000  # oldest screens are forgotten after this many
 
 # Areas of the device that are not clickable if set to True (useful in training).
 SAFEGUARD_MENU_CLICKS_DEFAULT = True
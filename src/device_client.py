@@ -1,13 +1,17 @@
 """ Connects to a DeviceServer over network to control a DeviceManager, somewhere """
 
 import asyncore
+import json
 import time
 import socket
 import threading
+from concurrent import futures
 from asyncchat_kim import AsyncchatKim, KimCommand
+from device_protocol import DeviceCommandError, STATUS_OK, encode_macro_steps
 from config import CURRENT_PHONE_GAME_RECT, VYSOR_CAP_AREA
 from config import SAFEGUARD_MENU_RECTS, SAFEGUARD_MENU_CLICKS_DEFAULT
-from config import DELAY_BETWEEN_ACTIONS
+from config import DELAY_BETWEEN_ACTIONS, DELAY_AFTER_SWIPE, ACTION_SETTLE_MODE, ACTION_SETTLE_MIN_DELAY
+from config import DEVICE_COMMAND_TIMEOUT, DEVICE_PROTOCOL_VERSION, DEVICE_HELLO_TIMEOUT
 from util import is_in_rect, convert_point_between_rects
 from window_setup import setup_vysor_window
 from enums import Action
@@ -21,6 +25,15 @@ class DeviceClient(AsyncchatKim):
     Also performs the *extremely desirable* task of translating points from
     image read on screen to point on device (we use a smaller image for reading)
     for performance reasons.
+
+    Every command gets a Future that the asyncore thread resolves with the
+    command's response when its ACK arrives, so any number of commands can be
+    in flight at once (from any thread), and waiting on one doesn't use cpu.
+
+    Commands are held until the connection is ready: connected, and done
+    negotiating the protocol (the server reads everything after its HELLO ack in
+    the new version, so nothing can go out while a HELLO is outstanding). Reconnects
+    happen on their own thread, so the asyncore thread keeps reading meanwhile.
     '''
 
     def __init__(self,
@@ -41,11 +54,19 @@ class DeviceClient(AsyncchatKim):
         self.restart_delay = restart_delay
         self.ai_info_publisher = get_ai_info_publisher()
         self.is_closed = False
+        self.is_stopped = False
+        self.pending_commands = {}  # command id -> Future
+        self.pending_lock = threading.Lock()
+        self.hello_command_id = None
+        self.timed_out_hello_id = None
+        self.ready = threading.Event()  # set while commands can be sent
 
     def start(self, max_attempts=5):
         """ Connects the client to a server """
         self.logger.debug('Connecting to %s:%d', self.host, self.port)
 
+        # every new connection starts on protocol 1
+        self._set_protocol_version(1)
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.connect((self.host, self.port))
 
@@ -67,44 +88,192 @@ class DeviceClient(AsyncchatKim):
 
         self.is_closed = False
         if not self.comm:
-            self.comm = threading.Thread(target=asyncore.loop)
+            self.comm = threading.Thread(target=self._run_comm_loop)
             self.comm.daemon = True
             self.comm.start()
 
+        self._negotiate_protocol()
+
+    def _run_comm_loop(self):
+        ''' asyncore.loop returns once the socket map is empty, this one keeps going across reconnects until stop() '''
+        while not self.is_stopped:
+            asyncore.loop(timeout=1, count=1)
+            if not asyncore.socket_map:
+                time.sleep(0.1)
+        # closed on this thread, closing the socket under a running select() fails it with EBADF
+        self.close()
+
+    def _negotiate_protocol(self):
+        '''
+        HELLO with the highest protocol we speak, servers that don't know HELLO keep us on 1.
+        Doesn't wait for the ack (start() can run on the asyncore thread, which reads it),
+        commands are held by send_command_async until it or its timeout arrives.
+        '''
+        if DEVICE_PROTOCOL_VERSION < 2:
+            self.ready.set()
+            return
+
+        command_id = self._next_command_id()
+        with self.pending_lock:
+            self.hello_command_id = command_id
+        self._send_command_with_id(command_id, KimCommand.HELLO, DEVICE_PROTOCOL_VERSION)
+
+        timer = threading.Timer(DEVICE_HELLO_TIMEOUT, self._handle_hello_timeout, [command_id])
+        timer.daemon = True
+        timer.start()
+
+    def _handle_hello_timeout(self, command_id):
+        with self.pending_lock:
+            if self.hello_command_id != command_id:
+                return
+            self.hello_command_id = None
+            self.timed_out_hello_id = command_id
+            self.ready.set()
+        self.logger.warning('No HELLO response, staying on protocol 1')
+
+    def _handle_hello_ack(self, command_id, data):
+        ''' True if the connection has to be reset (a late ack switched the server's protocol) '''
+        version = int(data[0]) if data else 1
+        with self.pending_lock:
+            if command_id == self.hello_command_id:
+                # the server sends everything after this ack in the agreed version, so switch right away
+                self.hello_command_id = None
+                if version >= 2:
+                    self._set_protocol_version(version)
+                self.ready.set()
+                self.logger.debug('Using device protocol %d', self.protocol_version)
+                return False
+
+            self.timed_out_hello_id = None
+        # we've been sending protocol 1 since the timeout, the server reads them as protocol `version`
+        if version >= 2:
+            self.logger.warning('Late HELLO response (protocol %d), reconnecting', version)
+            return True
+        return False
+
     def handle_close(self):
         if not self.is_closed:
             self.logger.debug('Disconnected from %s:%d', self.host, self.port)
             self.logger.debug('Will Attempt Connect in %d seconds', self.restart_delay)
             self.close()
             self.is_closed = True
-            time.sleep(self.restart_delay)
+            self._fail_pending_commands()
+
+            # the asyncore thread has to keep running while we wait (and negotiate)
+            reconnect = threading.Thread(target=self._reconnect)
+            reconnect.daemon = True
+            reconnect.start()
+
+    def _reconnect(self):
+        time.sleep(self.restart_delay)
+        if self.is_stopped:
+            return
+        try:
             self.start()
-        pass
-
-    def _wait_for_ack(self, command_id, timeout=15):
-        now = time.time()
-        while not self._has_received_cmd_ack(command_id):
-            time.sleep(0.001)
-            elapsed = time.time() - now
-            if self.connected and elapsed >= timeout:
-                self.logger.debug(
-                    'Timeout receving ACK for command %s' %
-                    command_id)
-                break
-            elif elapsed >= self.superlong_timeout_seconds:
+        except ConnectionRefusedError as e:
+            self.logger.error('Reconnect failed: %s', e)
+
+    def stop(self):
+        ''' closes the connection for good (no reconnects) '''
+        self.is_stopped = True
+        self.is_closed = True
+        if self.comm and self.comm is not threading.current_thread():
+            self.comm.join()
+        else:
+            self.close()
+        self._fail_pending_commands()
+
+    def _fail_pending_commands(self):
+        ''' their ids won't be acked on a new connection, so nobody should wait for them '''
+        with self.pending_lock:
+            self.ready.clear()
+            self.hello_command_id = None
+            self.timed_out_hello_id = None
+            pending, self.pending_commands = self.pending_commands, {}
+        for future in pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Disconnected from device server'))
+
+    def _handle_ack(self, command_id, data, status=STATUS_OK):
+        # runs on the asyncore thread
+        if command_id in (self.hello_command_id, self.timed_out_hello_id):
+            if self._handle_hello_ack(command_id, data):
+                self.handle_close()
+            return
+
+        with self.pending_lock:
+            future = self.pending_commands.pop(command_id, None)
+        if future is None:
+            self.logger.debug('Received ACK for command %s nobody is waiting for', command_id)
+        elif future.done():
+            pass
+        elif status != STATUS_OK:
+            future.set_exception(DeviceCommandError(status, data[0] if data else None))
+        else:
+            future.set_result(data)
+
+    def send_command_async(self, *args):
+        '''
+        Sends a command without waiting for its response, returns a Future of the response data.
+        While disconnected / negotiating it waits for the connection to be ready (the server may
+        come back), up to superlong_timeout_seconds.
+        '''
+        future = futures.Future()
+        future.command_id = None
+        deadline = time.time() + self.superlong_timeout_seconds
+        while True:
+            if not self.ready.wait(timeout=max(0, deadline - time.time())):
+                self.logger.warning('Device server not ready after %d seconds', self.superlong_timeout_seconds)
                 if self.on_superlong_timeout:
                     self.on_superlong_timeout()
-                break
+                future.set_exception(ConnectionError('Device server not ready'))
+                return future
+
+            # registered and sent under the lock, so a disconnect either fails it or happens before it
+            with self.pending_lock:
+                if not self.ready.is_set():
+                    continue
+                future.command_id = self._next_command_id()
+                self.pending_commands[future.command_id] = future
+                self._send_command_with_id(future.command_id, *args)
+            return future
 
-        data = self.get_command_res_data(command_id)
-        return data
+    def _wait_for_ack(self, future, timeout=DEVICE_COMMAND_TIMEOUT):
+        ''' Response data of the command, or None if it failed or wasn't acked within timeout '''
+        try:
+            return future.result(timeout=timeout)
+        except futures.TimeoutError:
+            self.logger.debug('Timeout receving ACK for command %s', future.command_id)
+        except (DeviceCommandError, ConnectionError) as e:
+            self.logger.warning('Command %s failed: %s', future.command_id, e)
+            return None
 
-    def _send_command(self, *args):
-        command_id = AsyncchatKim._send_command(self, *args)
+        with self.pending_lock:
+            self.pending_commands.pop(future.command_id, None)
+        future.cancel()
+        return None
 
+    def _send_command(self, *args, timeout=DEVICE_COMMAND_TIMEOUT):
         # Wait for ack for "consistency!!"
-        res_data = self._wait_for_ack(command_id)
-        return res_data
+        return self._wait_for_ack(self.send_command_async(*args), timeout)
+
+    def send_macro_command(self, steps, steps_duration=0):
+        '''
+        Runs [(command, args, delay after), ...] on the device in one round trip, returns
+        [(status, result)] per step (steps after a failed one are STATUS_SKIPPED), or None
+        if the macro wasn't acked. steps_duration is how long the steps themselves take
+        (on top of the delays), to wait long enough for the ack.
+        '''
+        timeout = DEVICE_COMMAND_TIMEOUT + steps_duration + sum(delay for _, _, delay in steps)
+        data = self._send_command(KimCommand.MACRO, *encode_macro_steps(steps), timeout=timeout)
+        if data is None:
+            return None
+        return [(int(data[i]), data[i + 1]) for i in range(0, len(data), 2)]
+
+    def get_server_stats(self):
+        ''' queue depth / wait time metrics of the device server's command lanes '''
+        data = self._send_command(KimCommand.STATS)
+        return json.loads(data[0]) if data else None
 
     def send_screenshot_command(self, filename):
         """ Sends a command to save screenshot to given filename """
@@ -167,8 +336,26 @@ class DeviceClient(AsyncchatKim):
         else:
             time.sleep(DELAY_BETWEEN_ACTIONS)
 
+    def send_drag_x_sequence(self, distances, duration=1, delay=None):
+        '''
+        swipes each distance (negative for left) as one macro, DELAY_AFTER_SWIPE apart so scrolls
+        don't run into each other. In fixed settle mode the device's drag already sleeps that
+        long after each swipe, so the steps only add it in adaptive mode.
+        '''
+        adaptive = ACTION_SETTLE_MODE == 'adaptive'
+        if delay is None:
+            delay = DELAY_AFTER_SWIPE if adaptive else 0
+        # what device_manager.drag sleeps for each swipe
+        drag_time = duration + (ACTION_SETTLE_MIN_DELAY if adaptive else DELAY_AFTER_SWIPE)
+        steps = [(KimCommand.DRAG_X, (d, duration), delay) for d in distances]
+        return self.send_macro_command(steps, steps_duration=drag_time * len(distances))
+
     def send_back_button_command(self):
         self._send_command(KimCommand.BACK_BUTTON)
 
+    def send_back_button_commands(self, count, delay):
+        ''' presses back count times, delay seconds apart, as one macro '''
+        return self.send_macro_command([(KimCommand.BACK_BUTTON, (), delay)] * count)
+
     def send_launch_hollywood_command(self):
         self._send_command(KimCommand.LAUNCH_HOLLYWOOD)
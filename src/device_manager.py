@@ -1,24 +1,53 @@
 """ DeviceManager class to control an Android emulator or phone """
 
+import threading
 from time import sleep
 from random import randint, random
 from com.android.monkeyrunner import MonkeyRunner, MonkeyDevice
 from kim_logs import get_kim_logger
 from config import DELAY_BETWEEN_ACTIONS, SHELL_TAP_PROB, DELAY_AFTER_SWIPE, DELAY_BETWEEN_DOUBLE_TAPS
 from config import KK_HOLLYWOOD_PACKAGE, KK_HOLLYWOOD_COMPONENT, RESET_PACKAGES_TO_KILL
+from config import ACTION_SETTLE_MODE, ACTION_SETTLE_MIN_DELAY
 
 # Constants
 BROWSER_PACKAGE = 'com.android.chrome'
 BROWSER_COMPONENT = '%s/com.google.android.apps.chrome.Main' % BROWSER_PACKAGE
 
 
+def get_post_action_delay(fixed_delay):
+    ''' with adaptive settling the env waits for the screen to stop changing instead '''
+    return ACTION_SETTLE_MIN_DELAY if ACTION_SETTLE_MODE == 'adaptive' else fixed_delay
+
+
+class LockedDevice(object):
+    '''
+    MonkeyDevice proxy that makes one call into the device at a time, since
+    MonkeyDevice / ChimpChat isn't thread safe and the DeviceServer runs queries
+    next to gestures. Only the calls are serialized, not the sleeps between them.
+    '''
+
+    def __init__(self, device):
+        self._device = device
+        self._lock = threading.RLock()
+
+    def __getattr__(self, name):
+        attr = getattr(self._device, name)
+        if not callable(attr):
+            return attr
+
+        def locked_call(*args, **kwargs):
+            with self._lock:
+                return attr(*args, **kwargs)
+        return locked_call
+
+
 class DeviceManager(object):
     '''
     Wrapper around MonkeyDevice with some higher-level controls.
     '''
 
     def __init__(self, device):
-        self.device = device
+        self.device = LockedDevice(device)
         self.frame_count = 0
         self.logger = get_kim_logger('DeviceManager')
         self.device_width = int(self.device.getProperty('display.width'))
@@ -69,7 +98,7 @@ class DeviceManager(object):
             (start_pos, end_pos, duration, steps))
         self.device.drag(start_pos, end_pos, duration, steps)
         # always want to behave synchronously, so wait until action is complete
-        sleep(duration + DELAY_AFTER_SWIPE)
+        sleep(duration + get_post_action_delay(DELAY_AFTER_SWIPE))
 
     def drag_delta(self, start_pos=None, delta_x=0,
                    delta_y=0, duration=1, steps=100):
@@ -87,7 +116,7 @@ class DeviceManager(object):
         ''' Taps device at given location '''
         self.logger.debug('Tapping at (%d, %d)' % (x, y))
         self.touch(x, y)
-        sleep(DELAY_BETWEEN_ACTIONS)
+        sleep(get_post_action_delay(DELAY_BETWEEN_ACTIONS))
 
     def double_tap(self, x, y):
         ''' Double Taps device at given location '''
@@ -95,7 +124,7 @@ class DeviceManager(object):
         self.touch(x, y)
         sleep(DELAY_BETWEEN_DOUBLE_TAPS)
         self.touch(x, y)
-        sleep(DELAY_BETWEEN_ACTIONS)
+        sleep(get_post_action_delay(DELAY_BETWEEN_ACTIONS))
 
     def touch(self, x, y):
         ''' inputs tap at given location '''
@@ -0,0 +1,144 @@
+'''
+Framing of device protocol v2, used by AsyncchatKim once a HELLO negotiated it.
+Shared by the python 3 DeviceClient and the jython DeviceServer, so it has to stay py2 compatible.
+
+Every frame is a u32 length followed by that many bytes (all big endian):
+
+    frame type u8 (1: command, 2: response), status u8 (0 ok, 1 error, 2 unknown command),
+    command id u32, name (u8 length + ascii), field count u16, fields
+
+Each field is a type tag u8 followed by its value:
+
+    0 None, 1 int (i64), 2 float (f64), 3 text (u32 length + utf-8), 4 binary (u32 length + bytes)
+'''
+
+import struct
+from numbers import Integral
+
+PROTOCOL_VERSION = 2
+
+FRAME_COMMAND = 1
+FRAME_RESPONSE = 2
+
+STATUS_OK = 0
+STATUS_ERROR = 1
+STATUS_UNKNOWN_COMMAND = 2
+STATUS_SKIPPED = 3  # macro steps after a failed one
+
+FIELD_NONE = 0
+FIELD_INT = 1
+FIELD_FLOAT = 2
+FIELD_TEXT = 3
+FIELD_BINARY = 4
+
+LENGTH = struct.Struct('>I')
+FRAME_HEADER = struct.Struct('>BBIB')
+NUM_FIELDS = struct.Struct('>H')
+FIELD_TAG = struct.Struct('>B')
+INT_VALUE = struct.Struct('>q')
+FLOAT_VALUE = struct.Struct('>d')
+
+PY2 = str is bytes
+if PY2:
+    # py2 str is text here, binary payloads have to be bytearrays
+    BINARY_TYPES = (bytearray,)
+else:
+    BINARY_TYPES = (bytes, bytearray)
+
+
+def encode_macro_steps(steps):
+    '''
+    [(command, args, delay after), ...] -> flat MACRO command fields:
+    step count, then per step: command, delay, arg count, args...
+    '''
+    fields = [len(steps)]
+    for command, args, delay in steps:
+        fields += [command, float(delay), len(args)] + list(args)
+    return fields
+
+
+def decode_macro_steps(fields):
+    ''' MACRO command fields -> [(command, args, delay after), ...], fields are strings in protocol 1 '''
+    steps = []
+    offset = 1
+    for _ in range(int(fields[0])):
+        command, delay, num_args = fields[offset], float(fields[offset + 1]), int(fields[offset + 2])
+        offset += 3
+        steps.append((command, fields[offset:offset + num_args], delay))
+        offset += num_args
+    return steps
+
+
+class DeviceCommandError(Exception):
+    ''' a command's response came back with a non ok status '''
+
+    def __init__(self, status, message=None):
+        Exception.__init__(self, 'Device command failed (status %d): %s' % (status, message))
+        self.status = status
+
+
+def _encode_text(value):
+    if PY2 and isinstance(value, str):
+        return value
+    if not isinstance(value, type(u'')):
+        value = u'%s' % value
+    return value.encode('utf-8')
+
+
+def encode_field(value):
+    if value is None:
+        return FIELD_TAG.pack(FIELD_NONE)
+    if isinstance(value, (bool, Integral)):
+        return FIELD_TAG.pack(FIELD_INT) + INT_VALUE.pack(int(value))
+    if isinstance(value, float):
+        return FIELD_TAG.pack(FIELD_FLOAT) + FLOAT_VALUE.pack(value)
+    if isinstance(value, BINARY_TYPES):
+        return FIELD_TAG.pack(FIELD_BINARY) + LENGTH.pack(len(value)) + bytes(value)
+    data = _encode_text(value)
+    return FIELD_TAG.pack(FIELD_TEXT) + LENGTH.pack(len(data)) + data
+
+
+def encode_frame(frame_type, command_id, name, fields=(), status=STATUS_OK):
+    ''' length prefixed frame, ready to send '''
+    name = _encode_text(name or '')
+    parts = [FRAME_HEADER.pack(frame_type, status, int(command_id), len(name)), name, NUM_FIELDS.pack(len(fields))]
+    parts += [encode_field(f) for f in fields]
+    body = b''.join(parts)
+    return LENGTH.pack(len(body)) + body
+
+
+def _decode_field(body, offset):
+    (tag,) = FIELD_TAG.unpack_from(body, offset)
+    offset += FIELD_TAG.size
+    if tag == FIELD_NONE:
+        return None, offset
+    if tag == FIELD_INT:
+        return INT_VALUE.unpack_from(body, offset)[0], offset + INT_VALUE.size
+    if tag == FIELD_FLOAT:
+        return FLOAT_VALUE.unpack_from(body, offset)[0], offset + FLOAT_VALUE.size
+
+    (length,) = LENGTH.unpack_from(body, offset)
+    offset += LENGTH.size
+    data = body[offset:offset + length]
+    if tag == FIELD_TEXT:
+        return (data if PY2 else data.decode('utf-8')), offset + length
+    if tag == FIELD_BINARY:
+        return (bytearray(data) if PY2 else bytes(data)), offset + length
+    raise ValueError('Unknown device protocol field type %d' % tag)
+
+
+def decode_frame(body):
+    ''' frame body (without its length) -> (frame type, status, command id, name, fields) '''
+    frame_type, status, command_id, name_len = FRAME_HEADER.unpack_from(body, 0)
+    offset = FRAME_HEADER.size
+    name = body[offset:offset + name_len]
+    name = name if PY2 else name.decode('ascii')
+    offset += name_len
+
+    (num_fields,) = NUM_FIELDS.unpack_from(body, offset)
+    offset += NUM_FIELDS.size
+    fields = []
+    for _ in range(num_fields):
+        value, offset = _decode_field(body, offset)
+        fields.append(value)
+    return frame_type, status, str(command_id), name, fields
@@ -1,19 +1,137 @@
 """ DeviceServer class to communicate with DeviceManager by commands over network """
 
 import asyncore
+import json
 import socket
 import signal
 import sys
+import threading
+import time
 import traceback
+from Queue import Queue, Empty
 from java.lang import Runtime
 
 from kim_logs import get_kim_logger
 from config import DEVICE_HOST, DEVICE_PORT, KILL_ADB_ON_DEVICE_SERVER_EXIT
+from config import DEVICE_QUERY_WORKERS
 from device_manager import get_default_device_manager
 from asyncchat_kim import AsyncchatKim, KimCommand
+from device_protocol import PROTOCOL_VERSION, STATUS_OK, STATUS_ERROR, STATUS_UNKNOWN_COMMAND, STATUS_SKIPPED
+from device_protocol import decode_macro_steps
 from util import floatarr, intarr, kill_process
 from window import run_cmd
 
+# commands that only read device state, run next to (not after) gestures
+QUERY_COMMANDS = set([KimCommand.GET_PROCESS])
+
+
+class ResponseWakeup(asyncore.dispatcher):
+    '''
+    Wakes the asyncore loop up when lanes finished commands: wakeup() writes a byte
+    to a loopback connection whose other end is in the socket map, which then calls
+    on_wakeup on the asyncore thread (jython has no socketpair / pipes to select on).
+    '''
+
+    def __init__(self, on_wakeup):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        self.writer = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.writer.connect(listener.getsockname())
+        reader, _ = listener.accept()
+        listener.close()
+
+        asyncore.dispatcher.__init__(self, reader)
+        self.on_wakeup = on_wakeup
+        self.lock = threading.Lock()
+        self.pending = False
+
+    def wakeup(self):
+        # one byte until the loop has read it is enough
+        with self.lock:
+            if self.pending:
+                return
+            self.pending = True
+            self.writer.send(b'x')
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        with self.lock:
+            self.pending = False
+            self.recv(1024)
+        self.on_wakeup()
+
+
+class CommandLane(object):
+    '''
+    Queue of commands run by num_workers worker threads, with queue depth / wait
+    metrics. Finished commands go to on_done, which hands them to the asyncore thread
+    to send (asynchat isn't thread safe).
+    '''
+
+    def __init__(self, name, num_workers, on_done):
+        self.name = name
+        self.logger = get_kim_logger('DeviceServer.%s' % name)
+        self.queue = Queue()
+        self.on_done = on_done
+        self.lock = threading.Lock()
+        self.stats = {
+            'queued': 0,
+            'max_queued': 0,
+            'running': 0,
+            'completed': 0,
+            'total_wait_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'total_run_ms': 0.0,
+        }
+
+        for i in range(num_workers):
+            worker = threading.Thread(target=self._run_worker, name='%s-%d' % (name, i))
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, handler, command_id, command, data):
+        with self.lock:
+            self.stats['queued'] += 1
+            self.stats['max_queued'] = max(self.stats['max_queued'], self.stats['queued'])
+        self.queue.put((time.time(), handler, command_id, command, data))
+
+    def _run_worker(self):
+        while True:
+            queued_time, handler, command_id, command, data = self.queue.get()
+            start = time.time()
+            with self.lock:
+                self.stats['queued'] -= 1
+                self.stats['running'] += 1
+
+            try:
+                res_data, status = handler.run_command(command_id, command, data)
+            except Exception as e:
+                # a dead worker would stall the whole lane
+                self.logger.error('Error running %s (%s): %s\n%s', command, command_id, e, traceback.format_exc())
+                res_data, status = str(e), STATUS_ERROR
+            self.on_done(handler, command_id, command, res_data, status)
+
+            end = time.time()
+            wait_ms = (start - queued_time) * 1000
+            with self.lock:
+                self.stats['running'] -= 1
+                self.stats['completed'] += 1
+                self.stats['total_wait_ms'] += wait_ms
+                self.stats['max_wait_ms'] = max(self.stats['max_wait_ms'], wait_ms)
+                self.stats['total_run_ms'] += (end - start) * 1000
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+        completed = max(1, stats['completed'])
+        stats['mean_wait_ms'] = round(stats.pop('total_wait_ms') / completed, 2)
+        stats['mean_run_ms'] = round(stats.pop('total_run_ms') / completed, 2)
+        stats['max_wait_ms'] = round(stats['max_wait_ms'], 2)
+        return stats
+
 
 class DeviceMessageHandler(AsyncchatKim):
     '''
@@ -23,6 +141,7 @@ class DeviceMessageHandler(AsyncchatKim):
     def __init__(self,
                  device_manager,
                  sock,
+                 lanes,
                  gc_memory_kill_limit=15000000,
                  gc_command_interval=20):
         AsyncchatKim.__init__(
@@ -31,6 +150,7 @@ class DeviceMessageHandler(AsyncchatKim):
             py2=True,
             sock=sock)
         self.device_manager = device_manager
+        self.lanes = lanes
         self.gc_memory_kill_limit = gc_memory_kill_limit
         self.gc_command_interval = gc_command_interval
         self.cmd_count = 0
@@ -60,27 +180,100 @@ class DeviceMessageHandler(AsyncchatKim):
             self.logger.info("Killing device server due to low memory.")
             kill_process()
 
+    def _handle_hello(self, command_id, data):
+        ''' acks with the protocol version to use (in protocol 1), then switches to it '''
+        version = min(int(data[0]), PROTOCOL_VERSION) if data else 1
+        self.logger.debug('Client asked for protocol %s, using %d', data, version)
+        self.send_ack(command_id, str(version))
+        self._set_protocol_version(version)
+
     def _handle_command(self, command_id, command, data):
+        '''
+        Runs on the asyncore thread: HELLO / STATS are answered right away, queries go to
+        the query lane and everything else to the (serialized) action lane
+        '''
+        if command == KimCommand.HELLO:
+            self._handle_hello(command_id, data)
+            return
+        if command == KimCommand.STATS:
+            self.send_ack(command_id, json.dumps(self.get_lane_stats()), STATUS_OK, command)
+            return
+
         self.cmd_count += 1
         if self.cmd_count % self.gc_command_interval == 0:
             self._clean_memory()
 
-        if command in self.command_handlers:
+        lane = self.lanes['query'] if command in QUERY_COMMANDS else self.lanes['action']
+        lane.submit(self, command_id, command, data)
+
+    def get_lane_stats(self):
+        return dict((name, lane.get_stats()) for name, lane in self.lanes.items())
+
+    def send_response(self, command_id, command, res_data, status):
+        ''' sends a lane's result (on the asyncore thread) '''
+        # protocol 1 can't carry errors, so they stay acks without data there
+        if status != STATUS_OK and self.protocol_version < 2:
             res_data = None
+        self.send_ack(command_id, res_data, status, command)
+
+    def run_command(self, command_id, command, data):
+        ''' runs on a lane worker, returns (res_data, status) '''
+        res_data = None
+        status = STATUS_OK
+        if command == KimCommand.MACRO:
+            res_data, status = self._handle_macro(data)
+        elif command in self.command_handlers:
             try:
                 res_data = self.command_handlers[command](data)
             except TypeError, e:
                 self.logger.error(
                     'TypeError handling command (%s, %s, %s): %s' %
                     (command_id, command, data, e))
+                res_data, status = str(e), STATUS_ERROR
             except Exception, e:
                 self.logger.error(
                     'Unknown error handling command (%s, %s, %s): %s' %
                     (command_id, command, data, e))
+                res_data, status = str(e), STATUS_ERROR
         else:
             self.logger.error('Received unknown command: %s', command)
+            status = STATUS_UNKNOWN_COMMAND
+
+        return res_data, status
+
+    def _handle_macro(self, data):
+        '''
+        Runs the macro's steps one after the other, sleeping each step's delay after it.
+        Stops at the first failing step. Returns ([status, result] for every step, flattened),
+        and the macro's own status, which is ok even when a step failed (so the step
+        results make it back).
+        '''
+        steps = decode_macro_steps(data)
+        self.logger.debug('Handling macro command with %d steps', len(steps))
+
+        results = []
+        failed = False
+        for command, args, delay in steps:
+            if failed:
+                results += [STATUS_SKIPPED, None]
+                continue
+            if command not in self.command_handlers:
+                self.logger.error('Received unknown macro step: %s', command)
+                results += [STATUS_UNKNOWN_COMMAND, None]
+                failed = True
+                continue
+
+            try:
+                results += [STATUS_OK, self.command_handlers[command](args)]
+            except Exception, e:
+                self.logger.error('Error handling macro step (%s, %s): %s' % (command, args, e))
+                results += [STATUS_ERROR, str(e)]
+                failed = True
+                continue
+            if delay > 0:
+                time.sleep(delay)
 
-        self.send_ack(command_id, res_data)
+        return results, STATUS_OK
 
     def _handle_screenshot(self, data):
         filename = data[0]
@@ -136,7 +329,12 @@ class DeviceMessageHandler(AsyncchatKim):
 
 class DeviceServer(asyncore.dispatcher):
     '''
-    Manages the creation of DeviceMessageHandlers for every incoming Socket client
+    Manages the creation of DeviceMessageHandlers for every incoming Socket client.
+
+    Commands run on lanes shared by all clients: gestures (and anything else that
+    drives the device) one at a time on the action lane, reads like GET_PROCESS on
+    the query lane's workers, so queries get answered while a gesture sleeps. The
+    calls into the device itself are still one at a time (see LockedDevice).
     '''
 
     def __init__(self, device_manager, host=DEVICE_HOST, port=DEVICE_PORT):
@@ -147,6 +345,13 @@ class DeviceServer(asyncore.dispatcher):
         self.logger = get_kim_logger('DeviceServer')
         self.message_handlers = []
 
+        self.response_queue = Queue()
+        self.response_wakeup = ResponseWakeup(self._send_lane_responses)
+        self.lanes = {
+            'action': CommandLane('action', 1, self._queue_response),
+            'query': CommandLane('query', DEVICE_QUERY_WORKERS, self._queue_response),
+        }
+
         self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
         self.set_reuse_addr()
         self.bind((host, port))
@@ -158,12 +363,27 @@ class DeviceServer(asyncore.dispatcher):
         self.logger.debug('Starting Device Server at %s:%d ...', self.host, self.port)
         asyncore.loop()
 
+    def _queue_response(self, handler, command_id, command, res_data, status):
+        ''' called by lane workers '''
+        self.response_queue.put((handler, command_id, command, res_data, status))
+        self.response_wakeup.wakeup()
+
+    def _send_lane_responses(self):
+        ''' on the asyncore thread '''
+        while True:
+            try:
+                handler, command_id, command, res_data, status = self.response_queue.get_nowait()
+            except Empty:
+                return
+            if handler.connected:
+                handler.send_response(command_id, command, res_data, status)
+
     def handle_accept(self):
         '''Called when a client (like DeviceClient) connects to our socket'''
 
         self.logger.debug('Connected to a new client...')
         sock, _ = self.accept()
-        handler = DeviceMessageHandler(device_manager=self.device_manager, sock=sock)
+        handler = DeviceMessageHandler(device_manager=self.device_manager, sock=sock, lanes=self.lanes)
         self.message_handlers.append(handler)
 
     def handle_close(self):
@@ -172,6 +392,7 @@ class DeviceServer(asyncore.dispatcher):
     def graceful_exit(self):
         self.logger.info('Gracefully exiting...')
         self.close()
+        self.response_wakeup.close()
         self.device_manager.exit_gracefully()
 
 
@@ -1,12 +1,26 @@
 """ Shared manager between old ai_env and tf_ai_env """
 
-import json
 import time
+import threading
+import redis
 from kim_logs import get_kim_logger
 from enums import Action
 from ai_state_data import AIState
+from ai_state_wire import decode_phone_image_state
 from ai_info_publisher import get_ai_info_publisher
-from config import REDIS_HOST, REDIS_PORT, SWIPE_DURATION
+from ai_actions import get_action_type_str
+from image_hash_index import get_hamming_distance
+from perf_metrics import StageMetrics
+from config import REDIS_HOST, REDIS_PORT, SWIPE_DURATION, FRESH_STATE_DELAY, FRESH_STATE_TIMEOUT
+from config import ACTION_SETTLE_MODE, ACTION_SETTLE_WINDOW, ACTION_SETTLE_MAX_DISTANCE, ACTION_SETTLE_TIMEOUT
+from config import ACTION_SETTLE_LOG_INTERVAL
+
+
+def get_settle_hash(state):
+    ''' the multiscale room_hash (8x8 + 16x16 dhash, so smaller changes show), or image_sig without one '''
+    if state.room_hash != 'none':
+        return int(state.room_hash, 16)
+    return state.image_sig if isinstance(state.image_sig, int) else None
 
 
 class DeviceClientEnvActionStateManager(object):
@@ -19,6 +33,12 @@ class DeviceClientEnvActionStateManager(object):
         self.ai_info_publisher = get_ai_info_publisher(host, port)
         self.cur_screen_index = 0
         self.cur_screen_state = None
+        self.cur_screen_cond = threading.Condition()
+        self.last_action_time = 0
+        self.last_action = None
+        self.num_stale_states = 0
+        self.settle_metrics = StageMetrics()
+        self.num_settles = 0
 
         # Setup Actions Map
         self.actions_map = {
@@ -30,8 +50,9 @@ class DeviceClientEnvActionStateManager(object):
             Action.DOUBLE_TAP_LOCATION: self.perform_double_tap_action,
         }
 
-        # Redis to grab the screen state from the phone_image_stream process
-        self.p = self.ai_info_publisher.r.pubsub(ignore_subscribe_messages=True)
+        # Redis to grab the screen state from the phone_image_stream process (binary, so no decoding)
+        self.r = redis.StrictRedis(host=host, port=port, db=0, decode_responses=False)
+        self.p = self.r.pubsub(ignore_subscribe_messages=True)
         self.p.subscribe(**{
             'phone-image-states': self._handle_phone_image_states
         })
@@ -41,15 +62,119 @@ class DeviceClientEnvActionStateManager(object):
         if message['type'] != 'message':
             return
 
-        data = json.loads(message['data'])
-        if data:
-            self.cur_screen_index = data['index']
-            self.cur_screen_state = AIState.deserialize(data['state'])
+        if message['data']:
+            index, state = decode_phone_image_state(message['data'])
+            with self.cur_screen_cond:
+                self.cur_screen_index, self.cur_screen_state = index, state
+                self.cur_screen_cond.notify_all()
 
     def get_cur_screen_state(self):
         state = self.cur_screen_state
         return state if state is not None else AIState()
 
+    def wait_for_state_after(self, after_time, timeout=FRESH_STATE_TIMEOUT):
+        '''
+        Waits for the first processed state whose frame was captured after after_time
+        (a time.time(), the image stream runs on the same machine). On timeout logs
+        it and returns the current state anyway. States from streams that don't send
+        capture times count as fresh once a newer frame index arrives.
+        '''
+        start_index = self.cur_screen_index
+        deadline = time.time() + timeout
+
+        def is_fresh():
+            state = self.cur_screen_state
+            if state is None:
+                return False
+            if state.capture_time is None:
+                return self.cur_screen_index > start_index
+            return state.capture_time > after_time
+
+        with self.cur_screen_cond:
+            while not is_fresh():
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.num_stale_states += 1
+                    self.logger.debug('No state captured after %.3f within %.1fs (%d stale so far)',
+                                      after_time, timeout, self.num_stale_states)
+                    break
+                self.cur_screen_cond.wait(remaining)
+
+        return self.get_cur_screen_state()
+
+    def wait_for_settled_state(self,
+                               action_time,
+                               action=None,
+                               window=ACTION_SETTLE_WINDOW,
+                               max_distance=ACTION_SETTLE_MAX_DISTANCE,
+                               timeout=ACTION_SETTLE_TIMEOUT):
+        '''
+        Waits for the screen to settle after an action that finished at action_time: every
+        frame captured over window seconds (of capture time) within max_distance bits of the
+        one before it. Counting time rather than frames matters since the image stream
+        republishes unchanged frames at capture rate. Returns the last state, or the latest
+        one once timeout passes. Settle times get recorded per action type. States without a
+        hash can't be compared, so the first fresh one is returned right away.
+        '''
+        start_index = self.cur_screen_index
+        deadline = time.time() + timeout
+        last_index = last_hash = None
+        stable_since = None  # capture time of the first frame of the current unchanged run
+        settled = False
+
+        with self.cur_screen_cond:
+            while True:
+                index, state = self.cur_screen_index, self.cur_screen_state
+                is_fresh = state is not None and (
+                    state.capture_time > action_time if state.capture_time is not None else index > start_index)
+                if is_fresh and index != last_index:
+                    frame_time = state.capture_time if state.capture_time is not None else time.time()
+                    hash_value = get_settle_hash(state)
+                    if hash_value is None:
+                        self.logger.warning('State %d has no room_hash / image_sig to settle on, not waiting', index)
+                        return state
+                    unchanged = last_hash is not None and get_hamming_distance(hash_value, last_hash) <= max_distance
+                    if not unchanged:
+                        stable_since = frame_time
+                    last_index, last_hash = index, hash_value
+                    if frame_time - stable_since >= window:
+                        settled = True
+                        break
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cur_screen_cond.wait(remaining)
+
+        self._record_settle(action, stable_since - action_time if settled else time.time() - action_time, settled)
+        return self.get_cur_screen_state()
+
+    def _record_settle(self, action, settle_time, settled):
+        ''' settle_time is when the screen stopped changing, or how long we waited if it didn't '''
+        action_type = get_action_type_str(action) if action is not None else 'unknown'
+        if settled:
+            self.settle_metrics.record(action_type, settle_time)
+        else:
+            self.settle_metrics.record_error(action_type)
+        self.logger.debug('%s %s after %.3fs', action_type, 'settled' if settled else 'did not settle', settle_time)
+
+        self.num_settles += 1
+        if self.num_settles % ACTION_SETTLE_LOG_INTERVAL == 0:
+            summary = self.settle_metrics.get_summary()
+            for name, stats in sorted(summary['stages'].items()):
+                self.logger.info('Settle times (ms) %s: n=%d mean=%.0f p50=%.0f p95=%.0f timeouts=%d',
+                                 name, stats['count'], stats['mean'], stats['p50'], stats['p95'],
+                                 summary['errors'].get(name, 0))
+
+    def get_fresh_screen_state(self, timeout=FRESH_STATE_TIMEOUT):
+        '''
+        State to observe after the last action: once the screen settled with adaptive
+        ACTION_SETTLE_MODE, otherwise the first state captured FRESH_STATE_DELAY after it
+        '''
+        if ACTION_SETTLE_MODE == 'adaptive':
+            return self.wait_for_settled_state(self.last_action_time, self.last_action)
+        return self.wait_for_state_after(self.last_action_time + FRESH_STATE_DELAY, timeout)
+
     def perform_pass_action(self, args):
         time.sleep(0.5)
 
@@ -64,6 +189,10 @@ class DeviceClientEnvActionStateManager(object):
         distance = args['distance'] if 'distance' in args else 200
         self.client.send_drag_x_command(distance=distance, duration=SWIPE_DURATION)
 
+    def perform_swipe_sequence(self, directions, distance=200):
+        ''' swipes left (-1) / right (1) for each direction, in one device round trip '''
+        self.client.send_drag_x_sequence([d * distance for d in directions], duration=SWIPE_DURATION)
+
     def perform_tap_action(self, args):
         x, y, type = [args[k] for k in ['x', 'y', 'type']]
         type = args['object_type'] if type == 'object' else type
@@ -78,5 +207,7 @@ class DeviceClientEnvActionStateManager(object):
         if action in self.actions_map:
             self.ai_info_publisher.publish_action(action, args)
             self.actions_map[action](args)
+            self.last_action_time = time.time()
+            self.last_action = action
         else:
             self.logger.debug('unrecognized action %s' % action)
@@ -0,0 +1,126 @@
+''' Runs a sequence of functions as overlapping stages connected by bounded queues '''
+
+import threading
+import traceback
+from collections import deque
+from kim_logs import get_kim_logger
+
+
+class DropOldestQueue(object):
+    '''
+    Thread-safe bounded queue. When full, putting a new item drops the oldest
+    waiting item, so the consumer always gets the freshest data.
+    '''
+
+    def __init__(self, maxsize=1):
+        self.maxsize = max(1, maxsize)
+        self.items = deque()
+        self.cond = threading.Condition()
+        self.dropped_count = 0
+        self.closed = False
+
+    def put(self, item):
+        with self.cond:
+            if len(self.items) >= self.maxsize:
+                self.items.popleft()
+                self.dropped_count += 1
+            self.items.append(item)
+            self.cond.notify_all()
+
+    def get(self, timeout=None):
+        ''' returns next item, or None if closed / timed out '''
+        with self.cond:
+            self.cond.wait_for(lambda: self.items or self.closed, timeout)
+            if not self.items:
+                return None
+            item = self.items.popleft()
+            # producers wait on the same condition (wait_for_space)
+            self.cond.notify_all()
+            return item
+
+    def wait_for_space(self, timeout=None):
+        ''' blocks until there is room for another item without dropping one, False if closed / timed out '''
+        with self.cond:
+            return self.cond.wait_for(
+                lambda: self.closed or len(self.items) < self.maxsize, timeout) and not self.closed
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        return len(self.items)
+
+
+class FramePipeline(object):
+    '''
+    Every stage runs in its own thread. The first stage is a source (called with
+    no arguments), every later stage is called with the output of the previous one.
+    A stage returning None drops the item.
+
+    The source's queue always holds one item and the source only runs when it has
+    room, so it prefetches exactly one item ahead (producing it while the next stage
+    works on the previous one) instead of free-running and producing items that
+    would just get dropped. queue_size applies to the later queues.
+    '''
+
+    def __init__(self, stages, queue_size=1, logger_name='FramePipeline'):
+        self.logger = get_kim_logger(logger_name)
+        self.stages = stages
+        self.queues = [DropOldestQueue(1 if idx == 0 else queue_size) for idx in range(len(stages) - 1)]
+        self.threads = []
+        self.running = False
+
+    def _run_stage(self, idx):
+        name, fn = self.stages[idx]
+        in_queue = self.queues[idx - 1] if idx > 0 else None
+        out_queue = self.queues[idx] if idx < len(self.queues) else None
+
+        while self.running:
+            item = None
+            if in_queue is None:
+                if out_queue is not None and not out_queue.wait_for_space(timeout=0.5):
+                    continue
+                args = ()
+            else:
+                item = in_queue.get(timeout=0.5)
+                if item is None:
+                    continue
+                args = (item,)
+
+            try:
+                res = fn(*args)
+            except Exception as e:
+                self.logger.error('Exception in %s stage: %s', name, e)
+                traceback.print_exc()
+                continue
+
+            if res is not None and out_queue is not None:
+                out_queue.put(res)
+
+    def get_dropped_counts(self):
+        ''' how many items each stage has dropped because its consumer was busy '''
+        return {self.stages[i][0]: q.dropped_count for i, q in enumerate(self.queues)}
+
+    def start(self):
+        self.running = True
+        for idx, (name, _) in enumerate(self.stages):
+            thread = threading.Thread(target=self._run_stage, args=(idx,), name=name)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        for q in self.queues:
+            q.close()
+
+    def join(self):
+        for thread in self.threads:
+            thread.join()
+
+    def run(self):
+        ''' starts the pipeline and blocks until it stops '''
+        self.start()
+        self.join()
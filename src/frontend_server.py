@@ -4,7 +4,11 @@ import argparse
 import os
 import io
 import json
+import time
+import cv2
 import redis
+from collections import deque
+from concurrent import futures
 
 import tornado.ioloop
 import tornado.web
@@ -12,10 +16,14 @@ import tornado.websocket
 
 from PIL import Image
 
-from config import REDIS_HOST, REDIS_PORT, VYSOR_CAP_AREA
+from config import REDIS_HOST, REDIS_PORT, VYSOR_CAP_AREA, FRAME_RING_NAME
+from config import FRONTEND_PUSH_FPS, FRONTEND_CLIENT_QUEUE_SIZE, PERF_METRICS_PUBLISH_INTERVAL
 from kim_logs import get_kim_logger
+from perf_metrics import StageMetrics
+from state_sync import StateHistory
 from ai_actions import ActionGetter
-from ai_state_data import AIState
+from ai_state_wire import decode_phone_image_state
+from shared_frame_ring import SharedFrameRing, is_shared_memory_available
 
 script_path = os.path.dirname(os.path.realpath(__file__))
 
@@ -25,6 +33,8 @@ parser.add_argument('--port', default=8888, type=int, help='Web server port (def
 parser.add_argument('--width', default=VYSOR_CAP_AREA.w, type=int, help='Width (default to VYSOR_CAP_AREA.width)')
 parser.add_argument('--height', default=VYSOR_CAP_AREA.h, type=int, help='Height (default to VYSOR_CAP_AREA.height)')
 parser.add_argument('--quality', default=90, type=int, help='JPEG Quality 1 (worst) to 100 (best) (default: 90)')
+parser.add_argument('--fps', default=FRONTEND_PUSH_FPS, type=float,
+                    help='Max frames / updates pushed to clients per second (default: FRONTEND_PUSH_FPS)')
 parser.add_argument('--stopdelay', default=7, type=int, help='Delay in seconds before the camera will be stopped after '
                                                              'all clients have disconnected (default: 7)')
 args = parser.parse_args()
@@ -41,7 +51,7 @@ class FrontendRedisStream:
     def __init__(self, width, height, quality):
         log("Initializing FrontendRedisStream...")
 
-        self.phone_image_state_data = None
+        self.phone_image_state_dict_cache = None
         self.phone_image_state_obj = None
         self.phone_image_index = 0
         self.on_ai_log_line = None
@@ -50,6 +60,7 @@ class FrontendRedisStream:
         self.ai_status_data = {}
         self.size = (width, height)
         self.quality = quality
+        self.frame_ring = None
 
         self.r = redis.StrictRedis(
             host=REDIS_HOST,
@@ -75,16 +86,27 @@ class FrontendRedisStream:
         return json.loads(text) if isjson else text
 
     def _handle_phone_image_state(self, message):
-        data = self._get_message_data(message)
-        if data:
-            self.phone_image_state_data = data['state']
-            self.phone_image_state_obj = AIState.deserialize(self.phone_image_state_data)
-            self.phone_image_index = data['index']
+        if message['type'] != 'message' or not message['data']:
+            return
+        self.phone_image_index, self.phone_image_state_obj = decode_phone_image_state(message['data'])
+
+    @property
+    def phone_image_state_dict(self):
+        ''' json compatible dict of the current state for the browser, only built when asked for '''
+        state_obj = self.phone_image_state_obj
+        if state_obj is None:
+            return None
+
+        cached = self.phone_image_state_dict_cache
+        if cached is None or cached[0] is not state_obj:
+            cached = self.phone_image_state_dict_cache = (state_obj, json.loads(state_obj.serialize()))
+        return cached[1]
 
     def _handle_system_info_update(self, message):
+        # both the process hub and the image stream publish here, so merge
         data = self._get_message_data(message)
         if data:
-            self.system_info_data = data
+            self.system_info_data = dict(self.system_info_data, **data)
 
     def _handle_ai_status_updates(self, message):
         data = self._get_message_data(message)
@@ -101,13 +123,37 @@ class FrontendRedisStream:
         if data and self.on_ai_action:
             self.on_ai_action(data)
 
-    def get_jpeg_image_bytes(self):
+    def _get_frame_ring(self):
+        ''' the image stream's shared memory frame ring, (re)attached as needed, or None '''
+        if self.frame_ring is not None and self.frame_ring.is_closed():
+            self.frame_ring.close()
+            self.frame_ring = None
+
+        if self.frame_ring is None and is_shared_memory_available():
+            try:
+                self.frame_ring = SharedFrameRing.attach_by_name(FRAME_RING_NAME)
+            except (FileNotFoundError, ValueError):
+                return None
+        return self.frame_ring
+
+    def _get_latest_image(self):
+        ''' latest frame as a PIL image, from shared memory if it's there, else from redis '''
+        frame_ring = self._get_frame_ring()
+        if frame_ring is not None:
+            latest = frame_ring.read_latest(lambda view: cv2.cvtColor(view, cv2.COLOR_BGRA2RGB))
+            return Image.fromarray(latest[2]) if latest else None
+
         image_data = self.r.get('phone-image-data')
         shape = self.phone_image_state_obj.image_shape if self.phone_image_state_obj else None
         if not image_data or not shape:
             return None
+        return Image.frombytes('RGB', (shape[0], shape[1]), image_data)
+
+    def get_jpeg_image_bytes(self):
+        decoded = self._get_latest_image()
+        if decoded is None:
+            return None
 
-        decoded = Image.frombytes('RGB', (shape[0], shape[1]), image_data)
         pimg = decoded.resize(self.size, Image.ANTIALIAS)
 
         with io.BytesIO() as bytesIO:
@@ -115,57 +161,224 @@ class FrontendRedisStream:
             return bytesIO.getvalue()
 
 
-redis_stream = FrontendRedisStream(args.width, args.height, args.quality)
+class FrameJpegEncoder:
+    '''
+    Encodes the latest frame to jpeg once per frame index, on a worker thread so the
+    IOLoop never waits on PIL, and serves the same bytes to every client. At most one
+    encode runs at a time; clients asking while it runs share its result.
+    '''
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.executor = futures.ThreadPoolExecutor(max_workers=1)
+        self.jpeg = None  # (frame index, jpeg bytes)
+        self.pending = None  # (frame index, future)
+
+    async def get_jpeg_frame(self):
+        ''' (frame index, jpeg bytes) of the latest frame, or None before there is one '''
+        index = self.stream.phone_image_index
+        if self.jpeg is not None and self.jpeg[0] == index:
+            return self.jpeg
+
+        if self.pending is None or self.pending[1].done():
+            future = tornado.ioloop.IOLoop.current().run_in_executor(self.executor, self.stream.get_jpeg_image_bytes)
+            self.pending = (index, future)
+
+        pending = self.pending
+        try:
+            jpeg_bytes = await pending[1]
+        except Exception:
+            logger.exception('Failed to encode frame %s', pending[0])
+            jpeg_bytes = None
+
+        if jpeg_bytes and (self.jpeg is None or pending[0] >= self.jpeg[0]):
+            self.jpeg = (pending[0], jpeg_bytes)
+        # possibly the previous frame, if a newer one came in while encoding
+        return self.jpeg
+
+
+class FrontendBroadcaster:
+    '''
+    Pushes frames, the current state and redis events to every websocket client from
+    the IOLoop, at most max_fps times a second. The state is synced with versioned
+    deltas against what each client last acknowledged (see state_sync.py).
+
+    Events (ai log lines, actions) go through each client's bounded queue, which drops
+    the oldest ones when the client falls behind. Frames and state are coalesced: a
+    client only ever gets the latest, and a client still busy with its last write
+    skips the tick, so slow clients get fewer frames instead of a backlog.
+    '''
+
+    def __init__(self, stream, jpeg_encoder, max_fps=FRONTEND_PUSH_FPS, queue_size=FRONTEND_CLIENT_QUEUE_SIZE):
+        self.stream = stream
+        self.jpeg_encoder = jpeg_encoder
+        self.queue_size = queue_size
+        self.clients = set()
+        self.sending = False
+        self.state_inputs = None
+        self.state_history = StateHistory()
+
+        self.metrics = StageMetrics()
+        self.last_counts = {}
+        self.last_metrics_time = time.time()
+
+        self.io_loop = tornado.ioloop.IOLoop.current()
+        self.send_callback = tornado.ioloop.PeriodicCallback(self._schedule_send, 1000.0 / max_fps)
+        self.metrics_callback = tornado.ioloop.PeriodicCallback(self._publish_metrics,
+                                                                PERF_METRICS_PUBLISH_INTERVAL * 1000)
+
+        # pubsub callbacks run on the redis thread
+        stream.on_ai_log_line = lambda line: self.add_event({'type': 'aiLogLine', 'data': line})
+        stream.on_ai_action = lambda data: self.add_event({'type': 'aiAction', 'data': data})
+
+    def start(self):
+        self.send_callback.start()
+        self.metrics_callback.start()
+
+    def add_client(self, client):
+        client.events = deque(maxlen=self.queue_size)
+        client.sent_frame_index = None
+        client.sent_version = None
+        client.acked_version = None
+        client.last_write = None
+        self.clients.add(client)
+
+    def remove_client(self, client):
+        self.clients.discard(client)
+
+    def add_event(self, message):
+        ''' thread safe, queues message for every client '''
+        self.io_loop.add_callback(self._queue_event, message)
+
+    def _queue_event(self, message):
+        for client in self.clients:
+            if len(client.events) == client.events.maxlen:
+                self.metrics.increment('events_dropped')
+            client.events.append(message)
+
+    def _update_state_version(self):
+        ''' adds a state version if anything in the state changed since the last one '''
+        stream = self.stream
+        inputs = (stream.phone_image_index, stream.phone_image_state_obj, stream.system_info_data, stream.ai_status_data)
+        if self.state_inputs is None or any(a is not b for a, b in zip(inputs, self.state_inputs)):
+            self.state_inputs = inputs
+            self.state_history.update(stream.phone_image_index, stream.phone_image_state_dict,
+                                      stream.system_info_data, stream.ai_status_data)
+
+    def ack_state(self, client, version):
+        if client.sent_version is not None and version <= client.sent_version:
+            client.acked_version = max(version, client.acked_version or 0)
+
+    def resync_state(self, client):
+        ''' client lost track of its versions, send it a full snapshot next '''
+        client.acked_version = None
+        client.sent_version = None
+
+    def _get_state_message(self, client):
+        ''' state message for client (or None if it's up to date / waiting to ack a snapshot) '''
+        history = self.state_history
+        if client.sent_version == history.version:
+            return None
 
+        if client.acked_version is not None and not history.has_version(client.acked_version):
+            # behind by more than the history holds
+            self.resync_state(client)
+
+        if client.acked_version is None:
+            if client.sent_version is not None:
+                return None
+            self.metrics.increment('state_snapshots_sent')
+            return history.get_message()
+
+        self.metrics.increment('state_deltas_sent')
+        return history.get_message(client.acked_version)
+
+    def _schedule_send(self):
+        if self.clients and not self.sending:
+            self.sending = True
+            self.io_loop.spawn_callback(self._send_to_clients)
+
+    async def _send_to_clients(self):
+        try:
+            with self.metrics.time_stage('broadcast'):
+                frame = await self.jpeg_encoder.get_jpeg_frame()
+                self._update_state_version()
+                for client in list(self.clients):
+                    self._send_to_client(client, frame)
+        finally:
+            self.sending = False
+
+    def _write(self, client, message, binary=False):
+        client.last_write = client.write_message(message, binary=binary)
+        # json messages are str, count what goes over the wire
+        num_bytes = len(message.encode()) if isinstance(message, str) else len(message)
+        self.metrics.increment('bytes_sent', num_bytes)
+
+    def _send_to_client(self, client, frame):
+        if client.last_write is not None and not client.last_write.done():
+            self.metrics.increment('slow_client_skips')
+            return
+
+        try:
+            if frame and client.sent_frame_index != frame[0]:
+                self._write(client, frame[1], binary=True)
+                client.sent_frame_index = frame[0]
+                self.metrics.increment('frames_sent')
+
+            state = self._get_state_message(client)
+            if state is not None:
+                self._write(client, state)
+                client.sent_version = self.state_history.version
+
+            while client.events:
+                self._write(client, json.dumps(client.events.popleft()))
+                self.metrics.increment('events_sent')
+        except tornado.websocket.WebSocketClosedError:
+            self.remove_client(client)
+
+    def _publish_metrics(self):
+        ''' send rates (per second since the last publish) and broadcast timings, shown with the system info '''
+        now = time.time()
+        summary = self.metrics.get_summary()
+        elapsed = max(now - self.last_metrics_time, 1e-6)
+        summary['rates'] = {name: round((count - self.last_counts.get(name, 0)) / elapsed, 2)
+                            for name, count in summary['counts'].items()}
+        summary['clients'] = len(self.clients)
+        self.last_counts = summary['counts']
+        self.last_metrics_time = now
+        self.stream.r.publish('system-info-updates', json.dumps({'frontendPerf': summary}))
 
-class ServerWebSocketHandler(tornado.websocket.WebSocketHandler):
-    clients = set()
 
-    def __init__(self, *args, **kwargs):
-        super(ServerWebSocketHandler, self).__init__(*args, **kwargs)
-        redis_stream.on_ai_log_line = self.queue_ai_log_line
-        redis_stream.on_ai_action = self.queue_ai_action
-        self.message_queue = []
+redis_stream = FrontendRedisStream(args.width, args.height, args.quality)
+jpeg_encoder = FrameJpegEncoder(redis_stream)
+broadcaster = FrontendBroadcaster(redis_stream, jpeg_encoder, max_fps=args.fps)
+
 
+class ServerWebSocketHandler(tornado.websocket.WebSocketHandler):
     def check_origin(self, origin):
         # Allow access from every origin
         return True
 
     def open(self):
-        ServerWebSocketHandler.clients.add(self)
+        broadcaster.add_client(self)
         log("WebSocket opened from: " + self.request.remote_ip)
 
-    def queue_message(self, message):
-        self.message_queue.append(message)
-
-    def queue_ai_log_line(self, line):
-        self.queue_message({'type': 'aiLogLine', 'data': line})
-
-    def queue_ai_action(self, data):
-        self.queue_message({'type': 'aiAction', 'data': data})
-
-    def write_cur_state(self):
-        data = {
-            'frameNum': redis_stream.phone_image_index,
-            'imageState': redis_stream.phone_image_state_data,
-            'systemInfo': redis_stream.system_info_data,
-            'aiStatus': redis_stream.ai_status_data,
-        }
-        self.write_message({'type': 'curState', 'data': data})
-
     def on_message(self, message):
-        jpeg_bytes = redis_stream.get_jpeg_image_bytes()
-        if jpeg_bytes:
-            self.write_message(jpeg_bytes, binary=True)
-
-        self.write_cur_state()
-
-        for q_message in self.message_queue:
-            self.write_message(q_message)
-        self.message_queue = []
+        # everything else is pushed by the broadcaster (old clients still send 'more' polls)
+        try:
+            data = json.loads(message)
+        except ValueError:
+            return
+        if not isinstance(data, dict):
+            return
+
+        if data.get('type') == 'ack':
+            broadcaster.ack_state(self, data.get('version', 1))
+        elif data.get('type') == 'resync':
+            broadcaster.resync_state(self)
 
     def on_close(self):
-        ServerWebSocketHandler.clients.remove(self)
+        broadcaster.remove_client(self)
         log("WebSocket closed from: " + self.request.remote_ip)
 
 
@@ -180,4 +393,5 @@ app = tornado.web.Application([
     ])
 app.listen(args.port)
 
+broadcaster.start()
 tornado.ioloop.IOLoop.current().start()
@@ -5,6 +5,7 @@ from math import pow
 from enums import Action, ActionShape
 from config import HEURISTIC_CONFIG
 from ai_actions import ActionGetter, ActionWeighter, get_action_type_str
+from image_hash_index import get_room_recognizer
 
 
 '''
@@ -92,9 +93,10 @@ class HeuristicConfig(object):
 
 
 class HeuristicRoom(object):
-    ''' Maintains info for a room identified by a specific color_sig '''
+    ''' Maintains info for a room identified by a room key from RoomRecognizer (a color_sig) '''
 
-    def __init__(self, color_sig, time_since_last_visit, rooms_since_last_visit):
+    def __init__(self, room_key, color_sig, time_since_last_visit, rooms_since_last_visit):
+        self.room_key = room_key
         self.color_sig = color_sig
         self.time_since_last_visit = time_since_last_visit
         self.rooms_since_last_visit = rooms_since_last_visit
@@ -273,8 +275,9 @@ class HeuristicActionSelector(object):
         self.config = HeuristicConfig()
         self.state_room_seq = deque(maxlen=self.config.max_room_history_len)
         self.state_idx = 0
+        self.room_recognizer = get_room_recognizer()
 
-    def _create_room(self, state):
+    def _create_room(self, state, room_key):
         # Get total action count since we have last been to this room
         has_visited_before = False
         time_since_last_visit = 0
@@ -282,7 +285,7 @@ class HeuristicActionSelector(object):
         num_rooms = max(1, len(self.state_room_seq))
         for i in range(num_rooms - 1):
             prev_room = self.state_room_seq[-(i + 1)]
-            if prev_room.color_sig == state.color_sig:
+            if prev_room.room_key == room_key:
                 has_visited_before = True
                 break
             else:
@@ -291,6 +294,7 @@ class HeuristicActionSelector(object):
 
         # Create room
         room = HeuristicRoom(
+            room_key,
             state.color_sig,
             time_since_last_visit if has_visited_before else 0,
             rooms_since_last_visit if has_visited_before else 0
@@ -300,13 +304,14 @@ class HeuristicActionSelector(object):
     def _ingest_state_into_room(self, state):
         '''
         Ingests state into current room, creating one if necessary
-        incorporates state into state_room_seq, deciding its a new room if color_sig is different...
+        incorporates state into state_room_seq, deciding its a new room if room key is different...
         '''
 
-        did_change = self.state_idx == 0 or state.color_sig != self.state_room_seq[-1].color_sig
+        room_key = self.room_recognizer.get_room_key(state)
+        did_change = self.state_idx == 0 or room_key != self.state_room_seq[-1].room_key
         if did_change:
             # Create room and append to seq
-            room = self._create_room(state)
+            room = self._create_room(state, room_key)
             self.state_room_seq.append(room)
 
         room = self.state_room_seq[-1]
@@ -0,0 +1,68 @@
+''' Cheap check for whether a captured frame differs from the last one we fully processed '''
+
+import time
+import cv2
+import numpy as np
+from config import FRAME_CHANGE_WIDTH, FRAME_CHANGE_PIXEL_THRESHOLD
+from config import FRAME_CHANGE_MIN_PIXELS, FRAME_CHANGE_MAX_SKIP_SECONDS
+
+
+class FrameChangeDetector(object):
+    '''
+    Compares a downsampled copy of each frame against the last changed frame.
+    Small regions that matter a lot but barely move the downsampled image
+    (like the money / stars HUD) can be passed as watch_rects, which are compared
+    at full resolution.
+    '''
+
+    def __init__(self,
+                 watch_rects=None,
+                 width=FRAME_CHANGE_WIDTH,
+                 pixel_threshold=FRAME_CHANGE_PIXEL_THRESHOLD,
+                 min_changed_pixels=FRAME_CHANGE_MIN_PIXELS,
+                 max_skip_seconds=FRAME_CHANGE_MAX_SKIP_SECONDS):
+        self.watch_rects = watch_rects or []
+        self.width = width
+        self.pixel_threshold = pixel_threshold
+        self.min_changed_pixels = min_changed_pixels
+        self.max_skip_seconds = max_skip_seconds
+
+        self.reference = None
+        self.reference_time = 0
+        self.last_change_fraction = 1.0
+
+    def _get_signature(self, np_img):
+        img = np_img[:, :, :3]
+        h, w, _ = img.shape
+        size = (self.width, max(1, int(h * self.width / float(w))))
+        small = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        crops = [img[y:y + rh, x:x + rw].copy() for x, y, rw, rh in self.watch_rects]
+        return small, crops
+
+    def _count_changed_pixels(self, a, b):
+        diff = cv2.absdiff(a, b)
+        return int(np.count_nonzero(diff.max(axis=2) > self.pixel_threshold))
+
+    def has_changed(self, np_img):
+        ''' returns True if frame differs from the last changed frame (and remembers it) '''
+        small, crops = self._get_signature(np_img)
+        now = time.time()
+
+        changed = True
+        if self.reference is not None and self.reference[0].shape == small.shape:
+            ref_small, ref_crops = self.reference
+            num_changed = self._count_changed_pixels(small, ref_small)
+            self.last_change_fraction = num_changed / float(small.shape[0] * small.shape[1])
+
+            crops_changed = any(self._count_changed_pixels(c, rc) >= self.min_changed_pixels
+                                for c, rc in zip(crops, ref_crops))
+            changed = crops_changed \
+                or num_changed >= self.min_changed_pixels \
+                or now - self.reference_time >= self.max_skip_seconds
+        else:
+            self.last_change_fraction = 1.0
+
+        if changed:
+            self.reference = (small, crops)
+            self.reference_time = now
+        return changed
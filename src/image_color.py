@@ -1,26 +1,59 @@
 ''' Module inspired by https://adamspannbauer.github.io/2018/03/02/app-icon-dominant-colors/ '''
-from sklearn.cluster import KMeans
 from collections import Counter
 import cv2
+import numpy as np
 from config import COLOR_SIG_K, COLOR_SIG_PCT_FACTOR, COLOR_SIG_SQUASH_FACTOR
+from config import COLOR_SIG_METHOD, COLOR_SIG_HIST_BINS, ROOM_HASH_SIZES
 
 
-def get_img_hash(image, hash_size=8):
-    # https://www.pyimagesearch.com/2017/11/27/image-hashing-opencv-python/
+def _bits_to_int(bits):
+    ''' bool array -> int where bits[i] is worth 2 ** i '''
+    # packbits is big endian, so reverse the bits (and pad the new front) so bit i lands at 2 ** i
+    bits = bits[::-1]
+    pad = (8 - len(bits) % 8) % 8
+    if pad:
+        bits = np.concatenate((np.zeros(pad, dtype=bool), bits))
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
 
+def _get_dhash_bits(image, hash_size, interpolation):
     # resize the input image, adding a single column (width) so we
     # can compute the horizontal gradient
-    resized = cv2.resize(image, (hash_size + 1, hash_size))
+    resized = cv2.resize(image, (hash_size + 1, hash_size), interpolation=interpolation)
     resized = cv2.cvtColor(resized, cv2.COLOR_BGR2GRAY)  # convert 2 gray
 
     # compute the (relative) horizontal gradient between adjacent column pixels
     diff = resized[:, 1:] > resized[:, :-1]
+    return diff.flatten()
+
+
+def get_img_hash(image, hash_size=8, interpolation=cv2.INTER_LINEAR):
+    # https://www.pyimagesearch.com/2017/11/27/image-hashing-opencv-python/
+    return _bits_to_int(_get_dhash_bits(image, hash_size, interpolation))
 
-    # convert the difference image to a hash
-    return sum([2 ** i for (i, v) in enumerate(diff.flatten()) if v])
 
+def get_img_multiscale_hash(image, hash_sizes=ROOM_HASH_SIZES):
+    '''
+    difference hashes at several sizes concatenated into one int (smallest size in
+    the low bits), so hamming distance counts coarse layout and finer detail changes.
+    INTER_AREA averages whole regions, which makes it robust to small rendering noise.
+    '''
+    bits = np.concatenate([_get_dhash_bits(image, size, cv2.INTER_AREA) for size in hash_sizes])
+    return _bits_to_int(bits)
 
-def get_img_dom_colors(image, k=3, image_processing_size=None):
+
+def _resize_for_dom_colors(image, image_processing_size=None):
+    # if no new dims provided, force 40w image
+    if image_processing_size is None:
+        h, w, _ = image.shape
+        r = float(w) / h
+        image_processing_size = (40, int(40 / r))
+
+    # resize image
+    return cv2.resize(image, image_processing_size, interpolation=cv2.INTER_AREA)
+
+
+def get_img_dom_colors_kmeans(image, k=3, image_processing_size=None):
     """
     takes an image as input (no alpha channel!)
     returns the dominant colors of the image as a list
@@ -36,14 +69,9 @@ def get_img_dom_colors(image, k=3, image_processing_size=None):
     [56.2423442, 34.0834233, 70.1234123]
     """
 
-    # if no new dims provided, force 40w image
-    if image_processing_size is None:
-        h, w, _ = image.shape
-        r = float(w) / h
-        image_processing_size = (40, int(40 / r))
+    from sklearn.cluster import KMeans
 
-    # resize image
-    image = cv2.resize(image, image_processing_size, interpolation=cv2.INTER_AREA)
+    image = _resize_for_dom_colors(image, image_processing_size)
 
     # reshape the image to be a list of pixels
     image = image.reshape((image.shape[0] * image.shape[1], 3))
@@ -62,6 +90,43 @@ def get_img_dom_colors(image, k=3, image_processing_size=None):
     return color_counts
 
 
+def get_img_dom_colors_histogram(image, k=3, image_processing_size=None, bins=COLOR_SIG_HIST_BINS):
+    """
+    same output as get_img_dom_colors_kmeans, but deterministic and much faster.
+
+    pixels are quantized into bins ** 3 color cells, and the dominant colors are
+    the mean colors of the k most populated cells (ties go to the lower cell index,
+    so the same screen always gets the same answer). With more than k colors on
+    screen kmeans merges some of them, which the histogram doesn't.
+    """
+
+    image = _resize_for_dom_colors(image, image_processing_size)
+    pixels = image.reshape((image.shape[0] * image.shape[1], 3))
+
+    # bin index of every pixel, ie c0 * bins^2 + c1 * bins + c2
+    quantized = (pixels.astype(np.int32) * bins) >> 8
+    cells = (quantized[:, 0] * bins + quantized[:, 1]) * bins + quantized[:, 2]
+
+    num_cells = bins ** 3
+    counts = np.bincount(cells, minlength=num_cells)
+    sums = np.stack([np.bincount(cells, weights=pixels[:, c], minlength=num_cells) for c in range(3)], axis=1)
+
+    # most populated first, lowest cell index breaks ties
+    top_cells = np.lexsort((np.arange(num_cells), -counts))[:k]
+    top_cells = [c for c in top_cells if counts[c] > 0]
+
+    # pct is of every pixel like the kmeans path (whose k clusters cover them all), so color_sigs match
+    total = float(len(pixels))
+    return [(sums[c] / counts[c], counts[c] / total, int(counts[c])) for c in top_cells]
+
+
+def get_img_dom_colors(image, k=3, image_processing_size=None, method=COLOR_SIG_METHOD):
+    """ returns [(color, pct, count)] of the k most dominant colors, using 'histogram' or 'kmeans' """
+    if method == 'kmeans':
+        return get_img_dom_colors_kmeans(image, k, image_processing_size)
+    return get_img_dom_colors_histogram(image, k, image_processing_size)
+
+
 def get_image_color_sig_component(color,
                                   pct,
                                   pct_factor=COLOR_SIG_PCT_FACTOR,
@@ -76,9 +141,10 @@ def get_image_color_sig(image,
                         k=COLOR_SIG_K,
                         image_processing_size=None,
                         pct_factor=COLOR_SIG_PCT_FACTOR,
-                        squash_factor=COLOR_SIG_SQUASH_FACTOR):
+                        squash_factor=COLOR_SIG_SQUASH_FACTOR,
+                        method=COLOR_SIG_METHOD):
     """ get color sig !! """
-    dom_colors = get_img_dom_colors(image, k, image_processing_size)
+    dom_colors = get_img_dom_colors(image, k, image_processing_size, method)
 
     sig_components = [get_image_color_sig_component(color, pct, pct_factor, squash_factor) for color, pct, _ in dom_colors]
     sig_components.sort()
@@ -92,11 +158,13 @@ def get_image_color_features(image, k=COLOR_SIG_K, image_processing_size=None):
 
     color_sig = get_image_color_sig(image, k, image_processing_size)
     image_sig = get_img_hash(image)
+    room_hash = get_img_multiscale_hash(image)
 
     return {
         # 'dom_colors': dom_colors,
         'color_sig': color_sig,
-        'image_sig': image_sig
+        'image_sig': image_sig,
+        'room_hash': '%x' % room_hash  # hex so it survives json readers without big ints
     }
 
 
@@ -1,10 +1,11 @@
 ''' Module inspired by https://www.pyimagesearch.com/2016/02/08/opencv-shape-detection/ '''
 import cv2
 import imutils
+import numpy as np
 from concurrent import futures
 from image_blob import get_center_color
 from util import convert_point_between_rects, convert_rect_between_rects
-from config import CONTOUR_PROCESS_HEIGHT, ACTION_SHAPE_COLOR_RANGES
+from config import CONTOUR_PROCESS_HEIGHT, CONTOUR_SEGMENTATION, ACTION_SHAPE_COLOR_RANGES
 
 
 def get_contour_shape(c):
@@ -109,6 +110,131 @@ def print_color_shapes(color_shapes):
         print(s['action_shape'], s['color_label'], 'verts:', s['verts'], s['rawRect'], 'area:', s['boundsArea'], s['areaRatio'])
 
 
+def _find_contours(binary_img):
+    # cv2 version independent
+    contour_res = cv2.findContours(binary_img, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    return contour_res[1] if len(contour_res) == 3 else contour_res[0]
+
+
+def _filter_color_shapes(item, color_shapes):
+    # filter for at least reasonable shapes
+    color_shapes = [cs for cs in color_shapes if cs and cs['boundsArea'] > 60 and cs['contourArea'] > 10]
+
+    # filter for this ShapeColorRange
+    return [cs for cs in color_shapes
+            if cs['boundsArea'] >= item.min_area
+            and cs['boundsArea'] <= item.max_area
+            and cs['verts'] >= item.min_verts
+            and cs['verts'] <= item.max_verts
+            and cs['areaRatio'] >= item.min_area_ratio
+            and cs['areaRatio'] <= item.max_area_ratio
+            and cs['rawRect'][1] >= item.min_y
+            and cs['whRatio'] >= item.min_wh_ratio
+            and cs['whRatio'] <= item.max_wh_ratio]
+
+
+class ColorRangeSegmenter(object):
+    '''
+    Classifies every HSV pixel against all color ranges at once.
+
+    Each (lower, upper) range gets a bit, and each HSV channel gets a 256 entry
+    lookup table of the bits whose range contains that value. ANDing the three
+    lookups gives a bitmask image where bit i is set if the pixel is inside range i
+    (ranges overlap, so a single label per pixel wouldn't work).
+
+    Bounds are rounded the same way cv2.inRange rounds them, so masks match the
+    old per-range inRange masks exactly.
+    '''
+
+    def __init__(self, shape_color_ranges):
+        self.shape_color_ranges = shape_color_ranges
+
+        # ranges shared by several ShapeColorRanges only get one bit
+        bounds = []
+        self.range_bits = []
+        for item in shape_color_ranges:
+            bits = 0
+            for lower, upper in item.get_color_ranges():
+                lower = tuple(int(v) for v in np.clip(np.rint(lower), 0, 255))
+                upper = tuple(int(v) for v in np.clip(np.rint(upper), 0, 255))
+                if (lower, upper) not in bounds:
+                    bounds.append((lower, upper))
+                bits |= 1 << bounds.index((lower, upper))
+            self.range_bits.append(bits)
+
+        if len(bounds) > 64:
+            raise ValueError('ColorRangeSegmenter supports at most 64 distinct color ranges')
+        self.dtype = np.uint32 if len(bounds) <= 32 else np.uint64
+
+        values = np.arange(256)
+        self.luts = []
+        for chan in range(3):
+            lut = np.zeros(256, dtype=self.dtype)
+            for bit, (lower, upper) in enumerate(bounds):
+                in_range = (values >= lower[chan]) & (values <= upper[chan])
+                lut[in_range] |= self.dtype(1 << bit)
+            self.luts.append(lut)
+
+    def get_range_image(self, hsv, gray):
+        '''
+        bitmask image of the ranges each pixel is in. Pixels that would have been
+        thresholded out of the masked grayscale image (gray <= 100) are cleared.
+        '''
+        range_img = self.luts[0][hsv[:, :, 0]]
+        range_img &= self.luts[1][hsv[:, :, 1]]
+        range_img &= self.luts[2][hsv[:, :, 2]]
+        range_img[gray <= 100] = 0
+        return range_img
+
+    def get_range_contours(self, hsv, gray):
+        ''' list of contours for each ShapeColorRange (in order), one findContours per distinct mask '''
+        range_img = self.get_range_image(hsv, gray)
+
+        contours_by_bits = {}
+        for bits in self.range_bits:
+            if bits not in contours_by_bits:
+                mask = (range_img & self.dtype(bits)) != 0
+                contours_by_bits[bits] = _find_contours(mask.view(np.uint8))
+        return [contours_by_bits[bits] for bits in self.range_bits]
+
+
+_segmenters = {}
+
+
+def _get_segmenter(shape_color_ranges):
+    key = tuple(id(item) for item in shape_color_ranges)
+    if key not in _segmenters:
+        _segmenters[key] = ColorRangeSegmenter(shape_color_ranges)
+    return _segmenters[key]
+
+
+def get_image_colored_shapes_single_pass(image, shape_color_ranges):
+    '''
+    Same results as get_image_colored_shapes, but segments all color ranges in one
+    vectorized pass, and only computes shape data once per distinct contour set.
+    '''
+    img = imutils.resize(image, height=CONTOUR_PROCESS_HEIGHT, inter=cv2.INTER_LINEAR)
+    img = cv2.GaussianBlur(img, (5, 5), 0)
+    hsv = cv2.cvtColor(img, cv2.COLOR_BGR2HSV)
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+    range_contours = _get_segmenter(shape_color_ranges).get_range_contours(hsv, gray)
+
+    shapes = []
+    shape_data_cache = {}
+    for item, contours in zip(shape_color_ranges, range_contours):
+        if id(contours) not in shape_data_cache:
+            shape_data_cache[id(contours)] = [get_contour_shape_data(c, image, img) for c in contours]
+
+        for data in _filter_color_shapes(item, shape_data_cache[id(contours)]):
+            data = dict(data)
+            data['action_shape'] = item.action_shape
+            data['color_label'] = item.color_label
+            shapes.append(data)
+
+    return shapes
+
+
 def get_image_colored_shapes(image, shape_color_ranges):
     '''
     Image is numpy image. shape_color_ranges is list of ShapeColorRange tuples
@@ -153,28 +279,13 @@ def get_image_colored_shapes(image, shape_color_ranges):
         res = cv2.threshold(res, 100, 255, cv2.THRESH_BINARY)[1]
         # cv2.imshow('Threshold', res); cv2.waitKey(0)
 
-        # Find contours (cv2 version independent)
-        contour_res = cv2.findContours(res, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        contours = contour_res[1] if len(contour_res) == 3 else contour_res[0]
+        contours = _find_contours(res)
 
         # Get colored shapes
         color_shapes = [get_color_shape_data(item, c, image, img) for c in contours]
 
-        # filter for at least reasonable shapes
-        color_shapes = [cs for cs in color_shapes if cs['boundsArea'] > 60 and cs['contourArea'] > 10]
-
-        # filter for this ShapeColorRange
         if TESTING and SHOW_PRE_SHAPES: print_color_shapes(color_shapes)
-        color_shapes = [cs for cs in color_shapes if cs
-                        and cs['boundsArea'] >= item.min_area
-                        and cs['boundsArea'] <= item.max_area
-                        and cs['verts'] >= item.min_verts
-                        and cs['verts'] <= item.max_verts
-                        and cs['areaRatio'] >= item.min_area_ratio
-                        and cs['areaRatio'] <= item.max_area_ratio
-                        and cs['rawRect'][1] >= item.min_y
-                        and cs['whRatio'] >= item.min_wh_ratio
-                        and cs['whRatio'] <= item.max_wh_ratio]
+        color_shapes = _filter_color_shapes(item, color_shapes)
         if TESTING:
             print("Drawn Shapes:")
             print_color_shapes(color_shapes)
@@ -198,6 +309,8 @@ def get_image_colored_shapes(image, shape_color_ranges):
 
 
 def get_kim_action_color_shapes(image):
+    if CONTOUR_SEGMENTATION == 'single_pass':
+        return get_image_colored_shapes_single_pass(image, ACTION_SHAPE_COLOR_RANGES)
     shapes = get_image_colored_shapes(image, ACTION_SHAPE_COLOR_RANGES)
     return shapes
 
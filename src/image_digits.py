@@ -0,0 +1,150 @@
+''' Fast reader for the money / stars HUD digits, by matching glyphs against templates learned from tesseract '''
+
+import threading
+import cv2
+import numpy as np
+from config import HUD_DIGIT_GLYPH_SIZE, HUD_DIGIT_MIN_SCORE, HUD_DIGIT_MIN_MARGIN, HUD_DIGIT_MIN_SAMPLES
+
+
+def _get_foreground(np_img):
+    ''' bool image of the text pixels (whichever of dark / light there is less of) '''
+    gray = np_img.mean(axis=2) if np_img.ndim == 3 else np_img.astype(float)
+    lo, hi = gray.min(), gray.max()
+    if hi - lo < 32:
+        # flat crop, no text
+        return None
+    fg = gray > (lo + hi) / 2.0
+    return fg if fg.mean() <= 0.5 else ~fg
+
+
+def segment_glyphs(np_img, glyph_size=HUD_DIGIT_GLYPH_SIZE, min_height_frac=0.6):
+    '''
+    Splits HUD crop into glyphs by column projection (runs of columns with text
+    pixels), and returns an (N, w * h) float array of glyphs resized to glyph_size.
+    Glyphs much shorter than the tallest one (commas, periods) are dropped.
+    '''
+    fg = _get_foreground(np_img)
+    if fg is None:
+        return np.zeros((0, glyph_size[0] * glyph_size[1]))
+
+    cols = fg.any(axis=0)
+    # starts / ends of runs of text columns
+    edges = np.diff(np.concatenate(([0], cols.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+
+    boxes = []
+    for start, end in zip(starts, ends):
+        rows = np.flatnonzero(fg[:, start:end].any(axis=1))
+        boxes.append((start, end, rows[0], rows[-1] + 1))
+
+    if not boxes:
+        return np.zeros((0, glyph_size[0] * glyph_size[1]))
+
+    max_height = max(bottom - top for _, _, top, bottom in boxes)
+    glyphs = []
+    for left, right, top, bottom in boxes:
+        if bottom - top < max_height * min_height_frac:
+            continue
+        glyph = fg[top:bottom, left:right].astype(np.float32)
+        glyphs.append(cv2.resize(glyph, glyph_size, interpolation=cv2.INTER_AREA).ravel())
+
+    return np.array(glyphs) if glyphs else np.zeros((0, glyph_size[0] * glyph_size[1]))
+
+
+class HUDDigitReader(object):
+    '''
+    Reads the HUD digits with template matching. The HUD uses one fixed font, so
+    each digit gets a template (mean glyph) learned from tesseract reads, once it has
+    min_samples agreeing samples. read() returns None until all ten digits have a
+    template (a digit without one would just match whichever template looks closest),
+    or when it isn't confident, which means the caller should fall back to tesseract.
+    '''
+
+    def __init__(self,
+                 glyph_size=HUD_DIGIT_GLYPH_SIZE,
+                 min_score=HUD_DIGIT_MIN_SCORE,
+                 min_margin=HUD_DIGIT_MIN_MARGIN,
+                 min_samples=HUD_DIGIT_MIN_SAMPLES):
+        self.glyph_size = glyph_size
+        self.min_score = min_score
+        self.min_margin = min_margin
+        self.min_samples = min_samples
+
+        self.lock = threading.Lock()
+        num_pixels = glyph_size[0] * glyph_size[1]
+        self.template_sums = np.zeros((10, num_pixels))
+        self.template_counts = np.zeros(10, dtype=int)
+
+        # (active digits, template matrix), swapped as a whole so readers don't need the lock
+        self.active = (np.zeros(0, dtype=int), np.zeros((0, num_pixels)))
+
+    def _match(self, glyphs):
+        ''' returns (digits, scores, margins) of the best template for each glyph, or None '''
+        digits, templates = self.active
+        if len(digits) == 0 or len(glyphs) == 0:
+            return None
+
+        # mean abs difference of every glyph to every template -> (num glyphs, num templates)
+        scores = 1 - np.abs(glyphs[:, None, :] - templates[None, :, :]).mean(axis=2)
+        order = np.argsort(-scores, axis=1)
+        best = scores[np.arange(len(glyphs)), order[:, 0]]
+        if len(digits) > 1:
+            margins = best - scores[np.arange(len(glyphs)), order[:, 1]]
+        else:
+            margins = np.ones(len(glyphs))
+        return digits[order[:, 0]], best, margins
+
+    def read(self, np_img):
+        ''' returns the number in the crop, or None if not confident '''
+        if not self.is_complete():
+            return None
+
+        glyphs = segment_glyphs(np_img, self.glyph_size)
+        match = self._match(glyphs)
+        if match is None:
+            return None
+
+        digits, scores, margins = match
+        if scores.min() < self.min_score or margins.min() < self.min_margin:
+            return None
+        return int(''.join(str(d) for d in digits))
+
+    def learn(self, np_img, value):
+        '''
+        Adds the glyphs of the crop as samples of the digits of value (usually read
+        by tesseract). Ignored unless the glyph count matches the number of digits and
+        every glyph with an active template already matches the same digit.
+        '''
+        if value is None or value < 0:
+            return False
+
+        glyphs = segment_glyphs(np_img, self.glyph_size)
+        value_digits = np.array([int(c) for c in str(value)])
+        if len(glyphs) != len(value_digits):
+            return False
+
+        match = self._match(glyphs)
+        if match is not None:
+            active_digits = self.active[0]
+            matched_digits = match[0]
+            for digit, matched in zip(value_digits, matched_digits):
+                if digit in active_digits and matched != digit:
+                    return False
+
+        with self.lock:
+            for digit, glyph in zip(value_digits, glyphs):
+                self.template_sums[digit] += glyph
+                self.template_counts[digit] += 1
+
+            active_digits = np.flatnonzero(self.template_counts >= self.min_samples)
+            templates = self.template_sums[active_digits] / self.template_counts[active_digits][:, None]
+            self.active = (active_digits, templates)
+        return True
+
+    def get_num_active_digits(self):
+        return len(self.active[0])
+
+    def is_complete(self):
+        ''' True once every digit has a template '''
+        return self.get_num_active_digits() == 10
@@ -0,0 +1,129 @@
+''' In-memory nearest-neighbor lookup of image hashes by hamming distance, used to recognize rooms '''
+
+import threading
+from collections import deque
+from config import ROOM_HASH_SIZES, ROOM_HASH_MAX_DISTANCE, ROOM_HASH_MIN_NEW_DISTANCE, ROOM_INDEX_MAX_ENTRIES
+
+
+# int.bit_count is python 3.10+
+_popcount = int.bit_count if hasattr(int, 'bit_count') else lambda x: bin(x).count('1')
+
+
+def get_hamming_distance(a, b):
+    return _popcount(a ^ b)
+
+
+class HashIndex(object):
+    '''
+    Multi-index hashing: each hash is split into max_distance + 1 chunks, and each
+    chunk gets a dict of chunk value -> entry ids. Two hashes within max_distance
+    must share at least one chunk exactly (pigeonhole), so a query only computes
+    distances to the few entries that share a chunk with it, instead of all of them.
+
+    Holds at most max_entries, forgetting the oldest first.
+    '''
+
+    def __init__(self, num_bits, max_distance, max_entries=ROOM_INDEX_MAX_ENTRIES):
+        self.num_bits = num_bits
+        self.max_distance = max_distance
+        self.max_entries = max_entries
+
+        num_chunks = min(num_bits, max_distance + 1)
+        bounds = [int(round(i * num_bits / float(num_chunks))) for i in range(num_chunks + 1)]
+        self.chunks = [(start, (1 << (end - start)) - 1) for start, end in zip(bounds[:-1], bounds[1:])]
+        self.tables = [{} for _ in self.chunks]
+
+        self.entries = {}
+        self.entry_order = deque()
+        self.next_id = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _get_chunk_values(self, hash_value):
+        return [(hash_value >> start) & mask for start, mask in self.chunks]
+
+    def add(self, hash_value, value):
+        entry_id = self.next_id
+        self.next_id += 1
+
+        self.entries[entry_id] = (hash_value, value)
+        self.entry_order.append(entry_id)
+        for table, chunk in zip(self.tables, self._get_chunk_values(hash_value)):
+            table.setdefault(chunk, set()).add(entry_id)
+
+        if len(self.entries) > self.max_entries:
+            self._remove(self.entry_order.popleft())
+
+    def _remove(self, entry_id):
+        hash_value, _ = self.entries.pop(entry_id)
+        for table, chunk in zip(self.tables, self._get_chunk_values(hash_value)):
+            ids = table[chunk]
+            ids.discard(entry_id)
+            if not ids:
+                del table[chunk]
+
+    def query(self, hash_value):
+        ''' returns (distance, value) of the nearest entry within max_distance (oldest wins ties), or None '''
+        candidates = set()
+        for table, chunk in zip(self.tables, self._get_chunk_values(hash_value)):
+            candidates.update(table.get(chunk, ()))
+
+        best = None
+        for entry_id in candidates:
+            distance = get_hamming_distance(hash_value, self.entries[entry_id][0])
+            if distance <= self.max_distance and (best is None or (distance, entry_id) < best[:2]):
+                best = (distance, entry_id, self.entries[entry_id][1])
+
+        return (best[0], best[2]) if best is not None else None
+
+
+class RoomRecognizer(object):
+    '''
+    Maps a state to a room key. A screen near (in hash distance) one we've seen
+    before gets that screen's room key, so minor rendering noise that flips a
+    color_sig doesn't look like a new room. Unknown screens start a room keyed by
+    their color_sig.
+
+    Which key a screen gets depends on what was seen before, so everything that
+    keys rooms should share one recognizer, see get_room_recognizer.
+    '''
+
+    def __init__(self,
+                 max_distance=ROOM_HASH_MAX_DISTANCE,
+                 min_new_distance=ROOM_HASH_MIN_NEW_DISTANCE,
+                 max_entries=ROOM_INDEX_MAX_ENTRIES):
+        self.min_new_distance = min_new_distance
+        num_bits = sum(size * size for size in ROOM_HASH_SIZES)
+        self.index = HashIndex(num_bits, max_distance, max_entries)
+        self.lock = threading.Lock()
+
+    def get_room_key(self, state):
+        if state.room_hash == 'none':
+            return state.color_sig
+
+        with self.lock:
+            return self._get_room_key(int(state.room_hash, 16), state.color_sig)
+
+    def _get_room_key(self, hash_value, color_sig):
+        match = self.index.query(hash_value)
+        if match is None:
+            self.index.add(hash_value, color_sig)
+            return color_sig
+
+        distance, room_key = match
+        if distance >= self.min_new_distance:
+            # remember this variation of the room too
+            self.index.add(hash_value, room_key)
+        return room_key
+
+
+room_recognizer = None
+
+
+def get_room_recognizer():
+    ''' the RoomRecognizer shared by the process (reward calc, heuristic selector) '''
+    global room_recognizer
+    if room_recognizer is None:
+        room_recognizer = RoomRecognizer()
+    return room_recognizer
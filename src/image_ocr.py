@@ -1,22 +1,25 @@
 """ Code to transform images from KK:Hollywood into numerical state """
 
+import hashlib
+import queue
 import tesserocr
+import threading
 import time
 import numpy as np
-from PIL import Image, ImageEnhance, ImageOps
+from collections import OrderedDict
+from PIL import Image
 from concurrent import futures
 from image_color import get_image_color_sig
-from tess_test import detect
+from image_digits import HUDDigitReader
+from config import OCR_CACHE_SIZE, OCR_TESSERACT_POOL_SIZE, OCR_CHAR_WHITELIST, HUD_DIGIT_TEMPLATES
 
 
 TESTING = False
 TESTING_BLANKSPACE = False
 
 
-def read_num_from_img(image):
-    """ Performs OCR on image and converts text to number """
-    # text = tesserocr.image_to_text(image).strip()
-    text = detect( np.array(image.convert('RGB')) )
+def parse_num(text):
+    """ converts OCR text to number, or -1 if there are no digits """
     try:
         f = filter(str.isdigit, text.encode('ascii', 'ignore').decode('utf-8'))
         t = ''.join(f)
@@ -28,42 +31,152 @@ def read_num_from_img(image):
         return -1
 
 
+class TesseractPool(object):
+    '''
+    Keeps num_apis initialized tesseract handles (engine init is the slow part), set
+    up for one line of digits. Each read borrows a handle, so up to num_apis reads
+    can run at once from different threads.
+    '''
+
+    def __init__(self, num_apis=OCR_TESSERACT_POOL_SIZE, whitelist=OCR_CHAR_WHITELIST):
+        self.apis = queue.Queue()
+        for _ in range(num_apis):
+            api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_LINE)
+            api.SetVariable('tessedit_char_whitelist', whitelist)
+            self.apis.put(api)
+        self.num_apis = num_apis
+
+    def read_text(self, np_img):
+        ''' OCR text of a numpy image (an ROI view is fine, only it gets copied) '''
+        np_img = np.ascontiguousarray(np_img)
+        height, width = np_img.shape[:2]
+        bytes_per_pixel = np_img.shape[2] if np_img.ndim == 3 else 1
+
+        api = self.apis.get()
+        try:
+            api.SetImageBytes(np_img.tobytes(), width, height, bytes_per_pixel, width * bytes_per_pixel)
+            return api.GetUTF8Text().strip()
+        finally:
+            self.apis.put(api)
+
+    def close(self):
+        for _ in range(self.num_apis):
+            self.apis.get().End()
+
+
+def read_num_from_img(np_img, tess_pool):
+    """ Performs OCR on image and converts text to number """
+    return parse_num(tess_pool.read_text(np_img))
+
+
+class OCRResultCache(object):
+    '''
+    LRU cache of OCR values keyed on the exact pixels of the crop, since the HUD
+    only changes a few times a minute. A crop we've read before never hits tesseract again.
+    '''
+
+    def __init__(self, max_entries=OCR_CACHE_SIZE, metrics=None):
+        self.max_entries = max_entries
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.values = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def get_key(np_img):
+        digest = hashlib.blake2b(np.ascontiguousarray(np_img).data, digest_size=16).digest()
+        return (np_img.dtype.str, np_img.shape, digest)
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.increment('ocr_cache_%s' % name)
+
+    def get_value(self, image, read_fn):
+        ''' cached read_fn(image) '''
+        key = self.get_key(image)
+        with self.lock:
+            if key in self.values:
+                self.values.move_to_end(key)
+                self.hits += 1
+                self._count('hits')
+                return self.values[key]
+
+        value = read_fn(image)
+
+        with self.lock:
+            self.misses += 1
+            self._count('misses')
+            self.values[key] = value
+            if len(self.values) > self.max_entries:
+                self.values.popitem(last=False)
+        return value
+
+    def get_stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.values)}
+
+
 class ImageOCRProcessor(object):
     """ Helps with reading characters from gameplay images """
 
-    def __init__(self, image_config):
+    def __init__(self, image_config, metrics=None):
         self.image_config = image_config
+        self.metrics = metrics
+        self.ocr_cache = OCRResultCache(metrics=metrics)
+        self.tess_pool = TesseractPool()
+
+        # money and stars share a font, so they share templates
+        self.digit_reader = HUDDigitReader() if HUD_DIGIT_TEMPLATES else None
+
+        # created once and reused for every frame (money + stars)
+        self.executor = futures.ThreadPoolExecutor(max_workers=2)
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.tess_pool.close()
+
+    def _count(self, name):
+        if self.metrics is not None:
+            self.metrics.increment(name)
+
+    def _read_num(self, hud_image):
+        ''' template reader if it is confident, otherwise tesseract (which then teaches the template reader) '''
+        if self.digit_reader is None:
+            return read_num_from_img(hud_image, self.tess_pool)
+
+        value = self.digit_reader.read(hud_image)
+        if value is not None:
+            self._count('hud_template_reads')
+            return value
+
+        value = read_num_from_img(hud_image, self.tess_pool)
+        self._count('hud_tesseract_reads')
+        self.digit_reader.learn(hud_image, value)
+        return value
 
     def _read_hud_value(self, image, left):
         padding = self.image_config.top_menu_padding
         height = self.image_config.top_menu_height
         width = self.image_config.top_menu_item_width
-        item_crop_box = (left, padding, left + width, height - padding)
-        hud_image = image.crop(item_crop_box)
-        # hud_image = ImageEnhance.Contrast(hud_image).enhance(2)
-        # hud_image = ImageEnhance.Sharpness(hud_image).enhance(4)
-        # hud_image = ImageOps.grayscale(hud_image)
-        # hud_image = hud_image.resize((width*2, (height-padding*2)*2), Image.ANTIALIAS)
-        # hud_image = hud_image.resize((162,100), Image.ANTIALIAS)
-        value = read_num_from_img(hud_image)
+        # view straight into the frame, no copy
+        hud_image = image[padding:height - padding, left:left + width, :3]
+        value = self.ocr_cache.get_value(hud_image, self._read_num)
         if TESTING:
-            new_im.show()
+            Image.fromarray(hud_image).show()
             print(value)
             time.sleep(10)
         return value
 
     def _get_blankspace_is_black(self, image, left):
         left_pad, top, width, height = self.image_config.blankspace_rect
-        item_crop_box = (left + left_pad, top, left + width, top + height)
-        cropped_image = image.crop(item_crop_box)
-        np_cropped_image = np.array(cropped_image)
-        blankspace_color_sig = get_image_color_sig(np_cropped_image[:, :, :3], k=1, squash_factor=0.15)
+        np_cropped_image = image[top:top + height, left + left_pad:left + width, :3]
+        blankspace_color_sig = get_image_color_sig(np_cropped_image, k=1, squash_factor=0.15)
         black = '0-0-0'
         blankspace_is_black = black in blankspace_color_sig and blankspace_color_sig.index(black) == 0
         if TESTING_BLANKSPACE:
             print(np_cropped_image.shape)
             print(left, blankspace_color_sig, blankspace_is_black)
-            cropped_image.resize((200, 130)).show()
+            Image.fromarray(np_cropped_image).resize((200, 130)).show()
             time.sleep(20)
         return blankspace_is_black
 
@@ -71,38 +184,41 @@ class ImageOCRProcessor(object):
         value = self._read_hud_value(image, left)
         return value
 
-    def process_image(self, image):
+    def process_np_img(self, np_img):
         '''
+            np_img is the captured frame, HUD items are read from views into it.
+
             FPS with no text reading: ~7.5
             FPS with straight sync text reading: ~3.0
             FPS with thread pool text reading: ~3.9
         '''
+        image = np_img
         # Get shape
-        width, height = image.size
+        height, width = image.shape[:2]
         image_shape = (width, height, 3)
 
         # get OCR text from known HUD elements
         values = {'image_shape': image_shape}
 
-        with futures.ThreadPoolExecutor() as executor:
-            future_to_key = {
-                executor.submit(self.get_hud_features, image, self.image_config.money_item_left, True): 'money',
-                executor.submit(self.get_hud_features, image, self.image_config.stars_item_left, False): 'stars',
-                # executor.submit(self._read_hud_value, image, self.image_config.bolts_item_left): 'bolts',
-            }
-            for future in futures.as_completed(future_to_key):
-                key = future_to_key[future]
-                try:
-                    values[key] = future.result()
-                except Exception as e:
-                    print('Exception reading value: %s', e)
+        executor = self.executor
+        future_to_key = {
+            executor.submit(self.get_hud_features, image, self.image_config.money_item_left, True): 'money',
+            executor.submit(self.get_hud_features, image, self.image_config.stars_item_left, False): 'stars',
+            # executor.submit(self._read_hud_value, image, self.image_config.bolts_item_left): 'bolts',
+        }
+        for future in futures.as_completed(future_to_key):
+            key = future_to_key[future]
+            try:
+                values[key] = future.result()
+            except Exception as e:
+                print('Exception reading value: %s', e)
 
         return values
 
+    def process_image(self, image):
+        ''' image is a PIL image '''
+        return self.process_np_img(np.asarray(image.convert('RGB')))
+
     def process_filename(self, filename):
         image = Image.open(filename).convert('RGB')
         return self.process_image(image)
-
-    def process_np_img(self, np_img):
-        image = Image.fromarray(np_img).convert('RGB')
-        return self.process_image(image)
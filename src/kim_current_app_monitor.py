@@ -1,4 +1,3 @@
-import json
 import redis
 from datetime import datetime
 from time import sleep
@@ -8,6 +7,7 @@ from config import MAX_NO_IMAGE_FEATURES_TIME, MAX_NO_IMAGE_FEATURES_BACK_BUTTON
 from config import MAX_BLACK_SCREEN_TIME, MAX_BLACK_SCREEN_BACK_BUTTON_ATTEMPTS, MIN_BACK_BUTTON_ATTEMPTS
 from kim_logs import get_kim_logger
 from device_client import DeviceClient
+from ai_state_wire import decode_phone_image_state
 
 
 LAUNCHER_PACKAGES = (
@@ -35,8 +35,9 @@ class KimCurrentAppMonitor(object):
         self.last_in_game_time = datetime.now()
         self.last_non_black_screen_time = datetime.now()
 
+        # image states may be binary, so don't decode responses
         self.r = redis.StrictRedis(
-            host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=True)
+            host=REDIS_HOST, port=REDIS_PORT, db=0, decode_responses=False)
 
         self.client = DeviceClient(restart_delay=30)
         self.client.start()
@@ -57,18 +58,17 @@ class KimCurrentAppMonitor(object):
 
     def _get_image_state_info(self):
         # decode current image state
-        image_state_data_str = self.r.get('cur-phone-image-state')
-        image_state_data = json.loads(image_state_data_str) if image_state_data_str is not None else None
-        image_state = json.loads(image_state_data['state']) if image_state_data is not None and 'state' in image_state_data else None
+        image_state_data = self.r.get('cur-phone-image-state')
+        image_state = decode_phone_image_state(image_state_data)[1] if image_state_data is not None else None
         if image_state is None:
             self.logger.debug('no image state...')
             return 0
 
-        money = image_state['money']
-        stars = image_state['stars']
-        on_menubar = image_state['on_menubar']
+        money = image_state.money
+        stars = image_state.stars
+        on_menubar = image_state.on_menubar
 
-        color_sig = image_state['color_features']['color_sig']
+        color_sig = image_state.color_sig
         black_color_sig_str = '0-0-0'
         screen_is_black = black_color_sig_str in color_sig and color_sig.index(black_color_sig_str) == 0
 
@@ -87,6 +87,11 @@ class KimCurrentAppMonitor(object):
             'is_in_game': is_in_game
         }
 
+    def _get_is_in_game(self):
+        # _get_image_state_info returns 0 while there is no image state
+        image_state_info = self._get_image_state_info()
+        return bool(image_state_info) and image_state_info['is_in_game']
+
     def _reset_time_counters(self):
         now = datetime.now()
         self.last_in_game_time = now
@@ -142,14 +147,20 @@ class KimCurrentAppMonitor(object):
             self._reset_time_counters()
         elif out_of_game_too_long or out_of_app_too_long:
             # press back N times. if still no image features, reset
-            back_attempts = 0
-            while (not is_in_game or not is_kim or back_attempts < MIN_BACK_BUTTON_ATTEMPTS) and back_attempts < MAX_NO_IMAGE_FEATURES_BACK_BUTTON_ATTEMPTS:
+            # the first MIN_BACK_BUTTON_ATTEMPTS presses don't depend on the screen, so they go as one macro
+            back_attempts = min(MIN_BACK_BUTTON_ATTEMPTS, MAX_NO_IMAGE_FEATURES_BACK_BUTTON_ATTEMPTS)
+            if back_attempts > 0:
+                self.logger.info('NO IMAGE FEATURES: Pressing back button x%d' % back_attempts)
+                self.client.send_back_button_commands(back_attempts, SECONDS_BETWEEN_BACK_BUTTONS)
+                is_kim, _ = self._get_app_info() if not is_kim else (True, True)
+                is_in_game = self._get_is_in_game()
+
+            while (not is_in_game or not is_kim) and back_attempts < MAX_NO_IMAGE_FEATURES_BACK_BUTTON_ATTEMPTS:
                 self.logger.info('NO IMAGE FEATURES: Pressing back button x%d' % (back_attempts + 1))
                 self.client.send_back_button_command()
                 sleep(SECONDS_BETWEEN_BACK_BUTTONS)
-                if back_attempts >= MIN_BACK_BUTTON_ATTEMPTS - 1:
-                    is_kim, _ = self._get_app_info() if not is_kim else (True, True)
-                    is_in_game = self._get_image_state_info()['is_in_game']
+                is_kim, _ = self._get_app_info() if not is_kim else (True, True)
+                is_in_game = self._get_is_in_game()
                 back_attempts += 1
 
             if not is_in_game or not is_kim:
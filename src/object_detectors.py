@@ -0,0 +1,246 @@
+'''
+Interchangeable YOLO object detector backends. Every backend's detect returns
+darkflow style dicts ({label, confidence, topleft: {x, y}, bottomright: {x, y}})
+so ai_state._process_image_objects doesn't care which one ran.
+
+    darkflow - TFNet (tensorflow 1, uses the gpu if there is one)
+    opencv   - cv2.dnn on the darknet cfg + weights, cpu friendly
+    onnx     - ONNX Runtime on a converted model, with graph optimization and thread control
+'''
+
+import abc
+import os
+import re
+import tempfile
+import cv2
+import numpy as np
+from config import OBJECT_DETECTOR_BACKEND, OBJECT_DETECTOR_THREADS, OBJECT_DETECTOR_NMS_THRESHOLD
+from config import OBJECT_DETECTOR_ONNX_MODEL, TFNET_CONFIG
+
+
+def parse_darknet_cfg(cfg_path):
+    ''' returns list of (section name, {key: value}) from a darknet cfg file '''
+    sections = []
+    with open(cfg_path) as f:
+        for line in f:
+            line = line.split('#')[0].strip()
+            if not line:
+                continue
+            if line.startswith('['):
+                sections.append((line.strip('[]'), {}))
+            elif '=' in line and sections:
+                key, value = line.split('=', 1)
+                sections[-1][1][key.strip()] = value.strip()
+    return sections
+
+
+def get_darknet_info(cfg_path):
+    ''' input size, anchors and class count of a yolo v2 style cfg '''
+    sections = parse_darknet_cfg(cfg_path)
+    net = next(s for name, s in sections if name == 'net')
+    region = next(s for name, s in sections if name == 'region')
+    anchors = [float(a) for a in region['anchors'].split(',')]
+    return {
+        'width': int(net['width']),
+        'height': int(net['height']),
+        'anchors': np.array(anchors).reshape(-1, 2),
+        'classes': int(region['classes']),
+    }
+
+
+def _write_cfg_with_region_thresh(cfg_path, thresh):
+    '''
+    cv2's region layer zeroes class scores under the cfg's thresh (.6 in tiny-yolo.cfg),
+    which would hide everything between our threshold and that. Writes a copy with
+    thresh set to ours and returns its path.
+    '''
+    with open(cfg_path) as f:
+        cfg = f.read()
+    cfg = re.sub(r'^\s*thresh\s*=.*$', 'thresh = %f' % thresh, cfg, flags=re.MULTILINE)
+    fd, path = tempfile.mkstemp(suffix='.cfg')
+    with os.fdopen(fd, 'w') as f:
+        f.write(cfg)
+    return path
+
+
+def get_labels(cfg_path, num_classes):
+    ''' same label lookup as darkflow: coco.names for 80 class models, otherwise labels.txt '''
+    labels_path = os.path.join(os.path.dirname(cfg_path), 'coco.names') if num_classes == 80 else 'labels.txt'
+    with open(labels_path) as f:
+        labels = [l.strip() for l in f if l.strip()]
+    return labels[:num_classes]
+
+
+def _to_darkflow_results(boxes, scores, class_ids, labels, image_size, nms_threshold):
+    '''
+    boxes are normalized (cx, cy, w, h). Applies per-class non max suppression and
+    converts to darkflow style pixel dicts.
+    '''
+    img_w, img_h = image_size
+    results = []
+    for class_id in np.unique(class_ids):
+        idxs = np.flatnonzero(class_ids == class_id)
+        pixel_boxes = [[int((boxes[i, 0] - boxes[i, 2] / 2) * img_w),
+                        int((boxes[i, 1] - boxes[i, 3] / 2) * img_h),
+                        int(boxes[i, 2] * img_w),
+                        int(boxes[i, 3] * img_h)] for i in idxs]
+        keep = cv2.dnn.NMSBoxes(pixel_boxes, [float(scores[i]) for i in idxs], 0.0, nms_threshold)
+        for k in np.array(keep).flatten():
+            x, y, w, h = pixel_boxes[k]
+            results.append({
+                'label': labels[class_id],
+                'confidence': float(scores[idxs[k]]),
+                'topleft': {'x': max(0, x), 'y': max(0, y)},
+                'bottomright': {'x': min(img_w - 1, x + w), 'y': min(img_h - 1, y + h)},
+            })
+    return results
+
+
+class ObjectDetector(abc.ABC):
+    ''' detect(np_img) takes a BGR (3 channel) image and returns darkflow style object dicts '''
+
+    name = None
+
+    @abc.abstractmethod
+    def detect(self, np_img):
+        pass
+
+    def close(self):
+        pass
+
+
+class DarkflowDetector(ObjectDetector):
+    name = 'darkflow'
+
+    def __init__(self, config=TFNET_CONFIG):
+        from darkflow.net.build import TFNet
+        self.tfnet = TFNet(config)
+
+    def detect(self, np_img):
+        return self.tfnet.return_predict(np_img)
+
+
+class OpenCVDarknetDetector(ObjectDetector):
+    ''' cv2.dnn reads the darknet cfg + weights directly, and its region layer decodes the boxes '''
+
+    name = 'opencv'
+
+    def __init__(self, config=TFNET_CONFIG, num_threads=OBJECT_DETECTOR_THREADS, nms_threshold=OBJECT_DETECTOR_NMS_THRESHOLD):
+        self.threshold = config['threshold']
+        self.nms_threshold = nms_threshold
+
+        info = get_darknet_info(config['model'])
+        self.input_size = (info['width'], info['height'])
+        self.labels = get_labels(config['model'], info['classes'])
+
+        cv2.setNumThreads(num_threads)
+        cfg_path = _write_cfg_with_region_thresh(config['model'], self.threshold)
+        try:
+            self.net = cv2.dnn.readNetFromDarknet(cfg_path, config['load'])
+        finally:
+            os.remove(cfg_path)
+        self.net.setPreferableBackend(cv2.dnn.DNN_BACKEND_OPENCV)
+        self.net.setPreferableTarget(cv2.dnn.DNN_TARGET_CPU)
+
+    def detect(self, np_img):
+        # same preprocessing as darkflow: resize, BGR -> RGB, scale to 0..1
+        blob = cv2.dnn.blobFromImage(np_img, 1 / 255.0, self.input_size, swapRB=True, crop=False)
+        self.net.setInput(blob)
+        out = self.net.forward()  # rows of cx, cy, w, h, objectness, class scores...
+
+        class_scores = out[:, 5:]
+        class_ids = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(out)), class_ids]
+        keep = scores >= self.threshold
+
+        height, width = np_img.shape[:2]
+        return _to_darkflow_results(out[keep, :4], scores[keep], class_ids[keep], self.labels,
+                                    (width, height), self.nms_threshold)
+
+
+class OnnxRuntimeDetector(ObjectDetector):
+    '''
+    ONNX Runtime on a yolo v2 model converted to onnx (OBJECT_DETECTOR_ONNX_MODEL), whose output
+    is the raw (1, num_anchors * (5 + classes), grid_h, grid_w) region tensor.
+    Anchors / classes come from the darknet cfg, and the region layer is decoded here.
+    '''
+
+    name = 'onnx'
+
+    def __init__(self,
+                 config=TFNET_CONFIG,
+                 onnx_model=OBJECT_DETECTOR_ONNX_MODEL,
+                 num_threads=OBJECT_DETECTOR_THREADS,
+                 nms_threshold=OBJECT_DETECTOR_NMS_THRESHOLD):
+        import onnxruntime as ort
+
+        self.threshold = config['threshold']
+        self.nms_threshold = nms_threshold
+
+        info = get_darknet_info(config['model'])
+        self.input_size = (info['width'], info['height'])
+        self.anchors = info['anchors']
+        self.num_classes = info['classes']
+        self.labels = get_labels(config['model'], info['classes'])
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        options.inter_op_num_threads = 1
+        self.session = ort.InferenceSession(onnx_model, sess_options=options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def _decode_region(self, out):
+        ''' region tensor -> normalized (cx, cy, w, h) boxes, class scores '''
+        num_anchors = len(self.anchors)
+        _, _, grid_h, grid_w = out.shape
+        out = out.reshape(num_anchors, 5 + self.num_classes, grid_h, grid_w)
+
+        grid_x = np.arange(grid_w)[None, None, :]
+        grid_y = np.arange(grid_h)[None, :, None]
+        sigmoid = lambda v: 1 / (1 + np.exp(-v))  # noqa: E731
+
+        cx = (grid_x + sigmoid(out[:, 0])) / grid_w
+        cy = (grid_y + sigmoid(out[:, 1])) / grid_h
+        w = np.exp(out[:, 2]) * self.anchors[:, 0, None, None] / grid_w
+        h = np.exp(out[:, 3]) * self.anchors[:, 1, None, None] / grid_h
+        objectness = sigmoid(out[:, 4])
+
+        logits = out[:, 5:]
+        probs = np.exp(logits - logits.max(axis=1, keepdims=True))
+        probs /= probs.sum(axis=1, keepdims=True)
+        class_scores = probs * objectness[:, None]
+
+        boxes = np.stack([cx, cy, w, h], axis=-1).reshape(-1, 4)
+        class_scores = class_scores.transpose(0, 2, 3, 1).reshape(-1, self.num_classes)
+        return boxes, class_scores
+
+    def detect(self, np_img):
+        img = cv2.resize(np_img, self.input_size)
+        img = img[:, :, ::-1].astype(np.float32) / 255.0
+        # onnx models converted from darknet take NCHW
+        blob = np.ascontiguousarray(img.transpose(2, 0, 1)[None])
+
+        out = self.session.run(None, {self.input_name: blob})[0]
+        boxes, class_scores = self._decode_region(out)
+
+        class_ids = class_scores.argmax(axis=1)
+        scores = class_scores[np.arange(len(class_scores)), class_ids]
+        keep = scores >= self.threshold
+
+        height, width = np_img.shape[:2]
+        return _to_darkflow_results(boxes[keep], scores[keep], class_ids[keep], self.labels,
+                                    (width, height), self.nms_threshold)
+
+
+OBJECT_DETECTORS = {
+    'darkflow': DarkflowDetector,
+    'opencv': OpenCVDarknetDetector,
+    'onnx': OnnxRuntimeDetector,
+}
+
+
+def create_object_detector(backend=OBJECT_DETECTOR_BACKEND, config=TFNET_CONFIG):
+    if backend not in OBJECT_DETECTORS:
+        raise ValueError('Unknown object detector backend: %s' % backend)
+    return OBJECT_DETECTORS[backend](config=config)
@@ -0,0 +1,144 @@
+''' Keeps YOLO image_objects up to date between detections by following them with template matching '''
+
+import cv2
+import numpy as np
+from config import OBJECT_DETECT_EVERY, OBJECT_DETECT_SCENE_CHANGE, OBJECT_TRACK_MAX_AGE
+from config import OBJECT_TRACK_CONFIDENCE_DECAY, OBJECT_TRACK_MIN_MATCH, OBJECT_TRACK_SCALE, OBJECT_TRACK_SEARCH_PAD
+
+
+def get_rect_iou(a, b):
+    ''' intersection over union of two x,y,w,h rects '''
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    iw = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    ih = max(0, min(ay + ah, by + bh) - max(ay, by))
+    inter = iw * ih
+    union = aw * ah + bw * bh - inter
+    return inter / float(union) if union > 0 else 0
+
+
+class ObjectTracker(object):
+    '''
+    Decides when the detector has to run (every detect_every frames, or when the
+    scene changed a lot), and on the frames in between moves each detected object
+    to wherever its pixels went, by template matching near its last rect.
+
+    Objects get 'track_id' (kept across detections by IoU association), 'age'
+    (frames since it was last detected, 0 for fresh detections) and 'tracked'.
+    Tracked confidence decays every frame, and objects are dropped once they're too
+    old or can't be found.
+    '''
+
+    def __init__(self,
+                 detect_every=OBJECT_DETECT_EVERY,
+                 scene_change_fraction=OBJECT_DETECT_SCENE_CHANGE,
+                 max_age=OBJECT_TRACK_MAX_AGE,
+                 confidence_decay=OBJECT_TRACK_CONFIDENCE_DECAY,
+                 min_match=OBJECT_TRACK_MIN_MATCH,
+                 scale=OBJECT_TRACK_SCALE,
+                 search_pad=OBJECT_TRACK_SEARCH_PAD):
+        self.detect_every = detect_every
+        self.scene_change_fraction = scene_change_fraction
+        self.max_age = max_age
+        self.confidence_decay = confidence_decay
+        self.min_match = min_match
+        self.scale = scale
+        self.search_pad = search_pad
+
+        self.tracks = []  # (object dict, template)
+        self.frames_since_detect = None
+        self.next_track_id = 0
+
+    def should_detect(self, change_fraction=0):
+        return self.frames_since_detect is None \
+            or self.frames_since_detect + 1 >= self.detect_every \
+            or change_fraction >= self.scene_change_fraction
+
+    def _get_gray(self, np_img):
+        gray = cv2.cvtColor(np_img[:, :, :3], cv2.COLOR_BGR2GRAY)
+        if self.scale != 1:
+            gray = cv2.resize(gray, None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_AREA)
+        return gray
+
+    def _to_gray_rect(self, rect, gray):
+        ''' full frame rect -> integer rect in the (scaled) gray image, clipped to it '''
+        x, y, w, h = [int(round(v * self.scale)) for v in rect]
+        img_h, img_w = gray.shape
+        x, y = max(0, min(x, img_w - 1)), max(0, min(y, img_h - 1))
+        return x, y, max(1, min(w, img_w - x)), max(1, min(h, img_h - y))
+
+    def _get_template(self, gray, rect):
+        x, y, w, h = self._to_gray_rect(rect, gray)
+        template = gray[y:y + h, x:x + w]
+        # too small to follow reliably
+        return template.copy() if w >= 4 and h >= 4 else None
+
+    def update_detections(self, np_img, image_objects):
+        ''' fresh detections: carries track ids over from matching tracks, returns copies of objects '''
+        gray = self._get_gray(np_img)
+
+        # greedy IoU association, best overlapping pairs first
+        pairs = []
+        for i, obj in enumerate(image_objects):
+            for j, (track, _) in enumerate(self.tracks):
+                if obj['label'] == track['label']:
+                    iou = get_rect_iou(obj['rect'], track['rect'])
+                    if iou > 0.3:
+                        pairs.append((iou, i, j))
+        track_ids = {}
+        used_tracks = set()
+        for _, i, j in sorted(pairs, reverse=True):
+            if i not in track_ids and j not in used_tracks:
+                track_ids[i] = self.tracks[j][0]['track_id']
+                used_tracks.add(j)
+
+        self.tracks = []
+        for i, obj in enumerate(image_objects):
+            if i not in track_ids:
+                track_ids[i] = self.next_track_id
+                self.next_track_id += 1
+            tracked_obj = dict(obj, track_id=track_ids[i], age=0, tracked=False)
+            self.tracks.append((tracked_obj, self._get_template(gray, obj['rect'])))
+
+        self.frames_since_detect = 0
+        return [dict(obj) for obj, _ in self.tracks]
+
+    def _match_template(self, gray, rect, template):
+        ''' returns (new rect, match score) of template searched for near rect '''
+        x, y, w, h = self._to_gray_rect(rect, gray)
+        th, tw = template.shape
+        pad_x, pad_y = int(tw * self.search_pad) + 2, int(th * self.search_pad) + 2
+        img_h, img_w = gray.shape
+        left, top = max(0, x - pad_x), max(0, y - pad_y)
+        right, bottom = min(img_w, x + tw + pad_x), min(img_h, y + th + pad_y)
+        if right - left < tw or bottom - top < th:
+            return rect, 0
+
+        result = cv2.matchTemplate(gray[top:bottom, left:right], template, cv2.TM_CCOEFF_NORMED)
+        _, score, _, (mx, my) = cv2.minMaxLoc(result)
+        if not np.isfinite(score):
+            return rect, 0
+
+        dx = (left + mx - x) / self.scale
+        dy = (top + my - y) / self.scale
+        return (int(rect[0] + dx), int(rect[1] + dy), rect[2], rect[3]), score
+
+    def propagate(self, np_img):
+        ''' moves tracked objects to where they are in this frame, returns copies of the ones still tracked '''
+        gray = self._get_gray(np_img)
+        self.frames_since_detect = (self.frames_since_detect or 0) + 1
+
+        tracks = []
+        for obj, template in self.tracks:
+            if template is None or obj['age'] + 1 > self.max_age:
+                continue
+            rect, score = self._match_template(gray, obj['rect'], template)
+            if score < self.min_match:
+                continue
+
+            obj = dict(obj, rect=rect, age=obj['age'] + 1, tracked=True,
+                       confidence=obj['confidence'] * self.confidence_decay)
+            tracks.append((obj, template))
+
+        self.tracks = tracks
+        return [dict(obj) for obj, _ in self.tracks]
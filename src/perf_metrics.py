@@ -0,0 +1,86 @@
+''' Low-overhead rolling latency histograms and counters for the image stream '''
+
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from config import PERF_METRICS_WINDOW
+
+
+def get_percentile(sorted_values, pct):
+    ''' nearest-rank percentile of an already sorted list '''
+    if not sorted_values:
+        return 0
+    idx = int(round((pct / 100.0) * (len(sorted_values) - 1)))
+    return sorted_values[min(len(sorted_values) - 1, max(0, idx))]
+
+
+class StageMetrics(object):
+    '''
+    Keeps the last `window` durations of each named stage, plus counters and
+    exception counts. Recording is just a deque append, percentiles are only
+    computed when a summary is requested.
+    '''
+
+    def __init__(self, window=PERF_METRICS_WINDOW):
+        self.window = window
+        self.lock = threading.Lock()
+        self.durations = {}
+        self.counts = {}
+        self.errors = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            if name not in self.durations:
+                self.durations[name] = deque(maxlen=self.window)
+            self.durations[name].append(seconds)
+
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + amount
+
+    def record_error(self, name):
+        with self.lock:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def get_count(self, name):
+        return self.counts.get(name, 0)
+
+    @contextmanager
+    def time_stage(self, name):
+        ''' times the with block under name, counting it as an error if it raises '''
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception:
+            self.record_error(name)
+            raise
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    def timed(self, name, fn):
+        ''' wraps fn so every call is timed under name '''
+        def timed_fn(*args, **kwargs):
+            with self.time_stage(name):
+                return fn(*args, **kwargs)
+        return timed_fn
+
+    def get_summary(self):
+        ''' {stages: {name: {count, mean, p50, p95, p99}}, counts, errors}, times in ms '''
+        with self.lock:
+            durations = {k: list(v) for k, v in self.durations.items()}
+            counts = dict(self.counts)
+            errors = dict(self.errors)
+
+        stages = {}
+        for name, values in durations.items():
+            values = sorted(v * 1000.0 for v in values)
+            stages[name] = {
+                'count': len(values),
+                'mean': round(sum(values) / len(values), 2) if values else 0,
+                'p50': round(get_percentile(values, 50), 2),
+                'p95': round(get_percentile(values, 95), 2),
+                'p99': round(get_percentile(values, 99), 2),
+            }
+
+        return {'stages': stages, 'counts': counts, 'errors': errors}
@@ -18,7 +18,13 @@ from PIL import Image
 
 from config import REDIS_HOST, REDIS_PORT, TFNET_CONFIG, IMAGE_PROCESS_SCALE
 from config import VYSOR_CAP_AREA, NUM_MONITORS, MONITORS
+from config import IMAGE_STREAM_PIPELINED, IMAGE_STREAM_QUEUE_SIZE, PERF_METRICS_PUBLISH_INTERVAL
+from config import FRAME_RING_NAME, FRAME_RING_SLOTS, FRAME_RING_REDIS_FALLBACK
 from kim_logs import get_kim_logger
+from frame_pipeline import FramePipeline
+from perf_metrics import StageMetrics
+from ai_state_wire import encode_phone_image_state, set_phone_image_state_frame
+from shared_frame_ring import SharedFrameRing, is_shared_memory_available
 from ai_state import AIStateProcessor, CURRENT_IMG_CONFIG
 from window_setup import setup_vysor_window
 
@@ -70,19 +76,17 @@ class VysorDataStream(object):
             port=REDIS_PORT,
             db=0,
             decode_responses=True)
-
-    def run(self):
-        ''' Go! '''
-        # Move Vysor window to correct location
-        setup_vysor_window()
-
-        # Create Screen Capturer
-        sct = mss.mss()
-
-        # Create State Processor
-        # This is the most important aspect of the whole project!!!!!!
-        processor = AIStateProcessor(image_config=CURRENT_IMG_CONFIG)
-
+        self.last_publish_time = None
+        self.last_serialized_state = (None, None)
+        self.metrics = StageMetrics()
+        self.last_metrics_publish_time = time.time()
+        self.pipeline = None
+        self.frame_ring = None
+        self.use_frame_ring = is_shared_memory_available()
+        if not self.use_frame_ring:
+            self.logger.warning('Shared memory unavailable, publishing frames to redis phone-image-data')
+
+    def _get_capture_monitor(self, sct):
         # if more than 1 monitor, we go to the second monitor
         # confusing calc but have to find the "left" pos of 2nd mon for mss
         mon_left = 0 if NUM_MONITORS == 1 else MONITORS[0][1][0]
@@ -90,7 +94,7 @@ class VysorDataStream(object):
         mon_num = all_mon_lefts.index(mon_left) if mon_left in all_mon_lefts else 1
 
         x, y, w, h = VYSOR_CAP_AREA
-        mon = {
+        return {
             'top': y + sct.monitors[mon_num]['top'],
             'left': x + sct.monitors[mon_num]['left'],
             'width': w,
@@ -98,36 +102,156 @@ class VysorDataStream(object):
             'mon': mon_num
         }
 
+    def _capture_frame(self, sct, mon, index):
+        # Get raw pixels from the screen, save it to a Numpy array
+        with self.metrics.time_stage('capture'):
+            return {
+                'index': index,
+                'capture_time': time.time(),
+                'np_img': np.array(sct.grab(mon))
+            }
+
+    def _process_frame(self, processor, sess, frame):
+        # Get State!
+        with self.metrics.time_stage('process'):
+            frame['ai_state'] = processor.process_from_np_img(sess, frame['np_img'], scale=IMAGE_PROCESS_SCALE)
+        return frame
+
+    def _serialize_frame(self, frame):
+        ''' builds everything that gets sent to redis for a processed frame '''
+        with self.metrics.time_stage('serialize'):
+            return self._serialize_frame_data(frame)
+
+    def _serialize_frame_data(self, frame):
+        # unchanged frames re-publish the same AIState object, so only encode it once
+        ai_state = frame['ai_state']
+        last_state, state_msg = self.last_serialized_state
+        if ai_state is not last_state:
+            state_msg = encode_phone_image_state(ai_state, frame['index'], frame['capture_time'])
+            self.last_serialized_state = (ai_state, state_msg)
+        else:
+            state_msg = set_phone_image_state_frame(state_msg, frame['index'], frame['capture_time'])
+
+        frame['state_msg'] = state_msg
+        frame['image_bytes'] = None
+        if FRAME_RING_REDIS_FALLBACK or not self.use_frame_ring:
+            captured_rgb_image = cv2.cvtColor(frame['np_img'], cv2.COLOR_BGR2RGB)
+            frame['image_bytes'] = Image.fromarray(captured_rgb_image).tobytes()
+        return frame
+
+    def _write_frame_ring(self, frame):
+        ''' copies the captured frame into the shared memory ring (recreated if the capture size changes) '''
+        np_img = frame['np_img']
+        if self.frame_ring is None or self.frame_ring.shape != np_img.shape:
+            if self.frame_ring is not None:
+                self.frame_ring.close()
+            self.frame_ring = SharedFrameRing(np_img.shape, FRAME_RING_SLOTS, dtype=np_img.dtype, name=FRAME_RING_NAME)
+            self.logger.info('Writing frames to shared memory ring %s %s', FRAME_RING_NAME, np_img.shape)
+        self.frame_ring.write(np_img, frame['index'], frame['capture_time'])
+
+    def _publish_frame(self, frame):
+        with self.metrics.time_stage('publish'):
+            # Display (frame goes out first, so whoever sees the state can find its frame)
+            if self.use_frame_ring:
+                self._write_frame_ring(frame)
+
+            # Publish to redis (:
+            self.r.publish('phone-image-states', frame['state_msg'])
+            self.r.set('cur-phone-image-state', frame['state_msg'])
+
+            if frame['image_bytes'] is not None:
+                self.r.set('phone-image-data', frame['image_bytes'])
+
+        now = time.time()
+        self.metrics.record('latency', now - frame['capture_time'])
+        if self.last_publish_time is not None:
+            self.metrics.record('frame_interval', now - self.last_publish_time)
+            self.logger.info('fps: {0:.2f} (latency: {1:.3f}s, processed: {2}, skipped: {3})'.format(
+                1 / max(0.0001, now - self.last_publish_time),
+                now - frame['capture_time'],
+                self.metrics.get_count('frames_processed'),
+                self.metrics.get_count('frames_skipped')))
+        self.last_publish_time = now
+
+        if now - self.last_metrics_publish_time >= PERF_METRICS_PUBLISH_INTERVAL:
+            self._publish_metrics()
+            self.last_metrics_publish_time = now
+
+    def _publish_metrics(self):
+        ''' publishes stage latency percentiles for the frontend / process hub '''
+        summary = self.metrics.get_summary()
+        interval = summary['stages'].get('frame_interval')
+        summary['fps'] = round(1000.0 / interval['mean'], 2) if interval and interval['mean'] > 0 else 0
+        if self.pipeline:
+            summary['dropped'] = self.pipeline.get_dropped_counts()
+        self.r.publish('system-info-updates', json.dumps({'imageStreamPerf': summary}))
+
+    def run_sequential(self, processor, mon):
+        ''' capture -> process -> publish, one frame at a time '''
+        sct = mss.mss()
+
         with tf.Session() as sess:
             screen_num = 0
             while 'Screen Capturing':
-                last_time = time.time()
+                frame = self._capture_frame(sct, mon, screen_num)
+                frame = self._process_frame(processor, sess, frame)
+                self._publish_frame(self._serialize_frame(frame))
 
-                # Get raw pixels from the screen, save it to a Numpy array
-                captured_np_img = np.array(sct.grab(mon))
+                # increment then Just Give It A Break
+                screen_num += 1
+                time.sleep(0.001)
 
-                # Get State!
-                ai_state = processor.process_from_np_img(sess, captured_np_img, scale=IMAGE_PROCESS_SCALE)
+    def run_pipelined(self, processor, mon):
+        '''
+        capture, process, serialize and publish run as stages in their own threads,
+        so processing frame N+1 overlaps with serializing / publishing frame N. The next
+        frame is captured while the current one is processed, but only one ahead, so
+        nothing gets grabbed just to be dropped. Later queues drop the oldest frame
+        when full.
+        '''
+        capture_data = {'sct': None, 'screen_num': 0}
+
+        def capture():
+            # mss handles have to be created on the thread that uses them
+            if capture_data['sct'] is None:
+                capture_data['sct'] = mss.mss()
+
+            # only called once the previous capture was taken by process (see FramePipeline)
+            frame = self._capture_frame(capture_data['sct'], mon, capture_data['screen_num'])
+            capture_data['screen_num'] += 1
+            return frame
 
-                # Publish to redis (:
-                message = {
-                    'index': screen_num,
-                    'state': ai_state.serialize()
-                }
-                msg_json = json.dumps(message)
-                self.r.publish('phone-image-states', msg_json)
-                self.r.set('cur-phone-image-state', msg_json)
+        with tf.Session() as sess:
+            def process(frame):
+                return self._process_frame(processor, sess, frame)
 
-                # Display
-                captured_rgb_image = cv2.cvtColor(captured_np_img, cv2.COLOR_BGR2RGB)
-                phone_image = Image.fromarray(captured_rgb_image)
-                self.r.set('phone-image-data', phone_image.tobytes())
+            pipeline = self.pipeline = FramePipeline([
+                ('capture', capture),
+                ('process', process),
+                ('serialize', self._serialize_frame),
+                ('publish', self._publish_frame),
+            ], queue_size=IMAGE_STREAM_QUEUE_SIZE, logger_name='VysorDataStream')
+            pipeline.run()
 
-                self.logger.info('fps: {0}'.format(1 / (time.time() - last_time)))
+    def run(self):
+        ''' Go! '''
+        # Move Vysor window to correct location
+        setup_vysor_window()
 
-                # increment then Just Give It A Break
-                screen_num += 1
-                time.sleep(0.001)
+        # Create State Processor
+        # This is the most important aspect of the whole project!!!!!!
+        processor = AIStateProcessor(image_config=CURRENT_IMG_CONFIG, metrics=self.metrics)
+
+        mon = self._get_capture_monitor(mss.mss())
+
+        try:
+            if IMAGE_STREAM_PIPELINED:
+                self.run_pipelined(processor, mon)
+            else:
+                self.run_sequential(processor, mon)
+        finally:
+            if self.frame_ring is not None:
+                self.frame_ring.close()
 
 
 def setup_vysor_data_stream():
@@ -3,6 +3,7 @@ from collections import deque
 from enums import Action
 from config import REWARD_PARAMS
 from util import get_dist
+from image_hash_index import get_room_recognizer
 
 
 class RewardCalculator():
@@ -35,6 +36,7 @@ class RewardCalculator():
         self.reset_penalty = params['reset_penalty']
 
         self.last_step_num_keys = ['swipe', 'pass', 'tap', 'double_tap', 'object_tap']
+        self.room_recognizer = get_room_recognizer()
         self.mark_reset()
 
     def mark_reset(self):
@@ -109,12 +111,13 @@ class RewardCalculator():
             reward += (stars_delta * self.stars_mult)
             self.stars_history.append(ai_state.stars)
 
-        # add reward for color sig not seen in history
+        # add reward for room not seen in history
+        room_key = self.room_recognizer.get_room_key(ai_state)
         if len(self.color_sig_history) > 0:
-            color_sig_in_memory = [v for v in self.color_sig_history if v == ai_state.color_sig]
-            if len(color_sig_in_memory) == 0:
+            room_in_memory = [v for v in self.color_sig_history if v == room_key]
+            if len(room_in_memory) == 0:
                 reward += self.color_sig_change_reward
-        self.color_sig_history.append(ai_state.color_sig)
+        self.color_sig_history.append(room_key)
 
         # add rewards for actions based on memory
         if action_name in (Action.SWIPE_LEFT, Action.SWIPE_RIGHT):
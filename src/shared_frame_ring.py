@@ -0,0 +1,200 @@
+'''
+Fixed-slot ring of numpy frames in shared memory, readable from other processes without copies.
+
+Layout of the shared memory block:
+
+    ring header   magic, version, num_slots, frame shape / dtype, latest slot, closed flag
+    slot headers  per slot: seq, frame index, timestamp (seqlock, see read_latest)
+    frames        num_slots frames
+'''
+
+import multiprocessing
+import struct
+import time
+import numpy as np
+
+try:
+    from multiprocessing import shared_memory, resource_tracker
+except ImportError:
+    # python < 3.8
+    shared_memory = None
+    resource_tracker = None
+
+MAGIC = b'KFRG'
+VERSION = 1
+
+RING_HEADER = struct.Struct('<4sHHIIII8s')
+RING_HEADER_SIZE = 64
+LATEST_SLOT_OFFSET = RING_HEADER.size  # i64, -1 until the first write
+CLOSED_OFFSET = LATEST_SLOT_OFFSET + 8  # i64, 1 once the owner closed the ring
+
+SLOT_HEADER_DTYPE = np.dtype([('seq', '<u8'), ('index', '<u8'), ('timestamp', '<f8'), ('pad', '<u8')])
+
+
+def is_shared_memory_available():
+    return shared_memory is not None
+
+
+def share_resource_tracker():
+    ''' starts this process's resource tracker, so processes forked from now on share it '''
+    if resource_tracker is not None:
+        resource_tracker.ensure_running()
+
+
+def _untrack_attached(shm):
+    '''
+    Stops this process's resource tracker from unlinking a segment it only attached to
+    when it exits. multiprocessing children (forked or spawned) share their parent's
+    tracker, so there that would drop the owner's registration instead, and a crashed
+    owner would leak the segment.
+    '''
+    if multiprocessing.parent_process() is None:
+        resource_tracker.unregister(shm._name, 'shared_memory')
+
+
+def _get_layout(shape, num_slots, dtype):
+    ''' (slot headers offset, frames offset, total size) '''
+    slot_size = int(np.prod(shape)) * dtype.itemsize
+    frames_offset = RING_HEADER_SIZE + SLOT_HEADER_DTYPE.itemsize * num_slots
+    frames_offset = (frames_offset + 63) // 64 * 64
+    return RING_HEADER_SIZE, frames_offset, frames_offset + slot_size * num_slots
+
+
+class SharedFrameRing(object):
+    '''
+    A block of shared memory holding num_slots frames of the same shape.
+    The owner writes frames into the next slot, and any process that knows the
+    ring info (see get_info), or just its name (see attach_by_name), can attach and
+    get numpy views of the slots.
+
+    Every slot has a seqlock: the writer makes its seq odd while writing and even
+    again when done, so readers can tell if a frame changed under them.
+    '''
+
+    def __init__(self, shape, num_slots=3, dtype=np.uint8, name=None, create=True):
+        self.shape = tuple(int(v) for v in shape)
+        self.num_slots = num_slots
+        self.dtype = np.dtype(dtype)
+        self.owner = create
+
+        slot_headers_offset, frames_offset, size = _get_layout(self.shape, num_slots, self.dtype)
+        if create:
+            self.shm = self._create_shm(name, size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # only the owner should unlink the memory when it exits
+            _untrack_attached(self.shm)
+
+        buf = self.shm.buf
+        self.slot_headers = np.ndarray((num_slots,), dtype=SLOT_HEADER_DTYPE, buffer=buf, offset=slot_headers_offset)
+        self.latest_slot = np.ndarray((1,), dtype='<i8', buffer=buf, offset=LATEST_SLOT_OFFSET)
+        self.closed = np.ndarray((1,), dtype='<i8', buffer=buf, offset=CLOSED_OFFSET)
+        self.frames = np.ndarray((num_slots,) + self.shape, dtype=self.dtype, buffer=buf, offset=frames_offset)
+        self.next_slot = 0
+
+        if create:
+            shape3 = (list(self.shape) + [1, 1])[:3]
+            RING_HEADER.pack_into(buf, 0, MAGIC, VERSION, num_slots, len(self.shape),
+                                  shape3[0], shape3[1], shape3[2], self.dtype.str.encode('ascii'))
+            self.slot_headers[:] = 0
+            self.latest_slot[0] = -1
+            self.closed[0] = 0
+
+    @staticmethod
+    def _create_shm(name, size):
+        try:
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+        except FileExistsError:
+            # left behind by an owner that crashed, take it over
+            stale = shared_memory.SharedMemory(name=name)
+            stale.close()
+            stale.unlink()
+            return shared_memory.SharedMemory(name=name, create=True, size=size)
+
+    @classmethod
+    def attach(cls, info):
+        ''' attach to a ring created by another process '''
+        return cls(info['shape'], info['num_slots'], info['dtype'], name=info['name'], create=False)
+
+    @classmethod
+    def attach_by_name(cls, name):
+        ''' attach to a ring created by another process, reading its layout from the ring header '''
+        shm = shared_memory.SharedMemory(name=name)
+        try:
+            magic, _, num_slots, ndim, s0, s1, s2, dtype = RING_HEADER.unpack_from(shm.buf, 0)
+        finally:
+            shm.close()
+            _untrack_attached(shm)
+
+        if magic != MAGIC:
+            raise ValueError('%s is not a frame ring' % name)
+        shape = (s0, s1, s2)[:ndim]
+        return cls(shape, num_slots, dtype.rstrip(b'\0').decode('ascii'), name=name, create=False)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    def get_info(self):
+        ''' small picklable description of the ring for other processes '''
+        return {
+            'name': self.name,
+            'shape': self.shape,
+            'num_slots': self.num_slots,
+            'dtype': self.dtype.str
+        }
+
+    def write(self, np_img, index=0, timestamp=None):
+        ''' copies frame into the next slot and returns the slot number '''
+        slot = self.next_slot
+        header = self.slot_headers[slot:slot + 1]
+
+        header['seq'] += 1  # odd: being written
+        np.copyto(self.frames[slot], np_img)
+        header['index'] = index
+        header['timestamp'] = timestamp if timestamp is not None else time.time()
+        header['seq'] += 1  # even: done
+
+        self.latest_slot[0] = slot
+        self.next_slot = (slot + 1) % self.num_slots
+        return slot
+
+    def get_slot_view(self, slot):
+        ''' zero-copy view of the frame in the given slot '''
+        return self.frames[slot]
+
+    def is_closed(self):
+        return bool(self.closed[0])
+
+    def read_latest(self, reader_fn=None, max_attempts=5):
+        '''
+        Calls reader_fn(zero-copy view) on the most recently written frame, and
+        returns (frame index, timestamp, reader_fn result). reader_fn defaults to
+        copying the frame. If the writer overwrote the slot while reader_fn ran, the
+        result is thrown away and it tries again. Returns None if there is no
+        consistent frame (yet).
+        '''
+        reader_fn = reader_fn or np.copy
+        for _ in range(max_attempts):
+            slot = int(self.latest_slot[0])
+            if slot < 0:
+                return None
+
+            seq = int(self.slot_headers[slot]['seq'])
+            if seq % 2 == 1:
+                continue
+            index = int(self.slot_headers[slot]['index'])
+            timestamp = float(self.slot_headers[slot]['timestamp'])
+            result = reader_fn(self.frames[slot])
+
+            if int(self.slot_headers[slot]['seq']) == seq:
+                return index, timestamp, result
+        return None
+
+    def close(self):
+        if self.owner:
+            self.closed[0] = 1
+        self.slot_headers = self.latest_slot = self.closed = self.frames = None
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
@@ -0,0 +1,128 @@
+'''
+Versioned snapshots of the frontend's curState, and the diffs between them.
+
+Clients get a full snapshot ('curState') when they connect, then 'stateDelta'
+messages against the last version they acknowledged:
+
+    {base, version, frameNum,
+     imageState: {set: {field: value}, unset: [field]},
+     objects:    {set: [[key, image object]], unset: [key]},
+     systemInfo: {set, unset},
+     aiStatus:   {set, unset}}
+
+Sections that didn't change are left out. Image objects are keyed by track id when
+they have one (so moved objects are a changed entry), otherwise by their content.
+'''
+
+import hashlib
+import json
+from collections import OrderedDict
+from config import STATE_SYNC_HISTORY
+
+
+def get_object_key(obj):
+    if obj.get('track_id') is not None:
+        return 't%d' % obj['track_id']
+    content = json.dumps(obj, sort_keys=True).encode('utf-8')
+    return hashlib.blake2b(content, digest_size=6).hexdigest()
+
+
+def get_keyed_objects(image_objects):
+    ''' OrderedDict of key -> image object, duplicate keys get a #n suffix '''
+    keyed = OrderedDict()
+    for obj in image_objects:
+        key = get_object_key(obj)
+        dup_key, n = key, 1
+        while dup_key in keyed:
+            n += 1
+            dup_key = '%s#%d' % (key, n)
+        keyed[dup_key] = obj
+    return keyed
+
+
+def diff_dicts(old, new):
+    ''' {set, unset} of the top level fields that changed from old to new, or None if none did '''
+    old, new = old or {}, new or {}
+    changed = {k: v for k, v in new.items() if k not in old or old[k] != v}
+    removed = [k for k in old if k not in new]
+    if not changed and not removed:
+        return None
+    return {'set': changed, 'unset': removed}
+
+
+def diff_objects(old, new):
+    ''' {set: [[key, object]], unset: [key]} between two keyed object dicts, or None '''
+    changed = [[k, obj] for k, obj in new.items() if k not in old or old[k] != obj]
+    removed = [k for k in old if k not in new]
+    if not changed and not removed:
+        return None
+    return {'set': changed, 'unset': removed}
+
+
+class StateSnapshot(object):
+    ''' one version of the curState, with the image objects keyed for diffing '''
+
+    def __init__(self, version, frame_num, image_state, system_info, ai_status):
+        self.version = version
+        self.frame_num = frame_num
+        self.objects = get_keyed_objects(image_state.get('image_objects', [])) if image_state else OrderedDict()
+        self.image_state = {k: v for k, v in image_state.items() if k != 'image_objects'} if image_state else None
+        self.system_info = system_info
+        self.ai_status = ai_status
+
+    def to_message(self):
+        image_state = None
+        if self.image_state is not None:
+            image_state = dict(self.image_state, image_objects=list(self.objects.values()))
+        return {'type': 'curState', 'data': {
+            'version': self.version,
+            'frameNum': self.frame_num,
+            'imageState': image_state,
+            'objectKeys': list(self.objects.keys()),
+            'systemInfo': self.system_info,
+            'aiStatus': self.ai_status,
+        }}
+
+    def diff_message(self, base):
+        data = {'base': base.version, 'version': self.version, 'frameNum': self.frame_num}
+        sections = [
+            ('imageState', diff_dicts(base.image_state, self.image_state)),
+            ('objects', diff_objects(base.objects, self.objects)),
+            ('systemInfo', diff_dicts(base.system_info, self.system_info)),
+            ('aiStatus', diff_dicts(base.ai_status, self.ai_status)),
+        ]
+        data.update((name, diff) for name, diff in sections if diff is not None)
+        return {'type': 'stateDelta', 'data': data}
+
+
+class StateHistory(object):
+    '''
+    The last max_versions snapshots. Messages are json encoded once and shared by
+    every client on the same base version.
+    '''
+
+    def __init__(self, max_versions=STATE_SYNC_HISTORY):
+        self.max_versions = max_versions
+        self.snapshots = OrderedDict()
+        self.version = 0
+        self.messages = {}  # base version (None for full) -> json message for the current version
+
+    def update(self, frame_num, image_state, system_info, ai_status):
+        ''' adds a new version and returns it '''
+        self.version += 1
+        self.snapshots[self.version] = StateSnapshot(self.version, frame_num, image_state, system_info, ai_status)
+        while len(self.snapshots) > self.max_versions:
+            self.snapshots.popitem(last=False)
+        self.messages = {}
+        return self.version
+
+    def has_version(self, version):
+        return version in self.snapshots
+
+    def get_message(self, base=None):
+        ''' json of the current version, as a delta from base, or a full snapshot if base is None '''
+        if base not in self.messages:
+            cur = self.snapshots[self.version]
+            message = cur.diff_message(self.snapshots[base]) if base is not None else cur.to_message()
+            self.messages[base] = json.dumps(message)
+        return self.messages[base]
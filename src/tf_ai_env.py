@@ -159,10 +159,12 @@ class DeviceClientTfEnv(py_environment.PyEnvironment):
         if action_name != Action.RESET:
             self._take_ai_action(action_name, args)
 
-        observation = self._get_current_tf_obs()
+        # observation and reward both come from the first frame captured after the action
+        ai_state = self.action_state_manager.get_fresh_screen_state()
+        observation = self.ai_state_to_observation(ai_state)
 
         reward = self.reward_calculator.get_step_reward(
-            self.step_num, self.get_cur_ai_state(), action_name, args)
+            self.step_num, ai_state, action_name, args)
         self.most_recent_reward = reward
 
         self.logger.debug('Step %d (%d) - Reward %d',
@@ -160,11 +160,8 @@ class TfAgentDeepQManager(object):
                 self.env.reset()
 
             # swipe around a bit so that we don't always start in same location
-            for _ in range(randint(1, 20)):
-                if randint(0, 100) < 70:
-                    self.env.action_state_manager.perform_swipe_left_action({})
-                else:
-                    self.env.action_state_manager.perform_swipe_right_action({})
+            directions = [-1 if randint(0, 100) < 70 else 1 for _ in range(randint(1, 20))]
+            self.env.action_state_manager.perform_swipe_sequence(directions)
 
             # Collect a few steps, save to the replay buffer
             self.collect_driver.run()
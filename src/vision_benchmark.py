@@ -0,0 +1,253 @@
+'''
+Repeatable benchmark of the vision stack over a directory of captured frames.
+
+Runs every AIStateProcessor state component, plus the full pipeline, over each
+frame and writes per-stage throughput and latency percentiles as JSON so runs
+can be diffed across commits:
+
+    python3 src/vision_benchmark.py --frames frames/ --output bench.json
+    python3 src/vision_benchmark.py --frames frames/ --no-yolo --baseline bench.json
+    python3 src/vision_benchmark.py --frames frames/ --detector opencv --baseline bench.json
+    python3 src/vision_benchmark.py --frames frames/ --uncached-ocr --output bench.json
+
+Every frame is run warmup + iterations times, so after the first run the OCR
+result cache and the HUD digit templates answer every read. --uncached-ocr adds
+a second pass (stages suffixed '_uncached') with both out of the way, which is
+what a frame with new HUD values costs.
+
+Frames can be images (png / jpg) or packed numpy frames (.npy with one frame
+or a stack of frames, .npz with any number of them).
+'''
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import cv2
+import numpy as np
+
+from config import CURRENT_IMG_CONFIG, IMAGE_PROCESS_SCALE, IMAGE_PROCESS_MODE, OBJECT_DETECTOR_BACKEND
+from kim_logs import get_kim_logger
+from perf_metrics import StageMetrics
+from image_color import get_image_color_sig
+from ai_state import AIStateProcessor
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+
+logger = get_kim_logger('VisionBenchmark')
+
+
+def _to_capture_format(img):
+    ''' frames from mss are BGRA, so match that '''
+    if img.ndim == 2:
+        return cv2.cvtColor(img, cv2.COLOR_GRAY2BGRA)
+    if img.shape[2] == 3:
+        return cv2.cvtColor(img, cv2.COLOR_BGR2BGRA)
+    return img
+
+
+def load_frames(frames_dir, max_frames=None):
+    ''' loads images / packed numpy frames from frames_dir (sorted by filename) '''
+    frames = []
+    for filename in sorted(os.listdir(frames_dir)):
+        path = os.path.join(frames_dir, filename)
+        ext = os.path.splitext(filename)[1].lower()
+        if ext in IMAGE_EXTENSIONS:
+            img = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+            if img is not None:
+                frames.append(img)
+        elif ext == '.npy':
+            arr = np.load(path)
+            frames += list(arr) if arr.ndim == 4 else [arr]
+        elif ext == '.npz':
+            with np.load(path) as packed:
+                for key in sorted(packed.files):
+                    arr = packed[key]
+                    frames += list(arr) if arr.ndim == 4 else [arr]
+
+    frames = [_to_capture_format(f) for f in frames]
+    return frames[:max_frames] if max_frames else frames
+
+
+def get_git_commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL)
+        return out.decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def _clear_ocr_cache(ocr_processor):
+    with ocr_processor.ocr_cache.lock:
+        ocr_processor.ocr_cache.values.clear()
+
+
+def run_stage_benchmark(processor, frames, warmup, iterations, scale, uncached_ocr=False):
+    '''
+    Times each state component and the full pipeline on every frame.
+    With uncached_ocr the OCR cache is emptied before every run and the digit
+    template reader is skipped, so each HUD read goes to tesseract.
+    Returns {stage_name: {count, throughput_fps, mean, p50, p95, p99}}
+    '''
+    metrics = StageMetrics(window=len(frames) * iterations)
+    total_times = {}
+    ocr_processor = processor.ocr_processor
+    digit_reader = ocr_processor.digit_reader
+    if uncached_ocr:
+        ocr_processor.digit_reader = None
+
+    def run_timed(name, fn, record):
+        if uncached_ocr:
+            _clear_ocr_cache(ocr_processor)
+        start = time.perf_counter()
+        try:
+            fn()
+        except Exception as e:
+            logger.error('Exception running %s: %s', name, e)
+            metrics.record_error(name)
+        elapsed = time.perf_counter() - start
+        if record:
+            metrics.record(name, elapsed)
+            total_times[name] = total_times.get(name, 0) + elapsed
+
+    try:
+        for idx, frame in enumerate(frames):
+            logger.info('Frame %d / %d%s', idx + 1, len(frames), ' (uncached OCR)' if uncached_ocr else '')
+            for i in range(warmup + iterations):
+                record = i >= warmup
+                for name, fn in processor.get_state_components(frame, scale):
+                    run_timed(name, fn, record)
+                run_timed('full_pipeline', lambda: processor.process_from_np_img(None, frame, scale), record)
+    finally:
+        ocr_processor.digit_reader = digit_reader
+
+    summary = metrics.get_summary()
+    stages = summary['stages']
+    for name, total in total_times.items():
+        stages[name]['throughput_fps'] = round(stages[name]['count'] / total, 2) if total > 0 else 0
+        stages[name]['errors'] = summary['errors'].get(name, 0)
+    return stages
+
+
+def run_color_sig_benchmark(frames, iterations, methods=('histogram', 'kmeans')):
+    '''
+    Times get_image_color_sig with each method, and counts frames whose sig was
+    not the same on every iteration (unstable sigs break heuristic room tracking)
+    '''
+    metrics = StageMetrics(window=len(frames) * iterations)
+    unstable = {method: 0 for method in methods}
+
+    for frame in frames:
+        frame_3chan = frame[:, :, :3]
+        for method in methods:
+            name = 'color_sig_%s' % method
+            sigs = set(metrics.timed(name, get_image_color_sig)(frame_3chan, method=method)
+                       for _ in range(iterations))
+            if len(sigs) > 1:
+                unstable[method] += 1
+
+    stages = metrics.get_summary()['stages']
+    for method in methods:
+        stages['color_sig_%s' % method]['unstable_frames'] = unstable[method]
+    return stages
+
+
+def compare_to_baseline(stages, baseline_path, max_regression):
+    ''' logs p50 change per stage, returns False if any stage regressed more than max_regression '''
+    with open(baseline_path) as f:
+        baseline = json.load(f)['stages']
+
+    ok = True
+    for name, data in sorted(stages.items()):
+        if name not in baseline or baseline[name]['p50'] <= 0:
+            continue
+        change = (data['p50'] - baseline[name]['p50']) / baseline[name]['p50']
+        regressed = max_regression is not None and change > max_regression
+        ok = ok and not regressed
+        logger.info('%-16s p50 %8.2fms -> %8.2fms (%+.1f%%)%s', name,
+                    baseline[name]['p50'], data['p50'], change * 100, ' REGRESSION' if regressed else '')
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the AIStateProcessor vision stack.')
+    parser.add_argument('--frames', required=True, help='Directory of captured frames (png / jpg / npy / npz)')
+    parser.add_argument('--max-frames', default=None, type=int, help='Only use the first N frames')
+    parser.add_argument('--warmup', default=2, type=int, help='Untimed runs per frame (default: 2)')
+    parser.add_argument('--iterations', default=10, type=int, help='Timed runs per frame (default: 10)')
+    parser.add_argument('--scale', default=IMAGE_PROCESS_SCALE, type=float, help='YOLO image scale')
+    parser.add_argument('--no-yolo', action='store_true', help='Skip YOLO object detection entirely')
+    parser.add_argument('--detector', default=OBJECT_DETECTOR_BACKEND,
+                        help="Object detector backend: 'darkflow', 'opencv' or 'onnx'")
+    parser.add_argument('--track-objects', action='store_true',
+                        help='Only detect objects every few frames and track them in between')
+    parser.add_argument('--process-mode', default=IMAGE_PROCESS_MODE, help="'threaded' or 'process'")
+    parser.add_argument('--compare-color-sig', action='store_true',
+                        help='Also time / check stability of the histogram and kmeans color sig methods')
+    parser.add_argument('--uncached-ocr', action='store_true',
+                        help="Also time every stage with the OCR cache and digit templates disabled ('_uncached')")
+    parser.add_argument('--output', default=None, help='Write JSON results to this file (default: stdout)')
+    parser.add_argument('--baseline', default=None, help='JSON results of an earlier run to compare to')
+    parser.add_argument('--max-regression', default=None, type=float,
+                        help='Exit with 1 if any stage p50 is this much slower than baseline (0.2 = 20%%)')
+    args = parser.parse_args()
+
+    frames = load_frames(args.frames, args.max_frames)
+    if not frames:
+        logger.error('No frames found in %s', args.frames)
+        sys.exit(1)
+
+    # the change gate would skip every repeat of a frame, so turn it off
+    processor = AIStateProcessor(CURRENT_IMG_CONFIG,
+                                 process_mode=args.process_mode,
+                                 gate_unchanged_frames=False,
+                                 use_yolo=not args.no_yolo,
+                                 detector_backend=args.detector,
+                                 track_objects=args.track_objects)
+
+    stages = run_stage_benchmark(processor, frames, args.warmup, args.iterations, args.scale)
+    if args.uncached_ocr:
+        uncached = run_stage_benchmark(processor, frames, args.warmup, args.iterations, args.scale,
+                                       uncached_ocr=True)
+        stages.update(('%s_uncached' % name, data) for name, data in uncached.items())
+    processor.close()
+
+    if args.compare_color_sig:
+        stages.update(run_color_sig_benchmark(frames, args.iterations))
+
+    results = {
+        'meta': {
+            'commit': get_git_commit(),
+            'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'num_frames': len(frames),
+            'frame_shape': list(frames[0].shape),
+            'warmup': args.warmup,
+            'iterations': args.iterations,
+            'scale': args.scale,
+            'yolo': not args.no_yolo,
+            'detector': None if args.no_yolo else args.detector,
+            'track_objects': args.track_objects,
+            'process_mode': args.process_mode,
+            'uncached_ocr': args.uncached_ocr,
+        },
+        'stages': stages,
+    }
+
+    results_json = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(results_json)
+        logger.info('Wrote results to %s', args.output)
+    else:
+        print(results_json)
+
+    if args.baseline:
+        if not compare_to_baseline(stages, args.baseline, args.max_regression):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+import asyncore
+import socket
+import threading
+import time
+
+import pytest
+
+from asyncchat_kim import AsyncchatKim, KimCommand
+from device_client import DeviceClient
+from device_protocol import PROTOCOL_VERSION, STATUS_OK
+
+
+class FakeDeviceHandler(AsyncchatKim):
+    '''
+    Handles commands like DeviceMessageHandler: switches to the new protocol as soon as it
+    answers HELLO. The ack itself goes out hello_ack_delay later, standing in for the time
+    it takes to reach the client.
+    '''
+
+    def __init__(self, sock, server):
+        AsyncchatKim.__init__(self, sock=sock, logger_name='FakeDeviceHandler')
+        self.server = server
+        self.send_delay = 0
+
+    def _send_data(self, data):
+        if self.send_delay:
+            threading.Timer(self.send_delay, AsyncchatKim._send_data, [self, data]).start()
+        else:
+            AsyncchatKim._send_data(self, data)
+
+    def _handle_command(self, command_id, command, data):
+        if command == KimCommand.HELLO:
+            version = min(int(data[0]), PROTOCOL_VERSION)
+            self.send_delay = self.server.hello_ack_delay
+            self.send_ack(command_id, str(version))
+            self.send_delay = 0
+            self._set_protocol_version(version)
+            return
+
+        self.server.received.append((command, self.protocol_version))
+        if command == KimCommand.GET_PROCESS:
+            self.send_ack(command_id, ['com.test.app'], STATUS_OK, command)
+        elif command == KimCommand.RESET:
+            # drops the connection (on the asyncore thread, like a server going away)
+            self.close()
+
+
+class FakeDeviceServer(asyncore.dispatcher):
+
+    def __init__(self, hello_ack_delay=0.2):
+        asyncore.dispatcher.__init__(self)
+        self.hello_ack_delay = hello_ack_delay
+        self.received = []
+        self.handlers = []
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.bind(('127.0.0.1', 0))
+        self.listen(1)
+        self.port = self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        sock, _ = self.accept()
+        self.handlers.append(FakeDeviceHandler(sock, self))
+
+
+@pytest.fixture
+def server():
+    server = FakeDeviceServer()
+    yield server
+    for handler in server.handlers:
+        handler.close()
+    server.close()
+
+
+@pytest.fixture
+def client(server, monkeypatch):
+    thread_errors = []
+    monkeypatch.setattr(threading, 'excepthook', thread_errors.append)
+
+    client = DeviceClient(restart_delay=60, superlong_timeout_seconds=5)
+    client.port = server.port
+    yield client
+    client.stop()
+
+    assert client.comm is None or not client.comm.is_alive()
+    assert client.socket.fileno() == -1
+    assert [args.exc_value for args in thread_errors] == []
+
+
+def test_command_in_flight_during_negotiation_waits_for_hello_ack(server, client):
+    results = []
+
+    def send_during_hello():
+        deadline = time.time() + 5
+        while client.hello_command_id is None and time.time() < deadline:
+            time.sleep(0.001)
+        results.append(client.get_cur_process_command())
+
+    sender = threading.Thread(target=send_during_hello)
+    sender.start()
+    client.start()
+    sender.join(timeout=10)
+
+    assert results == ['com.test.app']
+    assert server.received == [(KimCommand.GET_PROCESS, PROTOCOL_VERSION)]
+    assert client.protocol_version == PROTOCOL_VERSION
+
+
+def test_disconnect_fails_pending_commands(server, client):
+    client.start()
+    # never acked, then the server goes away
+    future = client.send_command_async(KimCommand.BACK_BUTTON)
+    client.send_command_async(KimCommand.RESET)
+
+    with pytest.raises(ConnectionError):
+        future.result(timeout=5)
+    assert not client.ready.is_set()
@@ -0,0 +1,50 @@
+import threading
+import time
+
+from frame_pipeline import FramePipeline
+
+STAGE_TIME = 0.05
+NUM_FRAMES = 10
+
+
+def test_capture_overlaps_process_one_frame_ahead():
+    lock = threading.Lock()
+    counts = {'captured': 0, 'processed': 0, 'max_ahead': 0}
+    process_times = []
+    capture_times = []
+    done = threading.Event()
+
+    def capture():
+        start = time.perf_counter()
+        time.sleep(STAGE_TIME)
+        with lock:
+            counts['captured'] += 1
+            counts['max_ahead'] = max(counts['max_ahead'], counts['captured'] - counts['processed'])
+            capture_times.append((start, time.perf_counter()))
+            return counts['captured']
+
+    def process(frame_num):
+        start = time.perf_counter()
+        time.sleep(STAGE_TIME)
+        with lock:
+            counts['processed'] += 1
+            process_times.append((start, time.perf_counter()))
+            if counts['processed'] == NUM_FRAMES:
+                done.set()
+        return frame_num
+
+    pipeline = FramePipeline([('capture', capture), ('process', process)])
+    start = time.perf_counter()
+    pipeline.start()
+    assert done.wait(timeout=5)
+    elapsed = time.perf_counter() - start
+    pipeline.stop()
+    pipeline.join()
+
+    # sequential would be 2 * STAGE_TIME per frame
+    assert elapsed < NUM_FRAMES * STAGE_TIME * 1.6
+    # a capture ran during processing
+    assert any(c_start < p_end and p_start < c_end
+               for c_start, c_end in capture_times for p_start, p_end in process_times)
+    # never more than the frame being processed plus the one just captured
+    assert counts['max_ahead'] <= 2
@@ -0,0 +1,57 @@
+import cv2
+import numpy as np
+import pytest
+
+from image_digits import HUDDigitReader
+
+
+def draw_number(value, digit_width=24, height=40):
+    ''' white digits on black, one per digit_width columns (so glyphs don't touch) '''
+    text = str(value)
+    img = np.zeros((height, digit_width * len(text) + 8, 3), dtype=np.uint8)
+    for i, c in enumerate(text):
+        cv2.putText(img, c, (4 + i * digit_width, 32), cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+    return img
+
+
+def teach(reader, value):
+    for _ in range(reader.min_samples):
+        assert reader.learn(draw_number(value), value)
+
+
+def test_unlearned_digit_is_not_read():
+    reader = HUDDigitReader()
+    teach(reader, 12345678)
+    teach(reader, 10)
+
+    assert reader.get_num_active_digits() == 9
+    # 9 has no template, so nothing is read (the caller falls back to tesseract)
+    assert reader.read(draw_number(1289)) is None
+    assert reader.read(draw_number(1288)) is None
+
+
+def test_reads_once_every_digit_is_learned():
+    reader = HUDDigitReader()
+    teach(reader, 1234567890)
+
+    assert reader.is_complete()
+    assert reader.read(draw_number(9081726354)) == 9081726354
+
+
+def test_unlearned_digit_falls_back_to_tesseract(monkeypatch):
+    image_ocr = pytest.importorskip('image_ocr')
+    monkeypatch.setattr(image_ocr, 'TesseractPool', lambda: None)
+    tesseract_reads = []
+
+    def read_num_from_img(hud_image, tess_pool):
+        tesseract_reads.append(hud_image)
+        return 1289
+
+    monkeypatch.setattr(image_ocr, 'read_num_from_img', read_num_from_img)
+    processor = image_ocr.ImageOCRProcessor(image_config=None)
+    teach(processor.digit_reader, 12345678)
+    teach(processor.digit_reader, 10)
+
+    assert processor._read_num(draw_number(1289)) == 1289
+    assert len(tesseract_reads) == 1
+    processor.executor.shutdown()